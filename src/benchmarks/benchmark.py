@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+シミュレータとデータパイプラインのスケーリングベンチマーク
+
+USER_NUM, ITEM_NUM, TOP_K, EXPERIMENT_STEPS, TRIAL_NUMのグリッドについて、
+create_data.main / load_data / EnvelopeIndex.build / run_experiment の処理時間・スループット・
+ピークメモリを計測する。
+
+各計測は新しいPythonプロセスで実行する（config.pyの値を差し替えてから各モジュールを読み込むため、
+またピークメモリ(ru_maxrss)を計測対象の処理だけに限定するため）。
+"""
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+BENCHMARK_DIR = os.path.join("results", "benchmarks")
+
+
+def case_key(record: dict) -> str:
+    """計測結果を比較するためのキーを作成します"""
+    size = record["size"]
+    return (
+        f"{record['stage']}|{record['engine']}|{record['data_format']}|"
+        f"U={size['USER_NUM']}|I={size['ITEM_NUM']}|K={size['TOP_K']}|"
+        f"S={size['EXPERIMENT_STEPS']}|T={size['TRIAL_NUM']}"
+    )
+
+
+def run_case(case: dict) -> dict:
+    """
+    1つの計測を実行します（子プロセス内で呼び出されます）
+
+    Args:
+        case: stage, size, engine, data_format, lambda_value, decay_flagを持つ計測条件
+    Returns:
+        record: 計測結果
+    """
+    import config
+
+    size = case["size"]
+    for name, value in size.items():
+        setattr(config, name, value)
+
+    # config.pyの値を差し替えた後に読み込む
+    from data_processing import create_data
+    from experiments import experiment
+
+    stage = case["stage"]
+    extra = {}
+    start = time.perf_counter()
+    if stage == "envelope_index":
+        from experiments.envelope import EnvelopeIndex
+        from experiments.vectorized import rank_items
+
+        # 読み込みを除いたインデックス作成の時間と、同じ候補を全て評価するランキング1回分の時間
+        seconds = rank_seconds = 0.0
+        for trial in range(size["TRIAL_NUM"]):
+            _, item_scores = experiment.load_trial_arrays(trial, case["data_format"])
+            # メモリマップの読み込みを計測に含めないよう、先にメモリへ読み込む
+            item_scores = np.array(item_scores)
+            start = time.perf_counter()
+            EnvelopeIndex.build(item_scores, size["TOP_K"])
+            seconds += time.perf_counter() - start
+            flat_scores = item_scores.reshape(-1, *item_scores.shape[2:])
+            deltas = np.zeros(len(flat_scores))
+            start = time.perf_counter()
+            rank_items(flat_scores, deltas, case["lambda_value"], size["TOP_K"])
+            rank_seconds += time.perf_counter() - start
+        extra = {
+            "rank_items_seconds": rank_seconds,
+            "build_to_rank_ratio": seconds / rank_seconds,
+        }
+    elif stage == "create_data":
+        create_data.main(case["data_format"])
+    elif stage == "load_data":
+        for trial in range(size["TRIAL_NUM"]):
+            experiment.load_trial(
+                trial, case["engine"], case["data_format"], with_baseline=False
+            )
+    else:
+        experiment.run_experiment(
+            case["lambda_value"],
+            case["decay_flag"],
+            case["engine"],
+            case["data_format"],
+        )
+    if stage != "envelope_index":
+        seconds = time.perf_counter() - start
+
+    user_steps = size["USER_NUM"] * size["EXPERIMENT_STEPS"] * size["TRIAL_NUM"]
+    return {
+        **case,
+        "seconds": seconds,
+        "user_steps_per_sec": user_steps / seconds,
+        "candidates_per_sec": user_steps * size["ITEM_NUM"] / seconds,
+        # Linuxではru_maxrssの単位はKB
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        **extra,
+    }
+
+
+def spawn_case(case: dict, work_dir: str) -> dict:
+    """計測を子プロセスで実行し、その結果を受け取ります"""
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run_case", json.dumps(case)],
+        cwd=work_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def build_sizes(args) -> list[dict]:
+    """グリッドの全組み合わせを作成します"""
+    return [
+        {
+            "USER_NUM": users,
+            "ITEM_NUM": items,
+            "TOP_K": top_k,
+            "EXPERIMENT_STEPS": steps,
+            "TRIAL_NUM": trials,
+        }
+        for users, items, top_k, steps, trials in itertools.product(
+            args.users, args.items, args.top_k, args.steps, args.trials
+        )
+        if top_k <= items
+    ]
+
+
+def run_benchmarks(args) -> list[dict]:
+    """グリッドの全ての計測を実行します"""
+    records = []
+    file_formats = [fmt for fmt in args.data_formats if fmt != "generated"]
+
+    for size in build_sizes(args):
+        # 試行データはサイズごとに一時ディレクトリへ生成する
+        with tempfile.TemporaryDirectory() as work_dir:
+            cases = [
+                {"stage": "create_data", "engine": "-", "data_format": fmt}
+                for fmt in file_formats
+            ]
+            cases += [
+                {"stage": stage, "engine": engine, "data_format": fmt}
+                for stage in ["load_data", "run_experiment"]
+                for engine in args.engines
+                for fmt in args.data_formats
+            ]
+            # 包絡線インデックスはvectorizedエンジン・ファイル形式のデータでのみ作成される
+            if "vectorized" in args.engines:
+                cases += [
+                    {
+                        "stage": "envelope_index",
+                        "engine": "vectorized",
+                        "data_format": fmt,
+                    }
+                    for fmt in file_formats
+                ]
+            for case in cases:
+                case.update(
+                    size=size,
+                    lambda_value=args.lambda_value,
+                    decay_flag=args.decay_flag,
+                )
+                # 計測のばらつきを抑えるため、repeat回のうち最も速い結果を採用する
+                record = min(
+                    (spawn_case(case, work_dir) for _ in range(args.repeat)),
+                    key=lambda r: r["seconds"],
+                )
+                print(
+                    f"{case_key(record)}: {record['seconds']:.3f}s, "
+                    f"{record['user_steps_per_sec']:.0f} users·steps/s, "
+                    f"{record['candidates_per_sec']:.0f} candidates/s, "
+                    f"peak {record['peak_rss_mb']:.1f}MB"
+                    + (
+                        f", ランキング1回分の{record['build_to_rank_ratio']:.1f}倍"
+                        if "build_to_rank_ratio" in record
+                        else ""
+                    )
+                )
+                records.append(record)
+
+    return records
+
+
+def compare_results(records: list[dict], baseline: list[dict], threshold: float):
+    """
+    ベースラインと比較し、性能が低下した計測を返します
+
+    Args:
+        records: 今回の計測結果
+        baseline: ベースラインの計測結果
+        threshold: 許容する低下率（0.2なら20%）
+    Returns:
+        regressions: (キー, 指標, ベースライン値, 今回の値) のリスト
+    """
+    baseline_by_key = {case_key(record): record for record in baseline}
+    regressions = []
+    for record in records:
+        key = case_key(record)
+        if key not in baseline_by_key:
+            continue
+        base = baseline_by_key[key]
+        if record["user_steps_per_sec"] < base["user_steps_per_sec"] * (1 - threshold):
+            regressions.append(
+                (
+                    key,
+                    "user_steps_per_sec",
+                    base["user_steps_per_sec"],
+                    record["user_steps_per_sec"],
+                )
+            )
+        if record["peak_rss_mb"] > base["peak_rss_mb"] * (1 + threshold):
+            regressions.append(
+                (key, "peak_rss_mb", base["peak_rss_mb"], record["peak_rss_mb"])
+            )
+    return regressions
+
+
+def parse_arguments():
+    """コマンドライン引数をパースします"""
+    parser = argparse.ArgumentParser(description="スケーリングベンチマーク")
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--items", type=int, nargs="+", default=[10])
+    parser.add_argument("--top_k", type=int, nargs="+", default=[1])
+    parser.add_argument("--steps", type=int, nargs="+", default=[50])
+    parser.add_argument("--trials", type=int, nargs="+", default=[2])
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=["loop", "vectorized"],
+        default=["loop", "vectorized"],
+    )
+    parser.add_argument(
+        "--data_formats",
+        nargs="+",
+        choices=["csv", "npy", "generated"],
+        default=["csv", "npy"],
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="各計測の繰り返し回数 (最速値を採用)"
+    )
+    parser.add_argument("--lambda_value", type=float, default=0.1)
+    parser.add_argument(
+        "--no_decay_flag",
+        action="store_false",
+        dest="decay_flag",
+        help="減衰なしで計測する場合に指定",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="計測結果の保存先 (デフォルト: results/benchmarks/benchmark_{timestamp}.json)",
+    )
+    parser.add_argument(
+        "--compare", default=None, help="比較するベースラインの計測結果ファイル"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="性能低下とみなす割合 (スループット低下・ピークメモリ増加)",
+    )
+    parser.add_argument("--run_case", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    """メイン関数"""
+    args = parse_arguments()
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return 0
+
+    records = run_benchmarks(args)
+
+    output = args.output
+    if output is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output = os.path.join(BENCHMARK_DIR, f"benchmark_{timestamp}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(records, f, indent=2)
+    print(f"計測結果を保存しました: {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(records, baseline, args.threshold)
+        for key, metric, base_value, value in regressions:
+            print(f"性能低下: {key} {metric}: {base_value:.1f} -> {value:.1f}")
+        if regressions:
+            return 1
+        print("性能低下は検出されませんでした")
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
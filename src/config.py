@@ -23,7 +23,11 @@ USER_STATE_POWER = 1 / 3  # user_state_scoreのべき乗値
 
 
 class ModelConfig:
-    """モデル固有のパラメータ"""
+    """モデル固有のパラメータ
+
+    スコア関数のitemにはItem（1件）とItemBatch（配列）のどちらも渡せる。
+    ItemBatchの場合はdeltaも候補の列とブロードキャスト可能な配列とする。
+    """
 
     @staticmethod
     def baseline_score(item):
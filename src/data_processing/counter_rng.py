@@ -0,0 +1,277 @@
+"""
+カウンタベース乱数（Philox4x32-10）による試行データのオンデマンド生成
+
+各値は (trial, user, step, item) をカウンタ・キーとする乱数から直接求めるため、
+データファイルを作らずに必要な候補だけをブロック単位で生成でき、生成順序にも依存しない。
+
+- キー: (RANDOM_SEED, trial)
+- カウンタ: (item, step, user, stream)。streamはアイテムスコア(0)、ユーザー初期状態(1)、
+  成否判定の一様乱数(2)の区別。成否判定ではitemの位置に推薦枠（top_kの順位）を使う
+- 出力の4ワードのうち先頭3ワードを (ph1, ph2, ph3) に使用する
+"""
+
+import os
+import sys
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from config import RANDOM_SEED  # noqa: E402
+
+# Philox4x32の定数
+PHILOX_M0 = np.uint64(0xD2511F53)
+PHILOX_M1 = np.uint64(0xCD9E8D57)
+PHILOX_W0 = np.uint64(0x9E3779B9)
+PHILOX_W1 = np.uint64(0xBB67AE85)
+PHILOX_ROUNDS = 10
+MASK32 = np.uint64(0xFFFFFFFF)
+
+ITEM_STREAM = 0
+USER_STREAM = 1
+OUTCOME_STREAM = 2
+
+# 1回のPhilox計算で扱うカウンタ数の上限（一時配列のメモリを抑えるため）
+BLOCK_SIZE = 1 << 20
+
+
+def philox4x32(counter: np.ndarray, key: tuple[int, int]) -> np.ndarray:
+    """
+    Philox4x32-10をNumPy配列で計算する
+
+    Args:
+        counter: shape (..., 4) の32bitカウンタ
+        key: 2ワードの32bitキー
+    Returns:
+        output: shape (..., 4) のuint32乱数
+    """
+    counter = np.asarray(counter, dtype=np.uint64) & MASK32
+    c0, c1, c2, c3 = (counter[..., i] for i in range(4))
+    k0 = np.uint64(key[0]) & MASK32
+    k1 = np.uint64(key[1]) & MASK32
+
+    for round_idx in range(PHILOX_ROUNDS):
+        if round_idx > 0:
+            k0 = (k0 + PHILOX_W0) & MASK32
+            k1 = (k1 + PHILOX_W1) & MASK32
+        prod0 = PHILOX_M0 * c0
+        prod1 = PHILOX_M1 * c2
+        c0, c1, c2, c3 = (
+            (prod1 >> np.uint64(32)) ^ c1 ^ k0,
+            prod1 & MASK32,
+            (prod0 >> np.uint64(32)) ^ c3 ^ k1,
+            prod0 & MASK32,
+        )
+
+    return np.stack([c0, c1, c2, c3], axis=-1).astype(np.uint32)
+
+
+def to_uniform(words: np.ndarray) -> np.ndarray:
+    """uint32乱数を[0, 1)の一様乱数に変換する"""
+    return words.astype(np.float64) / 2.0**32
+
+
+def _draw(
+    trial: int,
+    users: np.ndarray,
+    steps: np.ndarray,
+    items: np.ndarray,
+    stream: int,
+    seed: int,
+) -> np.ndarray:
+    """(user, step, item) のブロードキャスト結果ごとに4ワードの乱数を生成する"""
+    users, steps, items = np.broadcast_arrays(
+        np.asarray(users, dtype=np.uint64),
+        np.asarray(steps, dtype=np.uint64),
+        np.asarray(items, dtype=np.uint64),
+    )
+    counter = np.stack(
+        [items, steps, users, np.full_like(users, stream)], axis=-1
+    ).reshape(-1, 4)
+
+    output = np.empty(counter.shape, dtype=np.uint32)
+    for start in range(0, counter.shape[0], BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        output[block] = philox4x32(counter[block], (seed, trial))
+    return output.reshape(users.shape + (4,))
+
+
+def generate_user_states(
+    trial: int, users: np.ndarray, seed: int = RANDOM_SEED
+) -> np.ndarray:
+    """
+    ユーザーの初期状態を生成する（0-50の一様な整数）
+
+    Args:
+        trial: 試行番号
+        users: ユーザーIDの配列
+        seed: 乱数シード
+    Returns:
+        user_states: shape (users, 2) の初期状態 (ph1_counts, steps_since_last_ph1)
+    """
+    words = _draw(trial, users, 0, 0, USER_STREAM, seed)
+    return np.floor(to_uniform(words[..., :2]) * 51).astype(np.int64)
+
+
+def generate_item_scores(
+    trial: int,
+    users: np.ndarray,
+    step: int | np.ndarray,
+    num_items: int,
+    seed: int = RANDOM_SEED,
+) -> np.ndarray:
+    """
+    指定した (user, step) の候補アイテムのスコアを生成する（[0, 0.1]、小数点4桁）
+
+    Args:
+        trial: 試行番号
+        users: ユーザーIDの配列
+        step: ステップ（整数またはusersとブロードキャスト可能な配列）
+        num_items: 候補アイテム数
+        seed: 乱数シード
+    Returns:
+        item_scores: shape (users, items, 3) のph1~3スコア
+    """
+    users = np.asarray(users)[..., None]
+    step = np.asarray(step)[..., None]
+    words = _draw(trial, users, step, np.arange(num_items), ITEM_STREAM, seed)
+    return np.round(to_uniform(words[..., :3]) * 0.1, 4)
+
+
+class GeneratedItemScores:
+    """
+    shape (users, steps, items, 3) のアイテムスコア配列のように振る舞う遅延生成ビュー
+
+    `item_scores[users, step]` の形で参照された候補だけをその場で生成する。
+    `np.asarray` で全体を実体化することもできる。
+    first_userを指定すると、行iはユーザーID first_user + i の候補になる（シャード分割用）。
+    """
+
+    def __init__(
+        self,
+        trial: int,
+        num_users: int,
+        num_steps: int,
+        num_items: int,
+        seed: int = RANDOM_SEED,
+        first_user: int = 0,
+    ):
+        self.trial = trial
+        self.seed = seed
+        self.first_user = first_user
+        self.shape = (num_users, num_steps, num_items, 3)
+
+    def __getitem__(self, index):
+        users, step = index
+        users = self.first_user + np.arange(self.shape[0])[users]
+        return generate_item_scores(self.trial, users, step, self.shape[2], self.seed)
+
+    def __array__(self, dtype=None, copy=None):
+        num_steps = self.shape[1]
+        scores = np.stack([self[:, step] for step in range(num_steps)], axis=1)
+        return scores if dtype is None else scores.astype(dtype)
+
+
+def load_trial_generated(
+    trial: int,
+    num_users: int,
+    num_steps: int,
+    num_items: int,
+    seed: int = RANDOM_SEED,
+    first_user: int = 0,
+) -> tuple[np.ndarray, GeneratedItemScores]:
+    """
+    1試行分のデータをカウンタベース乱数で用意する
+
+    Args:
+        trial: 試行番号
+        num_users: ユーザー数
+        num_steps: ステップ数
+        num_items: 候補アイテム数
+        seed: 乱数シード
+        first_user: 先頭のユーザーID（ユーザーID first_user から num_users 人分を用意する）
+    Returns:
+        tuple[np.ndarray, GeneratedItemScores]: ユーザー初期状態と遅延生成のアイテムスコア
+    """
+    users = np.arange(first_user, first_user + num_users)
+    user_states = generate_user_states(trial, users, seed)
+    item_scores = GeneratedItemScores(
+        trial, num_users, num_steps, num_items, seed, first_user
+    )
+    return user_states, item_scores
+
+
+def generate_outcome_uniforms(
+    trial: int,
+    users: np.ndarray,
+    step: int | np.ndarray,
+    slot: int | np.ndarray = 0,
+    seed: int = RANDOM_SEED,
+) -> np.ndarray:
+    """
+    成否判定に使う (trial, user, step, slot, phase) ごとに固定の一様乱数を生成する
+
+    Args:
+        trial: 試行番号
+        users: ユーザーIDの配列
+        step: ステップ（整数またはusersとブロードキャスト可能な配列）
+        slot: 推薦枠（top_kの順位）
+        seed: 乱数シード
+    Returns:
+        uniforms: shape (users, 3) のph1~3の判定に使う[0, 1)の一様乱数
+    """
+    words = _draw(trial, users, step, slot, OUTCOME_STREAM, seed)
+    return to_uniform(words[..., :3])
+
+
+class OutcomeUniforms:
+    """
+    共通乱数（common random numbers）による成否判定の一様乱数
+
+    ランキングの結果にかかわらず (trial, user, step, slot, phase) ごとに同じ乱数を使うため、
+    同じ試行のλや方策の違いによる結果の差に、乱数の消費順序の違いによるばらつきが含まれない。
+
+    antitheticの場合は試行を2つずつ組にし、奇数番目の試行では組の偶数番目の試行の乱数uの代わりに1 - uを使う。
+
+    Attributes:
+        trial (int): 試行番号
+        antithetic (bool): 対称変量法を使うかどうか
+        first_user (int): 引数のユーザー番号0に対応するユーザーID（シャード分割用）
+    """
+
+    def __init__(
+        self,
+        trial: int,
+        antithetic: bool = False,
+        seed: int = RANDOM_SEED,
+        first_user: int = 0,
+    ):
+        self.trial = trial
+        self.antithetic = antithetic
+        self.seed = seed
+        self.first_user = first_user
+        self.base_trial = trial - trial % 2 if antithetic else trial
+        self.flip = antithetic and trial % 2 == 1
+
+    def __call__(self, users: np.ndarray, step: int, slot: int = 0) -> np.ndarray:
+        """shape (users, 3) の (user, step, slot) のph1~3の一様乱数を返す"""
+        uniforms = generate_outcome_uniforms(
+            self.base_trial, self.first_user + users, step, slot, self.seed
+        )
+        return 1.0 - uniforms if self.flip else uniforms
+
+    def table(self, num_users: int, num_steps: int, num_slots: int) -> np.ndarray:
+        """shape (users, steps, slots, 3) の全ての一様乱数を返す"""
+        users = self.first_user + np.arange(num_users)[:, None, None]
+        steps = np.arange(num_steps)[None, :, None]
+        slots = np.arange(num_slots)[None, None, :]
+        uniforms = to_uniform(
+            _draw(self.base_trial, users, steps, slots, OUTCOME_STREAM, self.seed)[
+                ..., :3
+            ]
+        )
+        return 1.0 - uniforms if self.flip else uniforms
@@ -1,93 +1,220 @@
-import numpy as np
-import csv
+"""
+実験データの生成
+
+各試行のデータは `SeedSequence(RANDOM_SEED, spawn_key=(trial,))` から作る独立した乱数列で生成するため、
+試行を生成する順序や並列数によらず同じデータになる。
+ユーザーをチャンクに分け、チャンクごとに全 (user, step, item) のスコアを配列としてまとめて生成し、
+.npyはメモリマップに、CSVはチャンクごとの文字列として書き出す。
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
-from config import USER_NUM, ITEM_NUM, RANDOM_SEED, EXPERIMENT_STEPS, TRIAL_NUM
 
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
 
-def generate_user_initial_states(num_users):
+from config import (  # noqa: E402
+    USER_NUM,
+    ITEM_NUM,
+    RANDOM_SEED,
+    EXPERIMENT_STEPS,
+    TRIAL_NUM,
+)
+from data_processing.trial_data import (  # noqa: E402
+    CSV_CHUNK_ROWS,
+    DATA_DIR,
+    ITEM_CSV_COLUMNS,
+    USER_CSV_COLUMNS,
+    create_trial_npy,
+    format_item_rows,
+    format_user_rows,
+)
+
+
+def trial_generators(
+    trial: int, seed: int = RANDOM_SEED
+) -> tuple[np.random.Generator, np.random.Generator]:
     """
-    各試行ごとのユーザーの初期状態を生成
+    試行ごとに独立したユーザー初期状態用・アイテムスコア用の乱数生成器を作成する
+
+    Args:
+        trial: 試行番号
+        seed: 乱数シード
     Returns:
-        dict: {
-            'ph1_counts': array of shape (num_users, num_items),
-            'steps_since_last_ph1': array of shape (num_users, num_items)
-        }
+        tuple[np.random.Generator, np.random.Generator]: ユーザー初期状態用とアイテムスコア用の乱数生成器
+    """
+    user_seed, item_seed = np.random.SeedSequence(seed, spawn_key=(trial,)).spawn(2)
+    return np.random.default_rng(user_seed), np.random.default_rng(item_seed)
+
+
+def generate_user_initial_states(
+    rng: np.random.Generator, num_users: int
+) -> np.ndarray:
     """
-    # 0-50の間で乱数を生成
-    ph1_counts = np.random.randint(0, 51, num_users).tolist()
-    steps_since_last_ph1 = np.random.randint(0, 51, num_users).tolist()
+    ユーザーの初期状態を生成する（0-50の一様な整数）
+
+    一様乱数から求めるため、チャンクに分けて順に生成しても一括で生成した場合と同じ値になる。
 
-    return {"ph1_counts": ph1_counts, "steps_since_last_ph1": steps_since_last_ph1}
+    Args:
+        rng: ユーザー初期状態用の乱数生成器
+        num_users: ユーザー数
+    Returns:
+        user_states: shape (users, 2) の初期状態 (ph1_counts, steps_since_last_ph1)
+    """
+    return np.floor(rng.random((num_users, 2)) * 51).astype(np.int64)
 
 
-def generate_items(num_items, num_users, num_steps):
+def generate_items(
+    rng: np.random.Generator, num_users: int, num_steps: int, num_items: int
+) -> np.ndarray:
     """
-    Userごとに各ステップで推薦するアイテムのスコアを生成
+    ユーザーごとに各ステップで推薦するアイテムのスコアを生成する（[0, 0.1]、小数点4桁）
+
+    Args:
+        rng: アイテムスコア用の乱数生成器
+        num_users: ユーザー数
+        num_steps: ステップ数
+        num_items: 候補アイテム数
+    Returns:
+        item_scores: shape (users, steps, items, 3) のph1~3スコア
     """
-    # ユーザー×ステップ数分のスコアを生成（小数点4桁まで）
-    ph1_scores = np.round(
-        np.random.rand(num_items, num_users * num_steps) * 0.1, 4
-    ).tolist()
-    ph2_scores = np.round(
-        np.random.rand(num_items, num_users * num_steps) * 0.1, 4
-    ).tolist()
-    ph3_scores = np.round(
-        np.random.rand(num_items, num_users * num_steps) * 0.1, 4
-    ).tolist()
-
-    return {
-        "ph1_scores": ph1_scores,
-        "ph2_scores": ph2_scores,
-        "ph3_scores": ph3_scores,
-    }
-
-
-def main():
-    # 出力ディレクトリの作成
-    data_dir = Path("data")
-    data_dir.mkdir(exist_ok=True)
-
-    # 乱数シードの設定
-    np.random.seed(RANDOM_SEED)
-
-    for trial in range(TRIAL_NUM):
-        # 各試行で新しいユーザー初期状態を生成
-        user_data = generate_user_initial_states(USER_NUM)
-        # 各試行で新しいアイテムスコアを生成（ユーザー×ステップ数分）
-        item_data = generate_items(ITEM_NUM, USER_NUM, EXPERIMENT_STEPS)
-        # user_{trial_num}.csvとして保存
-        user_data_path = data_dir / f"user_{trial}.csv"
-        with open(user_data_path, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(["ph1_counts", "steps_since_last_ph1"])
-            for ph1_count, step in zip(
-                user_data["ph1_counts"], user_data["steps_since_last_ph1"]
-            ):
-                writer.writerow([ph1_count, step])
-
-        # item_{trial_num}.csvとして保存
-        item_data_path = data_dir / f"item_{trial}.csv"
-        with open(item_data_path, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(
-                ["user", "step", "item", "ph1_scores", "ph2_scores", "ph3_scores"]
+    return np.round(rng.random((num_users, num_steps, num_items, 3)) * 0.1, 4)
+
+
+def generate_trial(
+    trial: int,
+    data_format: str = "both",
+    num_users: int = USER_NUM,
+    num_steps: int = EXPERIMENT_STEPS,
+    num_items: int = ITEM_NUM,
+    data_dir=DATA_DIR,
+    chunk_users: int | None = None,
+    seed: int = RANDOM_SEED,
+) -> int:
+    """
+    1試行分のデータを生成して保存する
+
+    Args:
+        trial: 試行番号
+        data_format: 出力形式（"csv", "npy", "both"）
+        num_users: ユーザー数
+        num_steps: ステップ数
+        num_items: 候補アイテム数
+        data_dir: 出力ディレクトリ
+        chunk_users: 1度に生成するユーザー数（Noneの場合はCSVの書き出し単位に合わせる）
+        seed: 乱数シード
+    Returns:
+        trial: 生成した試行番号
+    """
+    if chunk_users is None:
+        chunk_users = max(1, CSV_CHUNK_ROWS // (num_steps * num_items))
+    user_rng, item_rng = trial_generators(trial, seed)
+
+    with ExitStack() as stack:
+        if data_format in ("npy", "both"):
+            user_npy, item_npy = create_trial_npy(
+                trial, num_users, num_steps, num_items, data_dir
+            )
+        if data_format in ("csv", "both"):
+            user_csv = stack.enter_context(
+                open(Path(data_dir) / f"user_{trial}.csv", "w", newline="")
             )
+            item_csv = stack.enter_context(
+                open(Path(data_dir) / f"item_{trial}.csv", "w", newline="")
+            )
+            user_csv.write(",".join(USER_CSV_COLUMNS) + "\r\n")
+            item_csv.write(",".join(ITEM_CSV_COLUMNS) + "\r\n")
+
+        for start in range(0, num_users, chunk_users):
+            stop = min(start + chunk_users, num_users)
+            user_states = generate_user_initial_states(user_rng, stop - start)
+            item_scores = generate_items(item_rng, stop - start, num_steps, num_items)
+
+            if data_format in ("npy", "both"):
+                user_npy[start:stop] = user_states
+                item_npy[start:stop] = item_scores
+            if data_format in ("csv", "both"):
+                user_csv.write(format_user_rows(user_states))
+                item_csv.write(format_item_rows(item_scores, start))
+
+        if data_format in ("npy", "both"):
+            user_npy.flush()
+            item_npy.flush()
+
+    return trial
+
+
+def parse_arguments():
+    """コマンドライン引数をパースします"""
+    parser = argparse.ArgumentParser(description="実験データ生成スクリプト")
+    parser.add_argument(
+        "--format",
+        choices=["csv", "npy", "both"],
+        default="both",
+        help="出力形式 (csv: 行単位のCSV, npy: メモリマップ可能な.npy, both: 両方)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="試行を並列に生成するプロセス数 (1の場合は逐次実行)",
+    )
+    parser.add_argument("--trials", type=int, default=TRIAL_NUM, help="試行数")
+    parser.add_argument("--users", type=int, default=USER_NUM, help="ユーザー数")
+    parser.add_argument(
+        "--chunk_users",
+        type=int,
+        default=None,
+        help="1度に生成・書き出すユーザー数 (デフォルト: CSVで約100万行分)",
+    )
+    parser.add_argument("--data_dir", default=DATA_DIR, help="出力ディレクトリ")
+    return parser.parse_args()
+
+
+def main(
+    data_format="both",
+    workers=1,
+    num_trials=TRIAL_NUM,
+    num_users=USER_NUM,
+    data_dir=DATA_DIR,
+    chunk_users=None,
+):
+    # 出力ディレクトリの作成
+    Path(data_dir).mkdir(exist_ok=True)
 
-            # ユーザー×ステップ数分の行を書き込む
-            for u in range(USER_NUM):
-                for s in range(EXPERIMENT_STEPS):
-                    for item_idx in range(ITEM_NUM):
-                        writer.writerow(
-                            [
-                                u,
-                                s,
-                                item_idx,
-                                item_data["ph1_scores"][item_idx][u * s],
-                                item_data["ph2_scores"][item_idx][u * s],
-                                item_data["ph3_scores"][item_idx][u * s],
-                            ]
-                        )
+    generate = partial(
+        generate_trial,
+        data_format=data_format,
+        num_users=num_users,
+        data_dir=data_dir,
+        chunk_users=chunk_users,
+    )
+    # 試行ごとに独立した乱数列を使うため、並列数によらず同じデータになる
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(generate, range(num_trials)))
+    else:
+        for trial in range(num_trials):
+            generate(trial)
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_arguments()
+    main(
+        args.format,
+        args.workers,
+        args.trials,
+        args.users,
+        args.data_dir,
+        args.chunk_users,
+    )
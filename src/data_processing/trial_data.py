@@ -0,0 +1,326 @@
+"""
+試行データのバイナリ形式（.npy）の読み書き
+
+各試行のデータを以下の2ファイルで保持する:
+- `user_{trial}.npy`: shape (users, 2) のint64配列。列は (ph1_counts, steps_since_last_ph1)
+- `item_{trial}.npy`: shape (users, steps, items, 3) のfloat64配列。最後の軸は (ph1, ph2, ph3) スコア
+
+読み込みは `np.load(mmap_mode="r")` によるメモリマップで行い、行ごとのオブジェクトは生成しない。
+CSV形式（`user_{trial}.csv`, `item_{trial}.csv`）との相互変換もこのモジュールで行う。
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from config import TRIAL_NUM  # noqa: E402
+
+DATA_DIR = "data"
+USER_CSV_COLUMNS = ["ph1_counts", "steps_since_last_ph1"]
+ITEM_CSV_COLUMNS = ["user", "step", "item", "ph1_scores", "ph2_scores", "ph3_scores"]
+# CSVの1行の書式（csv.writerと同じく浮動小数点数はrepr、改行は\r\n）
+USER_ROW_FORMAT = "%d,%d\r\n"
+ITEM_ROW_FORMAT = "%d,%d,%d,%r,%r,%r\r\n"
+# CSVを1回に書き出す行数の目安
+CSV_CHUNK_ROWS = 1 << 20
+
+
+def user_npy_path(trial: int, data_dir=DATA_DIR) -> Path:
+    return Path(data_dir) / f"user_{trial}.npy"
+
+
+def item_npy_path(trial: int, data_dir=DATA_DIR) -> Path:
+    return Path(data_dir) / f"item_{trial}.npy"
+
+
+def save_trial_npy(
+    trial: int, user_states: np.ndarray, item_scores: np.ndarray, data_dir=DATA_DIR
+):
+    """
+    1試行分のデータを.npy形式で保存する
+
+    Args:
+        trial: 試行番号
+        user_states: shape (users, 2) のユーザー初期状態
+        item_scores: shape (users, steps, items, 3) のアイテムスコア
+        data_dir: 出力ディレクトリ
+    """
+    Path(data_dir).mkdir(exist_ok=True)
+    np.save(user_npy_path(trial, data_dir), np.asarray(user_states, dtype=np.int64))
+    np.save(item_npy_path(trial, data_dir), np.asarray(item_scores, dtype=np.float64))
+
+
+def create_trial_npy(
+    trial: int, num_users: int, num_steps: int, num_items: int, data_dir=DATA_DIR
+) -> tuple[np.memmap, np.memmap]:
+    """
+    1試行分の.npyファイルを作成し、書き込み用のメモリマップを返す
+
+    全体をメモリに載せずに、ユーザーの範囲ごとに書き込むために使う。
+
+    Args:
+        trial: 試行番号
+        num_users: ユーザー数
+        num_steps: ステップ数
+        num_items: 候補アイテム数
+        data_dir: 出力ディレクトリ
+    Returns:
+        tuple[np.memmap, np.memmap]: shape (users, 2) と shape (users, steps, items, 3) の書き込み先
+    """
+    Path(data_dir).mkdir(exist_ok=True)
+    user_states = np.lib.format.open_memmap(
+        user_npy_path(trial, data_dir),
+        mode="w+",
+        dtype=np.int64,
+        shape=(num_users, 2),
+    )
+    item_scores = np.lib.format.open_memmap(
+        item_npy_path(trial, data_dir),
+        mode="w+",
+        dtype=np.float64,
+        shape=(num_users, num_steps, num_items, 3),
+    )
+    return user_states, item_scores
+
+
+def load_trial_npy(
+    trial: int,
+    num_users: int | None = None,
+    num_steps: int | None = None,
+    num_items: int | None = None,
+    data_dir=DATA_DIR,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    1試行分のデータをメモリマップで読み込む
+
+    戻り値はファイルへの読み取り専用ビューであり、必要な範囲だけがスライスで参照される。
+
+    Args:
+        trial: 試行番号
+        num_users: 使用するユーザー数（Noneの場合は全ユーザー）
+        num_steps: 使用するステップ数（Noneの場合は全ステップ）
+        num_items: 使用する候補アイテム数（Noneの場合は全アイテム）
+        data_dir: データディレクトリ
+    Returns:
+        tuple[np.ndarray, np.ndarray]: ユーザー初期状態とアイテムスコアの配列
+    """
+    user_states = np.load(user_npy_path(trial, data_dir), mmap_mode="r")
+    item_scores = np.load(item_npy_path(trial, data_dir), mmap_mode="r")
+    return (
+        user_states[:num_users],
+        item_scores[:num_users, :num_steps, :num_items],
+    )
+
+
+def read_trial_csv(trial: int, data_dir=DATA_DIR) -> tuple[np.ndarray, np.ndarray]:
+    """
+    CSV形式の試行データを配列に読み込む
+
+    Args:
+        trial: 試行番号
+        data_dir: データディレクトリ
+    Returns:
+        tuple[np.ndarray, np.ndarray]: ユーザー初期状態とアイテムスコアの配列
+    """
+    user_states = np.loadtxt(
+        Path(data_dir) / f"user_{trial}.csv",
+        delimiter=",",
+        skiprows=1,
+        dtype=np.int64,
+        ndmin=2,
+    )
+    rows = np.loadtxt(
+        Path(data_dir) / f"item_{trial}.csv", delimiter=",", skiprows=1, ndmin=2
+    )
+    index = rows[:, :3].astype(np.int64)
+    num_users, num_steps, num_items = index.max(axis=0) + 1
+
+    item_scores = np.zeros((num_users, num_steps, num_items, 3), dtype=np.float64)
+    item_scores[index[:, 0], index[:, 1], index[:, 2]] = rows[:, 3:]
+    return user_states, item_scores
+
+
+def csv_offsets_path(path) -> Path:
+    return Path(f"{path}.offsets.npy")
+
+
+def csv_user_offsets(path, keyed: bool = True) -> np.ndarray:
+    """
+    CSVの各ユーザーの先頭行のバイト位置を求める（シャード分割時に範囲の行へ直接シークするための索引）
+
+    item_{trial}.csvはユーザーIDの昇順に並んでいる（format_item_rowsの出力）ことを前提に、
+    先頭列のIDが変わる行の位置を記録する。keyed=Falseの場合は1行を1ユーザーとする（user_{trial}.csv）。
+    索引は`{path}.offsets.npy`に保存し、CSVのサイズと更新時刻が変わらない間は再利用する。
+
+    Args:
+        path: CSVファイル
+        keyed: 先頭列をユーザーIDとして行をまとめるかどうか
+    Returns:
+        offsets: shape (users + 1,) のバイト位置（ユーザーuの行はoffsets[u]からoffsets[u + 1]の手前まで）
+    """
+    path = Path(path)
+    stat = path.stat()
+    signature = [stat.st_size, stat.st_mtime_ns]
+    cache = csv_offsets_path(path)
+    try:
+        cached = np.load(cache)
+        if cached[:2].tolist() == signature:
+            return cached[2:]
+    except (OSError, ValueError):
+        pass
+
+    offsets = []
+    previous_key = None
+    with open(path, "rb") as f:
+        position = len(f.readline())  # ヘッダ
+        for line in f:
+            if line.strip():
+                if not keyed:
+                    offsets.append(position)
+                else:
+                    key = line[: line.index(b",")]
+                    if key != previous_key:
+                        if int(key) != len(offsets):
+                            raise ValueError(
+                                f"{path}の行がユーザーIDの昇順に並んでいません: {int(key)}"
+                            )
+                        offsets.append(position)
+                        previous_key = key
+            position += len(line)
+    offsets.append(position)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    # 書き出し中の索引を他のプロセスが読まないよう、一時ファイルから置き換える
+    tmp_path = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.concatenate([signature, offsets]))
+        os.replace(tmp_path, cache)
+    except OSError:
+        # データディレクトリに書き込めない場合は保存せずに使う
+        pass
+    return offsets
+
+
+def read_csv_users(path, user_range: range, keyed: bool = True) -> csv.DictReader:
+    """
+    CSVのuser_rangeのユーザーの行だけを読む（csv_user_offsetsの位置へシークし、範囲外の行は読まない）
+
+    Args:
+        path: CSVファイル
+        user_range: 読み込むユーザーIDの範囲
+        keyed: csv_user_offsetsを参照
+    Returns:
+        reader: ヘッダの列名をキーとする行のcsv.DictReader
+    """
+    offsets = csv_user_offsets(path, keyed)
+    num_users = len(offsets) - 1
+    start, stop = min(user_range.start, num_users), min(user_range.stop, num_users)
+    with open(path, "rb") as f:
+        header = f.readline()
+        f.seek(offsets[start])
+        rows = f.read(offsets[stop] - offsets[start])
+    return csv.DictReader(io.StringIO((header + rows).decode("utf-8"), newline=""))
+
+
+def format_user_rows(user_states: np.ndarray) -> str:
+    """
+    ユーザー初期状態をCSVの行にまとめて変換する
+
+    Args:
+        user_states: shape (users, 2) のユーザー初期状態
+    Returns:
+        rows: ヘッダを除くCSVの文字列
+    """
+    values = np.asarray(user_states).ravel().tolist()
+    return (USER_ROW_FORMAT * (len(values) // 2)) % tuple(values)
+
+
+def format_item_rows(item_scores: np.ndarray, first_user: int = 0) -> str:
+    """
+    アイテムスコアをCSVの行にまとめて変換する
+
+    行は (user, step, item) の順に並び、csv.writerで1行ずつ書き出した場合と同じ文字列になる。
+
+    Args:
+        item_scores: shape (users, steps, items, 3) のアイテムスコア
+        first_user: 先頭のユーザーID
+    Returns:
+        rows: ヘッダを除くCSVの文字列
+    """
+    num_users, num_steps, num_items = item_scores.shape[:3]
+    index = np.indices((num_users, num_steps, num_items)).reshape(3, -1).T
+    index[:, 0] += first_user
+    # 整数・浮動小数点数をPythonのオブジェクトとして1つの書式でまとめて変換する
+    rows = np.empty((index.shape[0], 6), dtype=object)
+    rows[:, :3] = index
+    rows[:, 3:] = np.asarray(item_scores).reshape(-1, 3)
+    return (ITEM_ROW_FORMAT * rows.shape[0]) % tuple(rows.ravel().tolist())
+
+
+def write_trial_csv(
+    trial: int, user_states: np.ndarray, item_scores: np.ndarray, data_dir=DATA_DIR
+):
+    """
+    配列形式の試行データをCSV形式で書き出す
+
+    Args:
+        trial: 試行番号
+        user_states: shape (users, 2) のユーザー初期状態
+        item_scores: shape (users, steps, items, 3) のアイテムスコア
+        data_dir: 出力ディレクトリ
+    """
+    Path(data_dir).mkdir(exist_ok=True)
+    with open(Path(data_dir) / f"user_{trial}.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(USER_CSV_COLUMNS)
+        f.write(format_user_rows(user_states))
+
+    num_users, num_steps, num_items = item_scores.shape[:3]
+    chunk_users = max(1, CSV_CHUNK_ROWS // (num_steps * num_items))
+    with open(Path(data_dir) / f"item_{trial}.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(ITEM_CSV_COLUMNS)
+        for start in range(0, num_users, chunk_users):
+            chunk = item_scores[start : start + chunk_users]
+            f.write(format_item_rows(chunk, start))
+
+
+def parse_arguments():
+    """コマンドライン引数をパースします"""
+    parser = argparse.ArgumentParser(description="試行データの形式変換スクリプト")
+    parser.add_argument(
+        "--to",
+        choices=["npy", "csv"],
+        default="npy",
+        help="変換先の形式 (npy: CSVから.npyへ, csv: .npyからCSVへ)",
+    )
+    parser.add_argument("--data_dir", default=DATA_DIR, help="データディレクトリ")
+    parser.add_argument("--trials", type=int, default=TRIAL_NUM, help="変換する試行数")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    for trial in range(args.trials):
+        if args.to == "npy":
+            user_states, item_scores = read_trial_csv(trial, args.data_dir)
+            save_trial_npy(trial, user_states, item_scores, args.data_dir)
+        else:
+            user_states, item_scores = load_trial_npy(trial, data_dir=args.data_dir)
+            write_trial_csv(trial, user_states, item_scores, args.data_dir)
+
+
+if __name__ == "__main__":
+    main()
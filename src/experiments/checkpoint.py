@@ -0,0 +1,152 @@
+"""
+試行単位のチェックポイント
+
+実験の各試行が終わるたびに、設定ごとの試行結果を
+`{checkpoint_dir}/{config_hash}/trial_{trial}.json` に保存する。
+config_hashは実験結果に影響する設定（config.pyの値、ユーザ状態スコアのパラメータ、
+λ、減衰フラグ、エンジン、データ形式、成否判定の乱数、ランキング方策）から計算するため、設定を変えた実行の結果が混ざることはない。
+ユーザーをシャードに分割した場合、逐次の乱数列（sequential）ではシャードサイズによって結果が変わるため、シャードサイズもハッシュに含める。
+TRIAL_NUMはハッシュに含めないため、試行回数を増やした場合も既存の試行を再利用できる。
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+import config  # noqa: E402
+from experiments.policies import PROPOSED, config_policy  # noqa: E402
+from utils.utils import UserStateScoreParams  # noqa: E402
+
+
+def effective_config(
+    lambda_val: float,
+    decay_flag: bool,
+    engine: str,
+    data_format: str,
+    outcome_rng: str = "sequential",
+    policy: str = PROPOSED,
+    shard_size: int | None = None,
+) -> dict:
+    """
+    実験結果に影響する設定の一覧を返す
+
+    Args:
+        lambda_val: 将来マッチング重視パラメータλ
+        decay_flag: 減衰フラグ
+        engine: 実験エンジン
+        data_format: 試行データの形式
+        outcome_rng: 成否判定の乱数
+        policy: λ≠0の場合に使うランキング方策（λ=0の場合はbaselineとして記録する）
+        shard_size: 1シャードのユーザー数（Noneの場合は分割しない）
+    Returns:
+        settings: 設定名と値の辞書
+    """
+    settings = {
+        "USER_NUM": config.USER_NUM,
+        "ITEM_NUM": config.ITEM_NUM,
+        "TOP_K": config.TOP_K,
+        "EXPERIMENT_STEPS": config.EXPERIMENT_STEPS,
+        "RANDOM_SEED": config.RANDOM_SEED,
+        "USER_STATE_POWER": config.USER_STATE_POWER,
+        "SCORE_ADJUSTMENT": dict(config.ModelConfig.SCORE_ADJUSTMENT),
+        "MAX_PH1_COUNT": UserStateScoreParams.MAX_PH1_COUNT,
+        "MAX_STEPS": UserStateScoreParams.MAX_STEPS,
+        "BASE_SCORE": UserStateScoreParams.BASE_SCORE,
+        "MAX_SCORE_MULTIPLIER": UserStateScoreParams.MAX_SCORE_MULTIPLIER,
+        "DECAY_RATE": UserStateScoreParams.DECAY_RATE,
+        "lambda": lambda_val,
+        "decay_flag": decay_flag,
+        "engine": engine,
+        "data_format": data_format,
+        "outcome_rng": outcome_rng,
+        "policy": config_policy(policy, lambda_val),
+    }
+    # 共通乱数は (user, step, slot) ごとに固定のため、シャードに分割しても結果は変わらない
+    if shard_size is not None and outcome_rng == "sequential":
+        settings["shard_size"] = shard_size
+    return settings
+
+
+def config_hash(
+    lambda_val: float,
+    decay_flag: bool,
+    engine: str,
+    data_format: str,
+    outcome_rng: str = "sequential",
+    policy: str = PROPOSED,
+    shard_size: int | None = None,
+) -> str:
+    """effective_configのハッシュ値（16桁の16進数）を返す"""
+    settings = effective_config(
+        lambda_val, decay_flag, engine, data_format, outcome_rng, policy, shard_size
+    )
+    encoded = json.dumps(settings, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def checkpoint_path(checkpoint_dir: str, hash_value: str, trial: int) -> str:
+    return os.path.join(checkpoint_dir, hash_value, f"trial_{trial:05d}.json")
+
+
+def _write_json(path: str, data: dict):
+    """一時ファイルに書き込んでから置き換え、中断されても不完全なファイルが残らないようにする"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint(
+    checkpoint_dir: str,
+    hash_value: str,
+    trial: int,
+    record: dict,
+    settings: dict | None = None,
+):
+    """
+    1試行・1設定分の結果を保存する
+
+    Args:
+        checkpoint_dir: チェックポイントの保存先
+        hash_value: config_hashの値
+        trial: 試行番号
+        record: results, step_counts, execution_time, profileを持つ試行結果
+        settings: ハッシュの元になった設定（初回のみconfig.jsonとして保存する）
+    """
+    config_file = os.path.join(checkpoint_dir, hash_value, "config.json")
+    if settings is not None and not os.path.exists(config_file):
+        _write_json(config_file, settings)
+
+    _write_json(
+        checkpoint_path(checkpoint_dir, hash_value, trial),
+        {**record, "step_counts": np.asarray(record["step_counts"]).tolist()},
+    )
+
+
+def load_checkpoint(checkpoint_dir: str, hash_value: str, trial: int) -> dict | None:
+    """
+    保存済みの試行結果を読み込む
+
+    Returns:
+        record: save_checkpointで保存した試行結果（未完了の場合はNone）
+    """
+    path = checkpoint_path(checkpoint_dir, hash_value, trial)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            record = json.load(f)
+    except json.JSONDecodeError:
+        return None
+    record["step_counts"] = np.array(record["step_counts"], dtype=np.int32)
+    return record
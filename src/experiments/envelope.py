@@ -0,0 +1,288 @@
+"""
+提案スコアの上側包絡線インデックス
+
+提案スコア base + λ·ph1·Δ は、(user, step) の候補集合を固定すると c = λ·Δ の1変数について
+各アイテムを直線 base_i + c·ph1_i とみなせる。任意のcにおける上位アイテムは直線群の上側包絡線上にあり、
+上位k件は包絡線を外側から順にはがしたk層までのいずれかの層に含まれる。
+
+EnvelopeIndexは (user, step) ごとにk層の包絡線（傾き順の直線と、隣接する直線の交点）を事前計算しておく。
+ランキング時は各層で交点を二分探索し、探索位置の前後k本だけを元のスコア式で再計算して上位k件を選ぶため、
+候補数（ITEM_NUM）に依存せず、λやユーザ状態が変わっても同じインデックスを使える。
+再計算はrank_itemsと同じ式・同じ同点の扱い（若いインデックス優先）で行うため、結果はrank_itemsと一致する。
+"""
+
+import os
+import sys
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from config import TOP_K, ModelConfig  # noqa: E402
+from models.models import ItemBatch  # noqa: E402
+
+
+def _upper_envelopes(
+    slopes: np.ndarray, intercepts: np.ndarray, positions: np.ndarray, counts
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    各行の直線から上側包絡線を求める（全行のスタックを同時に更新する）
+
+    各行の直線は傾きの昇順（同じ傾きは切片の降順・インデックスの昇順）に並べておく。
+    3本が1点で交わる場合、中央の直線はその点で同点の上位となるため包絡線に残す。
+
+    Args:
+        slopes: shape (rows, items) の傾き
+        intercepts: shape (rows, items) の切片
+        positions: shape (rows, m) の各行で調べる直線の位置（昇順。各行の先頭counts個が有効）
+        counts: shape (rows,) の各行の直線数
+    Returns:
+        tuple[np.ndarray, np.ndarray]:
+            shape (rows, m) の包絡線を構成する直線の位置（傾きの昇順）と、shape (rows,) の各行の直線数
+    """
+    rows = np.arange(len(counts))
+    hull = np.zeros_like(positions)
+    sizes = np.zeros(len(counts), dtype=np.intp)
+    for column in range(positions.shape[1]):
+        position = positions[:, column]
+        a3, b3 = slopes[rows, position], intercepts[rows, position]
+        last = hull[rows, np.maximum(sizes - 1, 0)]
+        active = (column < counts) & ~((sizes > 0) & (slopes[rows, last] == a3))
+        while True:
+            p1 = hull[rows, np.maximum(sizes - 2, 0)]
+            p2 = hull[rows, np.maximum(sizes - 1, 0)]
+            a1, b1 = slopes[rows, p1], intercepts[rows, p1]
+            a2, b2 = slopes[rows, p2], intercepts[rows, p2]
+            # 直線1・3の交点が直線1・2の交点より左にあれば、直線2が上位になるcは存在しない
+            pop = (
+                active & (sizes >= 2) & ((b1 - b3) * (a2 - a1) < (b1 - b2) * (a3 - a1))
+            )
+            if not pop.any():
+                break
+            sizes -= pop
+        hull[rows[active], sizes[active]] = position[active]
+        sizes += active
+    return hull, sizes
+
+
+def _dense_ranks(sorted_values: np.ndarray, order: np.ndarray) -> np.ndarray:
+    """
+    各行の値の順位（同じ値は同じ順位）を求める
+
+    Args:
+        sorted_values: shape (rows, n) の各行を昇順に並べた値
+        order: shape (rows, n) の並べ替えに使ったインデックス（sorted_values[r] = values[r, order[r]]）
+    Returns:
+        ranks: shape (rows, n) の元の位置ごとの順位
+    """
+    dense = np.zeros(order.shape, dtype=np.int64)
+    dense[:, 1:] = np.cumsum(sorted_values[:, 1:] != sorted_values[:, :-1], axis=1)
+    ranks = np.empty_like(dense)
+    np.put_along_axis(ranks, order, dense, axis=1)
+    return ranks
+
+
+class EnvelopeIndex:
+    """
+    (user, step) ごとのk層の上側包絡線
+
+    Attributes:
+        items (np.ndarray): shape (users, steps, layers, width) の包絡線の直線（アイテム）。空きは-1
+        breaks (np.ndarray): shape (users, steps, layers, width - 1) の隣接する直線の交点のc。空きはinf
+        sizes (np.ndarray): shape (users, steps, layers) の各層の直線数
+    """
+
+    def __init__(self, items: np.ndarray, breaks: np.ndarray, sizes: np.ndarray):
+        self.items = items
+        self.breaks = breaks
+        self.sizes = sizes
+
+    @property
+    def num_layers(self) -> int:
+        return self.items.shape[2]
+
+    @classmethod
+    def build(cls, item_scores: np.ndarray, top_k: int = TOP_K) -> "EnvelopeIndex":
+        """
+        全 (user, step) のインデックスを作成する
+
+        Args:
+            item_scores: shape (users, steps, items, 3) のph1~3スコア
+            top_k: 推薦するアイテム数（包絡線の層数）
+        Returns:
+            index: EnvelopeIndex
+        """
+        num_users, num_steps, num_items = item_scores.shape[:3]
+        flat_scores = np.asarray(item_scores, dtype=np.float64).reshape(
+            -1, num_items, 3
+        )
+        batch = ItemBatch.from_scores(flat_scores)
+        slopes = batch.ph1_score
+        intercepts = ModelConfig.baseline_score(batch).astype(np.float64)
+        num_rows = flat_scores.shape[0]
+        num_layers = min(top_k, num_items)
+
+        # 傾きの昇順、同じ傾きは切片の降順・インデックスの昇順
+        # （np.lexsortは遅いため、傾きだけで並べ替え、傾きが重複する行は3つのキーの順位を
+        # 1つの整数にまとめて並べ直す。順位は0~num_items-1のため、num_items < 2·10^6 で桁あふれしない）
+        order = np.argsort(slopes, axis=1)
+        sorted_slopes = np.take_along_axis(slopes, order, axis=1)
+        tied = np.flatnonzero(
+            (sorted_slopes[:, 1:] == sorted_slopes[:, :-1]).any(axis=1)
+        )
+        if len(tied):
+            slope_ranks = _dense_ranks(sorted_slopes[tied], order[tied])
+            negated = -intercepts[tied]
+            intercept_order = np.argsort(negated, axis=1)
+            intercept_ranks = _dense_ranks(
+                np.take_along_axis(negated, intercept_order, axis=1), intercept_order
+            )
+            keys = (slope_ranks * num_items + intercept_ranks) * num_items + np.arange(
+                num_items
+            )
+            order[tied] = np.argsort(keys, axis=1)
+            sorted_slopes[tied] = np.take_along_axis(slopes[tied], order[tied], axis=1)
+        sorted_intercepts = np.take_along_axis(intercepts, order, axis=1)
+
+        remaining = np.ones((num_rows, num_items), dtype=bool)
+        layers = []
+        for _ in range(num_layers):
+            # 上側凸包の頂点は、傾きが小さい側または大きい側の全ての点より切片が大きい（階段状の点）
+            b = np.where(remaining, sorted_intercepts, -np.inf)
+            before = np.maximum.accumulate(b, axis=1)
+            before = np.concatenate(
+                [np.full((num_rows, 1), -np.inf), before[:, :-1]], axis=1
+            )
+            after = np.maximum.accumulate(b[:, ::-1], axis=1)[:, ::-1]
+            after = np.concatenate(
+                [after[:, 1:], np.full((num_rows, 1), -np.inf)], axis=1
+            )
+            staircase = remaining & ((b >= before) | (b >= after))
+
+            # 階段状の点を行ごとに左詰めにする
+            counts = np.count_nonzero(staircase, axis=1)
+            point_rows, point_positions = np.nonzero(staircase)
+            columns = np.arange(len(point_rows)) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            positions = np.zeros((num_rows, max(counts.max(), 1)), dtype=np.intp)
+            positions[point_rows, columns] = point_positions
+
+            hull, sizes = _upper_envelopes(
+                sorted_slopes, sorted_intercepts, positions, counts
+            )
+            in_hull = np.arange(hull.shape[1]) < sizes[:, None]
+            hull_rows, hull_columns = np.nonzero(in_hull)
+            remaining[hull_rows, hull[hull_rows, hull_columns]] = False
+            layers.append((hull, sizes, in_hull))
+
+        width = max(int(sizes.max()) for _, sizes, _ in layers)
+        items = np.full((num_rows, num_layers, width), -1, dtype=np.int32)
+        breaks = np.full((num_rows, num_layers, max(width - 1, 0)), np.inf)
+        layer_sizes = np.zeros((num_rows, num_layers), dtype=np.int32)
+        for layer_idx, (hull, sizes, in_hull) in enumerate(layers):
+            hull, in_hull = hull[:, :width], in_hull[:, :width]
+            layer_sizes[:, layer_idx] = sizes
+            items[:, layer_idx, : hull.shape[1]] = np.where(
+                in_hull, np.take_along_axis(order, hull, axis=1), -1
+            )
+            if hull.shape[1] < 2:
+                continue
+            a = np.take_along_axis(sorted_slopes, hull, axis=1)
+            b = np.take_along_axis(sorted_intercepts, hull, axis=1)
+            # 隣接する直線の交点（これより小さいcでは傾きが小さい直線が上位）
+            with np.errstate(divide="ignore", invalid="ignore"):
+                layer_breaks = (b[:, :-1] - b[:, 1:]) / (a[:, 1:] - a[:, :-1])
+            breaks[:, layer_idx, : hull.shape[1] - 1] = np.where(
+                in_hull[:, 1:], layer_breaks, np.inf
+            )
+
+        shape = (num_users, num_steps, num_layers)
+        return cls(
+            items.reshape(shape + (width,)),
+            breaks.reshape(shape + (max(width - 1, 0),)),
+            layer_sizes.reshape(shape),
+        )
+
+    def candidates(
+        self, users: np.ndarray, step: int, c: np.ndarray, window: int
+    ) -> np.ndarray:
+        """
+        各層で交点を二分探索し、cにおける包絡線上の直線と前後window本を候補として返す
+
+        Args:
+            users: shape (n,) のユーザID
+            step: ステップ
+            c: shape (n,) のλ·Δ
+            window: 探索位置の前後に含める直線の数
+        Returns:
+            candidates: shape (n, layers * (2 * window + 1)) のアイテムインデックス（候補でない要素は-1）
+        """
+        items = self.items[users, step]  # (n, layers, width)
+        breaks = self.breaks[users, step]  # (n, layers, width - 1)
+        sizes = self.sizes[users, step]  # (n, layers)
+        c = np.asarray(c, dtype=np.float64)[:, None]
+
+        # position: c より小さい交点の数（交点はinfで埋めてあり、各行で昇順）
+        num_breaks = breaks.shape[2]
+        position = np.zeros(sizes.shape, dtype=np.intp)
+        bit = 1 << max(num_breaks.bit_length() - 1, 0)
+        while num_breaks and bit:
+            probe = position + bit
+            inside = probe <= num_breaks
+            probe_breaks = np.take_along_axis(
+                breaks, np.minimum(probe, num_breaks)[..., None] - 1, axis=2
+            )[..., 0]
+            position = np.where(inside & (probe_breaks < c), probe, position)
+            bit >>= 1
+
+        offsets = np.arange(-window, window + 1)
+        slots = position[..., None] + offsets  # (n, layers, 2 * window + 1)
+        valid = (slots >= 0) & (slots < sizes[..., None])
+        slots = np.clip(slots, 0, items.shape[2] - 1)
+        candidates = np.where(valid, np.take_along_axis(items, slots, axis=2), -1)
+        return candidates.reshape(len(users), -1)
+
+    def rank(
+        self,
+        step_items: np.ndarray,
+        users: np.ndarray,
+        step: int,
+        deltas: np.ndarray,
+        lambda_val: float,
+        top_k: int = TOP_K,
+    ) -> tuple[np.ndarray, int]:
+        """
+        rank_itemsと同じ上位top_k件を、包絡線上の候補だけを再計算して求める
+
+        Args:
+            step_items: shape (n, items, 3) の各ユーザのこのステップの候補アイテムのph1~3スコア
+            users: shape (n,) のユーザID（インデックス作成時の行）
+            step: ステップ（インデックス作成時のステップ）
+            deltas: shape (n,) のユーザ状態スコアの変化量
+            lambda_val: 将来マッチング重視パラメータλ
+            top_k: 推薦するアイテム数（num_layers以下）
+        Returns:
+            tuple[np.ndarray, int]:
+                shape (n, top_k) のアイテムインデックス（スコア降順）と、スコアを再計算した候補数
+        """
+        # 交点付近の丸め誤差と同点を考慮し、前後top_k本を再計算する
+        candidates = self.candidates(users, step, lambda_val * deltas, window=top_k)
+        valid = candidates >= 0
+        chosen = np.take_along_axis(
+            step_items, np.maximum(candidates, 0)[..., None], axis=1
+        )
+        scores = ModelConfig.proposed_score(
+            ItemBatch.from_scores(chosen), deltas[:, None], lambda_val
+        )
+        scores = np.where(valid, scores, -np.inf)
+        # スコアの降順、同点はアイテムインデックスの昇順（候補でない要素は末尾）
+        tie_break = np.where(valid, candidates, np.iinfo(np.int32).max)
+        order = np.lexsort((tie_break, -scores), axis=-1)
+        num_ranked = min(top_k, step_items.shape[1])
+        top_k_indices = np.take_along_axis(candidates, order[:, :num_ranked], axis=1)
+        return top_k_indices, int(np.count_nonzero(valid))
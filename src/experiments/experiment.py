@@ -5,16 +5,22 @@ import argparse
 import logging
 import os
 import time
+import tracemalloc
+from time import perf_counter
 import random
 import json
 import numpy as np
 from datetime import datetime
 import sys
 import csv
+from contextlib import nullcontext
+from dataclasses import replace
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 from utils.utils import (
-    calculate_user_state_score,
-    get_user_state_score_delta,
+    calculate_metrics,
+    get_phase_multipliers,
 )
 
 from config import (
@@ -26,10 +32,47 @@ from config import (
     RANDOM_SEED,
     RESULTS_DIR,
     LOGS_DIR,
-    ModelConfig,
 )
 
 from models.models import User, Item
+from utils.profiling import StageProfile
+from utils.results_store import RESULTS_DB, ResultsStore
+from utils.running_stats import RunningStats, relative_width
+from experiments.tracing import TraceSink, TraceWriter, clear_trace_dirs
+from experiments.checkpoint import (
+    config_hash,
+    effective_config,
+    load_checkpoint,
+    save_checkpoint,
+)
+from experiments.envelope import EnvelopeIndex
+from experiments.policies import (
+    BASELINE,
+    POLICIES,
+    PROPOSED,
+    BaselinePolicy,
+    RankingPolicy,
+    config_policy,
+    get_policy,
+    load_policy_modules,
+)
+from experiments.sharding import (
+    MEMORY_SAMPLE_USERS,
+    estimate_user_bytes,
+    merge_shard_records,
+    peak_rss_mb,
+    shard_ranges,
+    shard_seed,
+    shard_size_for_memory,
+)
+from experiments.vectorized import (
+    simulate_trial,
+    rank_baseline,
+    to_arrays,
+    from_arrays,
+)
+from data_processing.trial_data import load_trial_npy, read_csv_users
+from data_processing.counter_rng import OutcomeUniforms, load_trial_generated
 
 # このファイルのディレクトリの親（src）をパスに追加
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -37,6 +80,8 @@ src_dir = os.path.abspath(os.path.join(current_dir, ".."))
 if src_dir not in sys.path:
     sys.path.insert(0, src_dir)
 
+PHASES = ["ph1", "ph2", "ph3"]
+
 
 def setup_logger():
     """ロギング設定を行います"""
@@ -54,172 +99,1182 @@ def setup_logger():
     return logging.getLogger(__name__)
 
 
-def load_data(trial: int) -> tuple[list[User], list[Item]]:
+def _csv_rows(path: str, user_range: range | None, keyed: bool = True):
+    """
+    CSVの行を番号とともに順に返す（user_rangeを指定した場合はread_csv_usersでその範囲の行だけを読む）
+
+    Args:
+        path: CSVファイル
+        user_range: 読み込むユーザーIDの範囲（Noneの場合はファイル全体）
+        keyed: read_csv_usersに渡す
+    """
+    if user_range is not None:
+        yield from enumerate(read_csv_users(path, user_range, keyed))
+        return
+    with open(path, "r") as f:
+        yield from enumerate(csv.DictReader(f))
+
+
+def load_data(
+    trial: int, user_range: range | None = None
+) -> tuple[list[User], list[Item]]:
     """
     実験用のユーザーデータとアイテムデータを読み込む
 
+    user_rangeを指定した場合は、その範囲のユーザーの行だけを読み込み、ユーザーIDを範囲の先頭からの番号に付け替える。
+    範囲の行はユーザーごとの先頭行のバイト位置の索引（trial_data.csv_user_offsets、初回に作成して保存）から
+    直接読むため、シャードごとにファイルの先頭から読み直さない。
+
     Args:
         trial: 実験試行回数
+        user_range: 読み込むユーザーIDの範囲（Noneの場合は先頭のUSER_NUM人）
     Returns:
         tuple[list[User], list[Item]]: ユーザーリストとアイテムデータのリスト
     """
-    # ユーザーデータの読み込み
+    first_user = 0 if user_range is None else user_range.start
     user_file = os.path.join("data", f"user_{trial}.csv")
-    users = []
+    item_file = os.path.join("data", f"item_{trial}.csv")
 
-    with open(user_file, "r") as f:
-        reader = csv.DictReader(f)
-        for i, row in enumerate(reader):
-            if i >= USER_NUM:  # ユーザー数に達したら終了
-                break
-            user = User(
-                id=i,
-                ph1_count=int(row["ph1_counts"]),
-                last_ph1_step=int(row["steps_since_last_ph1"]),
-                finished=False,
-            )
-            users.append(user)
+    # ユーザーデータの読み込み
+    users = []
+    for i, row in _csv_rows(user_file, user_range, keyed=False):
+        if i >= USER_NUM:  # ユーザー数に達したら終了
+            break
+        user = User(
+            id=i,
+            ph1_count=int(row["ph1_counts"]),
+            last_ph1_step=int(row["steps_since_last_ph1"]),
+            finished=False,
+        )
+        users.append(user)
 
     # アイテムデータの読み込み
-    item_file = os.path.join("data", f"item_{trial}.csv")
     items = []
+    for _, row in _csv_rows(item_file, user_range):
+        user_id = int(row["user"]) - first_user
+        step = int(row["step"])
+        item_id = int(row["item"])
 
-    with open(item_file, "r") as f:
-        reader = csv.DictReader(f)
-
-        for row in reader:
-            user_id = int(row["user"])
-            step = int(row["step"])
-            item_id = int(row["item"])
-
-            if item_id < ITEM_NUM:
-                item = Item(
-                    user=user_id,
-                    step=step,
-                    item=item_id,
-                    ph1_score=float(row["ph1_scores"]),
-                    ph2_score=float(row["ph2_scores"]),
-                    ph3_score=float(row["ph3_scores"]),
-                )
-                items.append(item)
+        if item_id < ITEM_NUM:
+            item = Item(
+                user=user_id,
+                step=step,
+                item=item_id,
+                ph1_score=float(row["ph1_scores"]),
+                ph2_score=float(row["ph2_scores"]),
+                ph3_score=float(row["ph3_scores"]),
+            )
+            items.append(item)
 
     return users, items
 
 
-def run_experiment(lambda_val: float, decay_flag: bool):
-    """指定されたλ値で実験を実行します"""
-    logger = logging.getLogger(__name__)
-    logger.info(f"実験を開始します: λ = {lambda_val}, 減衰フラグ = {decay_flag}")
+def load_trial_arrays(
+    trial: int, data_format: str = "csv", user_range: range | None = None
+):
+    """
+    実験用のデータを配列形式で読み込む
 
-    start_time = time.time()
+    Args:
+        trial: 実験試行回数
+        data_format: データ形式。"csv", "npy"（メモリマップで読み込む）,
+            "generated"（ファイルを使わずカウンタベース乱数で必要な候補だけ生成する）
+        user_range: 読み込むユーザーIDの範囲（Noneの場合は先頭のUSER_NUM人）
+    Returns:
+        tuple[np.ndarray, np.ndarray]:
+            shape (users, 2) のユーザー初期状態とshape (users, steps, items, 3) のアイテムスコア
+    """
+    if data_format == "npy":
+        user_states, item_scores = load_trial_npy(
+            trial, USER_NUM, EXPERIMENT_STEPS, ITEM_NUM
+        )
+        if user_range is not None:
+            # メモリマップのスライスのため、範囲外のユーザーのデータは読まれない
+            user_states = user_states[user_range.start : user_range.stop]
+            item_scores = item_scores[user_range.start : user_range.stop]
+        return user_states, item_scores
+    if data_format == "generated":
+        if user_range is None:
+            return load_trial_generated(trial, USER_NUM, EXPERIMENT_STEPS, ITEM_NUM)
+        return load_trial_generated(
+            trial,
+            len(user_range),
+            EXPERIMENT_STEPS,
+            ITEM_NUM,
+            first_user=user_range.start,
+        )
 
-    all_results = {"lambda": lambda_val, "trials": []}
+    users, items = load_data(trial, user_range)
+    return to_arrays(users, items, EXPERIMENT_STEPS, ITEM_NUM)
 
-    for trial in range(TRIAL_NUM):
-        logger.info(f"試行 {trial + 1}/{TRIAL_NUM} を開始")
 
-        # 試行ごとに固定の乱数シードを設定
-        trial_seed = RANDOM_SEED + trial
-        random.seed(trial_seed)
-        np.random.seed(trial_seed)
+def group_items(items: list[Item]) -> dict:
+    """
+    itemsをユーザーとステップでグループ化した辞書を作成します
 
-        # ユーザーとアイテムデータを読み込む
-        users, items = load_data(trial)
-
-        # 各フェーズの成功回数を記録
-        trial_results = {"ph1": 0, "ph2": 0, "ph3": 0}
-
-        # 最初にitemsをユーザーとステップでグループ化した辞書を作成
-        items_dict = {}
-        for item in items:
-            key = (item.user, item.step)
-            if key not in items_dict:
-                items_dict[key] = []
-            items_dict[key].append(item)
-
-        # 実験ステップのループ
-        for step in range(EXPERIMENT_STEPS):
-            # 各ユーザーの処理
-            step_score = {"ph1": 0, "ph2": 0, "ph3": 0}
-            for user in users:
-                if user.finished:
-                    continue
-
-                # λ=0の場合はbaselineスコア、それ以外はproposedスコアを使用
-                if lambda_val == 0:
-                    # 辞書から直接ユーザーとステップに関連するアイテムを取得
-                    user_items = items_dict.get((user.id, step), [])
-                    sorted_items = sorted(
-                        user_items,
-                        key=ModelConfig.baseline_score,
-                        reverse=True,
-                    )
+    Args:
+        items: アイテムデータのリスト
+    Returns:
+        items_dict: (user, step) をキーとする候補アイテムのリスト
+    """
+    items_dict = {}
+    for item in items:
+        key = (item.user, item.step)
+        if key not in items_dict:
+            items_dict[key] = []
+        items_dict[key].append(item)
+    return items_dict
+
+
+def rank_baseline_items(items_dict: dict) -> dict:
+    """
+    baselineスコアによる各 (user, step) の上位TOP_K件を計算します
+
+    baselineスコアはユーザー状態に依存しないため、λ=0の設定間（減衰フラグ違いなど）で共有できます。
+
+    Args:
+        items_dict: (user, step) をキーとする候補アイテムのリスト
+    Returns:
+        baseline_rankings: (user, step) をキーとする上位TOP_K件のアイテム
+    """
+    policy = get_policy(BASELINE)
+    return {
+        key: policy.rank_user(user_items, None, None, 0, TOP_K)
+        for key, user_items in items_dict.items()
+    }
+
+
+def release_user_items(user_id: int, from_step: int, items_dict: dict):
+    """終了したユーザーのfrom_step以降の候補アイテムを削除します"""
+    for step in range(from_step, EXPERIMENT_STEPS):
+        items_dict.pop((user_id, step), None)
+
+
+def run_trial_loop(
+    users: list[User],
+    items_dict: dict,
+    lambda_val: float,
+    decay_flag: bool,
+    baseline_rankings: dict | None = None,
+    release_finished: bool = False,
+    profile: StageProfile | None = None,
+    uniforms: list | None = None,
+    policy: RankingPolicy | None = None,
+    trace: TraceWriter | None = None,
+) -> tuple[dict, np.ndarray]:
+    """
+    1試行分の実験をPythonループで実行します（参照実装）
+
+    Args:
+        users: ユーザーリスト（状態は実験中に更新されます）
+        items_dict: (user, step) をキーとする候補アイテムのリスト
+        lambda_val: 将来マッチング重視パラメータλ
+        decay_flag: 減衰フラグ
+        baseline_rankings: rank_baseline_itemsの結果（λ=0の場合に再利用）
+        release_finished: 終了したユーザーの以降のステップの候補をitems_dictから削除するかどうか
+            （items_dictを他の設定と共有していない場合のみTrueにする）
+        profile: 処理段階ごとの時間とカウンタの記録先（Noneの場合は計測しない）
+        uniforms: OutcomeUniforms.tableの結果のリスト。指定した場合、randomの代わりに
+            uniforms[user][step][slot][phase] の共通乱数で成否を判定する
+        policy: ランキング方策（Noneの場合はλ=0ならbaseline、それ以外はproposed）
+        trace: 推薦イベントの記録先（Noneの場合は記録しない）
+    Returns:
+        tuple[dict, np.ndarray]:
+            各フェーズの成功回数と、shape (steps, 3) のステップごとのph1~3成功回数
+    """
+    # 各フェーズの成功回数を記録
+    trial_results = {"ph1": 0, "ph2": 0, "ph3": 0}
+    step_counts = np.zeros((EXPERIMENT_STEPS, 3), dtype=np.int32)
+
+    # 計測用（profilingがFalseの場合は分岐のみ）
+    profiling = profile is not None
+    delta_time = ranking_time = sampling_time = aggregation_time = 0.0
+    candidates_scored = users_skipped = recommendations = 0
+
+    if policy is None:
+        policy = get_policy(config_policy(PROPOSED, lambda_val))
+    use_baseline_rankings = (
+        isinstance(policy, BaselinePolicy) and baseline_rankings is not None
+    )
+
+    # 未終了のユーザーのみを保持し、ステップごとの処理量を残りのユーザー数に比例させる
+    active_users = [user for user in users if not user.finished]
+
+    # 実験ステップのループ
+    for step in range(EXPERIMENT_STEPS):
+        if profiling:
+            users_skipped += len(users) - len(active_users)
+        if not active_users:
+            if profiling:
+                users_skipped += (EXPERIMENT_STEPS - step - 1) * len(users)
+            break
+
+        # 各ユーザーの処理
+        step_score = {"ph1": 0, "ph2": 0, "ph3": 0}
+        for user in active_users:
+            if profiling:
+                t0 = perf_counter()
+
+            # baselineは事前計算したランキングを再利用し、それ以外は方策でランキングする
+            if use_baseline_rankings:
+                sorted_items = baseline_rankings.get((user.id, step), [])
+            else:
+                features = policy.user_features(user)
+                if profiling:
+                    t1 = perf_counter()
+                    delta_time += t1 - t0
+                    t0 = t1
+                # 辞書から直接ユーザーとステップに関連するアイテムを取得
+                user_items = items_dict.get((user.id, step), [])
+                sorted_items = policy.rank_user(
+                    user_items, user, features, lambda_val, TOP_K
+                )
+                if profiling:
+                    candidates_scored += len(user_items)
+
+            top_k_items = sorted_items[:TOP_K]
+            if profiling:
+                t1 = perf_counter()
+                ranking_time += t1 - t0
+                t0 = t1
+                recommendations += len(top_k_items)
+
+            for slot, item in enumerate(top_k_items):
+                # 共通乱数の場合はph1, ph2, ph3の順に (user, step, slot) の乱数を取り出す
+                if uniforms is None:
+                    draw = random.random
                 else:
-                    delta = get_user_state_score_delta(
+                    draw = iter(uniforms[user.id][step][slot]).__next__
+                if trace is not None:
+                    # 推薦時点のユーザ状態と、成否を判定する前の成功回数
+                    state = (user.ph1_count, user.last_ph1_step)
+                    counts = (step_score["ph1"], step_score["ph2"], step_score["ph3"])
+
+                # decay_flagによって確率の計算方法を切り替え
+                if decay_flag:
+                    # ユーザ状態スコアのSCORE_ADJUSTMENT乗は事前計算テーブルから参照
+                    ph1_mult, ph2_mult, ph3_mult = get_phase_multipliers(
                         user.ph1_count, user.last_ph1_step
                     )
-                    # 辞書から直接ユーザーとステップに関連するアイテムを取得
-                    user_items = items_dict.get((user.id, step), [])
-                    sorted_items = sorted(
-                        user_items,
-                        key=lambda x: ModelConfig.proposed_score(x, delta, lambda_val),
-                        reverse=True,
-                    )
+                    ph1_prob = item.ph1_score * ph1_mult
+                    ph2_prob = item.ph2_score * ph2_mult
+                    ph3_prob = item.ph3_score * ph3_mult
+                else:
+                    ph1_prob = item.ph1_score
+                    ph2_prob = item.ph2_score
+                    ph3_prob = item.ph3_score
 
-                top_k_items = sorted_items[:TOP_K]
-                for item in top_k_items:
-                    user_status = calculate_user_state_score(
-                        user.ph1_count, user.last_ph1_step
+                if draw() < ph1_prob:
+                    step_score["ph1"] += 1
+                    user.ph1_count += 1
+                    user.last_ph1_step = 0
+
+                    if draw() < ph2_prob:
+                        step_score["ph2"] += 1
+
+                        if draw() < ph3_prob:
+                            step_score["ph3"] += 1
+                            user.finished = True
+                else:
+                    user.last_ph1_step += 1
+
+                if trace is not None:
+                    trace.append_row(
+                        step,
+                        slot,
+                        user.id,
+                        item.item,
+                        *state,
+                        ph1_prob,
+                        ph2_prob,
+                        ph3_prob,
+                        step_score["ph1"] > counts[0],
+                        step_score["ph2"] > counts[1],
+                        step_score["ph3"] > counts[2],
                     )
-                    # decay_flagによって確率の計算方法を切り替え
-                    if decay_flag:
-                        ph1_prob = item.ph1_score * (
-                            user_status ** ModelConfig.SCORE_ADJUSTMENT["ph1"]
-                        )
-                        ph2_prob = item.ph2_score * (
-                            user_status ** ModelConfig.SCORE_ADJUSTMENT["ph2"]
-                        )
-                        ph3_prob = item.ph3_score * (
-                            user_status ** ModelConfig.SCORE_ADJUSTMENT["ph3"]
-                        )
-                    else:
-                        ph1_prob = item.ph1_score
-                        ph2_prob = item.ph2_score
-                        ph3_prob = item.ph3_score
-
-                    if random.random() < ph1_prob:
-                        step_score["ph1"] += 1
-                        user.ph1_count += 1
-                        user.last_ph1_step = 0
-
-                        if random.random() < ph2_prob:
-                            step_score["ph2"] += 1
-
-                            if random.random() < ph3_prob:
-                                step_score["ph3"] += 1
-                                user.finished = True
-                    else:
-                        user.last_ph1_step += 1
-
-            # 結果を累積
-            for phase in ["ph1", "ph2", "ph3"]:
-                trial_results[phase] += step_score[phase]
-
-        # 試行結果を記録
-        all_results["trials"].append(trial_results)
-
-    # 平均値を計算
-    average_results = {
+
+            if profiling:
+                sampling_time += perf_counter() - t0
+
+        if profiling:
+            t0 = perf_counter()
+
+        # 結果を累積
+        for phase_idx, phase in enumerate(["ph1", "ph2", "ph3"]):
+            trial_results[phase] += step_score[phase]
+            step_counts[step, phase_idx] = step_score[phase]
+
+        # このステップでph3に到達したユーザーを除外
+        if step_score["ph3"] > 0:
+            if release_finished:
+                for user in active_users:
+                    if user.finished:
+                        release_user_items(user.id, step + 1, items_dict)
+                        if baseline_rankings is not None:
+                            release_user_items(user.id, step + 1, baseline_rankings)
+            active_users = [user for user in active_users if not user.finished]
+
+        if profiling:
+            aggregation_time += perf_counter() - t0
+
+    if profiling:
+        profile.add_time("delta", delta_time)
+        profile.add_time("ranking", ranking_time)
+        profile.add_time("sampling", sampling_time)
+        profile.add_time("aggregation", aggregation_time)
+        profile.add_count("candidates_scored", candidates_scored)
+        profile.add_count("users_skipped_finished", users_skipped)
+        # ph1の判定は推薦ごと、ph2・ph3の判定は前のフェーズの成功時のみ乱数を引く
+        profile.add_count(
+            "rng_draws", recommendations + trial_results["ph1"] + trial_results["ph2"]
+        )
+
+    return trial_results, step_counts
+
+
+def load_trial(
+    trial: int,
+    engine: str,
+    data_format: str,
+    with_baseline: bool,
+    profile: StageProfile | None = None,
+    with_envelope: bool = False,
+    user_range: range | None = None,
+):
+    """
+    1試行分のデータを読み込み、設定間で共有できる前処理を行います
+
+    Args:
+        trial: 実験試行回数
+        engine: 実験エンジン
+        data_format: 試行データの形式
+        with_baseline: baselineランキングを事前計算するかどうか
+        profile: 処理段階ごとの時間とカウンタの記録先（Noneの場合は計測しない）
+        with_envelope: 提案スコアの包絡線インデックスを事前計算するかどうか（vectorizedエンジンのみ）
+        user_range: 読み込むユーザーIDの範囲（シャード分割用。Noneの場合は先頭のUSER_NUM人）
+    Returns:
+        trial_data: エンジンごとの試行データ（ユーザーIDはuser_rangeの先頭からの番号）
+    """
+    profile = profile or StageProfile()
+
+    if engine == "vectorized":
+        with profile.timer("load"):
+            user_states, item_scores = load_trial_arrays(trial, data_format, user_range)
+        # 遅延生成データは全体を実体化しないよう、baselineも各ステップで計算する
+        with_baseline = with_baseline and data_format != "generated"
+        with_envelope = with_envelope and data_format != "generated"
+        baseline_ranking = None
+        envelope_index = None
+        if with_baseline:
+            with profile.timer("grouping"):
+                baseline_ranking = rank_baseline(item_scores, TOP_K)
+            profile.add_count("candidates_scored", np.prod(item_scores.shape[:3]))
+        if with_envelope:
+            with profile.timer("grouping"):
+                envelope_index = EnvelopeIndex.build(item_scores, TOP_K)
+        return {
+            "user_states": user_states,
+            "item_scores": item_scores,
+            "baseline_ranking": baseline_ranking,
+            "envelope_index": envelope_index,
+        }
+
+    with profile.timer("load"):
+        if data_format == "csv":
+            users, items = load_data(trial, user_range)
+        else:
+            users, items = from_arrays(
+                *load_trial_arrays(trial, data_format, user_range)
+            )
+    with profile.timer("grouping"):
+        items_dict = group_items(items)
+        baseline_rankings = None
+        if with_baseline:
+            baseline_rankings = rank_baseline_items(items_dict)
+            profile.add_count("candidates_scored", len(items))
+    return {
+        "users": users,
+        "items_dict": items_dict,
+        "baseline_rankings": baseline_rankings,
+    }
+
+
+def run_trial(
+    trial_data: dict,
+    lambda_val: float,
+    decay_flag: bool,
+    engine: str,
+    trial_seed: int,
+    release_finished: bool = False,
+    profile: StageProfile | None = None,
+    outcome_uniforms: OutcomeUniforms | None = None,
+    policy: RankingPolicy | None = None,
+    trace: TraceWriter | None = None,
+) -> tuple[dict, np.ndarray]:
+    """
+    読み込み済みの試行データに対して1設定分の実験を実行します
+
+    Args:
+        trial_data: load_trialの戻り値
+        lambda_val: 将来マッチング重視パラメータλ
+        decay_flag: 減衰フラグ
+        engine: 実験エンジン
+        trial_seed: 試行の乱数シード
+        release_finished: 試行データをこの設定で使い切る場合にTrue。
+            候補データの所有権を実験側に移し、終了したユーザーの候補を途中で解放できるようにする
+        profile: 処理段階ごとの時間とカウンタの記録先（Noneの場合は計測しない）
+        outcome_uniforms: 指定した場合、trial_seedの乱数の代わりにこの共通乱数で成否を判定する
+        policy: ランキング方策（Noneの場合はλ=0ならbaseline、それ以外はproposed）
+        trace: 推薦イベントの記録先（Noneの場合は記録しない）
+    Returns:
+        tuple[dict, np.ndarray]:
+            各フェーズの成功回数と、shape (steps, 3) のステップごとのph1~3成功回数
+    """
+    # 逐次の乱数列を使う場合のみ、試行ごとに固定の乱数シードを設定
+    # （共通乱数は (trial, user, step, slot, phase) ごとに決まるため、グローバルな乱数の状態を使わない）
+    if outcome_uniforms is None:
+        random.seed(trial_seed)
+        np.random.seed(trial_seed)
+
+    # 所有権を移す場合はtrial_dataから取り除き、他から参照されないようにする
+    take = trial_data.pop if release_finished else trial_data.get
+
+    if engine == "vectorized":
+        return simulate_trial(
+            trial_data["user_states"],
+            take("item_scores"),
+            lambda_val,
+            decay_flag,
+            np.random.default_rng(trial_seed),
+            baseline_ranking=take("baseline_ranking"),
+            release_finished=release_finished,
+            profile=profile,
+            envelope_index=take("envelope_index"),
+            outcome_uniforms=outcome_uniforms,
+            policy=policy,
+            trace=trace,
+        )
+
+    # ユーザー状態は実験中に更新されるため、設定ごとにコピーする
+    users = [replace(user) for user in trial_data["users"]]
+    uniforms = None
+    if outcome_uniforms is not None:
+        uniforms = outcome_uniforms.table(len(users), EXPERIMENT_STEPS, TOP_K).tolist()
+    return run_trial_loop(
+        users,
+        take("items_dict"),
+        lambda_val,
+        decay_flag,
+        take("baseline_rankings"),
+        release_finished=release_finished,
+        profile=profile,
+        uniforms=uniforms,
+        policy=policy,
+        trace=trace,
+    )
+
+
+def summarize_trials(all_results: dict) -> dict:
+    """試行結果の平均値を計算します"""
+    return {
         "ph1": float(np.mean([trial["ph1"] for trial in all_results["trials"]])),
         "ph2": float(np.mean([trial["ph2"] for trial in all_results["trials"]])),
         "ph3": float(np.mean([trial["ph3"] for trial in all_results["trials"]])),
     }
 
-    all_results["average"] = average_results
-    all_results["execution_time"] = time.time() - start_time
 
-    logger.info(f"実験が完了しました: λ = {lambda_val}, 平均結果 = {average_results}")
-    return all_results
+def summarize_history(step_counts_list: list[np.ndarray]) -> tuple[dict, dict]:
+    """
+    試行ごとのステップ別成功回数を集計します
+
+    Args:
+        step_counts_list: 試行ごとのshape (steps, 3) のph1~3成功回数
+    Returns:
+        tuple[dict, dict]: 試行ごとのステップ別成功回数と、ステップ別の平均値
+    """
+    history = np.stack(step_counts_list)  # (trials, steps, 3)
+    trial_history = {}
+    average_history = {}
+    for phase_idx, phase in enumerate(["ph1", "ph2", "ph3"]):
+        trial_history[phase] = history[:, :, phase_idx].tolist()
+        average_history[phase] = history[:, :, phase_idx].mean(axis=0).tolist()
+    return trial_history, average_history
+
+
+def prepare_policies(policy: str, lambda_values) -> dict[str, RankingPolicy]:
+    """
+    設定で使う方策のインスタンスを方策名ごとに1度だけ作成し、事前計算を行います
+
+    Args:
+        policy: λ≠0の設定で使うランキング方策の登録名（λ=0の設定はbaseline）
+        lambda_values: 設定のλのリスト
+    Returns:
+        policies: config_policyの方策名と準備済みのインスタンスの辞書
+    """
+    policies = {}
+    for lambda_val in lambda_values:
+        name = config_policy(policy, lambda_val)
+        if name not in policies:
+            policies[name] = get_policy(name)
+            policies[name].prepare()
+    return policies
+
+
+def run_trial_configs(
+    trial: int,
+    configs: list[tuple[float, bool]],
+    engine: str,
+    data_format: str,
+    profiling: bool = False,
+    checkpoint_dir: str | None = None,
+    envelope: bool = False,
+    outcome_rng: str = "sequential",
+    policy: str = PROPOSED,
+    user_range: range | None = None,
+    trace_dir: str | None = None,
+    policies: dict[str, RankingPolicy] | None = None,
+) -> tuple[list[dict], float]:
+    """
+    1試行分のデータを読み込み、全ての設定で実験を実行します
+
+    プロセスプールのワーカーからも呼び出されるため、戻り値は試行ごとの集計値のみとします。
+    user_rangeを指定した場合はそのシャードのユーザーだけを実験します。
+    シャードの結果は呼び出し側で足し合わせるため、チェックポイントは保存しません。
+
+    Args:
+        trial: 実験試行回数
+        configs: (λ, 減衰フラグ) のリスト
+        engine: 実験エンジン
+        data_format: 試行データの形式
+        profiling: 処理段階ごとの時間とカウンタを計測するかどうか
+        checkpoint_dir: 指定した場合、試行が終わるたびに設定ごとの結果をチェックポイントとして保存する
+        envelope: λ≠0のランキングに包絡線インデックスを使用するかどうか
+        outcome_rng: 成否判定の乱数。"crn"（(trial, user, step, slot, phase) ごとに固定の共通乱数）、
+            "antithetic"（共通乱数の対称変量）、"sequential"（試行ごとのシードの乱数列。従来の動作でデフォルト）
+        policy: λ≠0の設定で使うランキング方策の登録名（λ=0の設定はbaseline）
+        user_range: 実験するユーザーIDの範囲（Noneの場合は全ユーザー）
+        trace_dir: 指定した場合、推薦イベントをここに記録する（experiments/tracing.py）
+        policies: prepare_policiesで準備した方策のインスタンス（Noneの場合はこの試行で作成して準備する）
+    Returns:
+        tuple[list[dict], float]:
+            設定ごとの試行結果とデータ読み込み時間。試行結果は以下を持つ
+            - results: 各フェーズの成功回数
+            - step_counts: shape (steps, 3) のステップごとのph1~3成功回数
+            - execution_time: 実行時間（共有の読み込み・前処理の時間は設定数で按分）
+            - profile: 計測結果（共有の読み込み・前処理を含む。計測しない場合はNone）
+    """
+    logger = logging.getLogger(__name__)
+    if policies is None:
+        policies = prepare_policies(policy, [lambda_val for lambda_val, _ in configs])
+    trial_seed = RANDOM_SEED + trial
+    first_user = 0
+    if user_range is None:
+        logger.info(f"試行 {trial + 1}/{TRIAL_NUM} を開始")
+    else:
+        # シャードごとの開始ログは出さず、完了時にメモリ使用量とあわせて出力する
+        trial_seed = shard_seed(trial_seed, user_range)
+        first_user = user_range.start
+
+    # ユーザーとアイテムデータを読み込む（全設定で共有）
+    with_baseline = any(lambda_val == 0 for lambda_val, _ in configs)
+    # 包絡線インデックスはproposedのスコアに対してのみ作成できる
+    with_envelope = (
+        envelope
+        and policy == PROPOSED
+        and any(lambda_val != 0 for lambda_val, _ in configs)
+    )
+    shared_profile = StageProfile() if profiling else None
+    load_start = time.time()
+    trial_data = load_trial(
+        trial,
+        engine,
+        data_format,
+        with_baseline,
+        shared_profile,
+        with_envelope,
+        user_range,
+    )
+    load_time = time.time() - load_start
+
+    outcome_uniforms = None
+    if outcome_rng != "sequential":
+        outcome_uniforms = OutcomeUniforms(
+            trial, antithetic=outcome_rng == "antithetic", first_user=first_user
+        )
+
+    # トレースはバックグラウンドのスレッドが書き出し、試行の終了時に書き出しの完了を待つ
+    # 例外で中断した場合も書き出しスレッドを終了させる
+    sink = TraceSink(trace_dir) if trace_dir is not None else nullcontext()
+    with sink as trace_sink:
+        records = []
+        for config_idx, config in enumerate(configs):
+            profile = StageProfile().merge(shared_profile) if profiling else None
+            config_start = time.time()
+            # 最後の設定では試行データを共有する必要がないため、終了ユーザーの候補を解放させる
+            release_finished = config_idx == len(configs) - 1
+            trace = None
+            if trace_sink is not None:
+                trace = trace_sink.writer(*config, trial, first_user)
+            trial_results, step_counts = run_trial(
+                trial_data,
+                *config,
+                engine,
+                trial_seed,
+                release_finished,
+                profile,
+                outcome_uniforms,
+                policies[config_policy(policy, config[0])],
+                trace,
+            )
+            records.append(
+                {
+                    "results": trial_results,
+                    "step_counts": step_counts,
+                    "execution_time": time.time()
+                    - config_start
+                    + load_time / len(configs),
+                    "profile": profile.to_dict() if profiling else None,
+                }
+            )
+
+    if user_range is not None:
+        logger.info(
+            f"試行 {trial + 1}/{TRIAL_NUM} のユーザー {user_range.start}-"
+            f"{user_range.stop - 1} が完了 (ピークメモリ {peak_rss_mb():.0f} MB)"
+        )
+    elif checkpoint_dir is not None:
+        _save_checkpoints(
+            checkpoint_dir,
+            trial,
+            configs,
+            records,
+            engine,
+            data_format,
+            outcome_rng,
+            policy,
+        )
+
+    return records, load_time
+
+
+def measure_user_bytes(
+    configs: list[tuple[float, bool]],
+    engine: str,
+    data_format: str,
+    envelope: bool = False,
+    outcome_rng: str = "sequential",
+    policy: str = PROPOSED,
+    policies: dict[str, RankingPolicy] | None = None,
+) -> int:
+    """
+    先頭のMEMORY_SAMPLE_USERS人で試行0の全設定を実行し、1ユーザーあたりのメモリを計測します
+
+    tracemallocで計測するため、Pythonのオブジェクトと配列の確保を含み、メモリマップで参照するだけの
+    ファイルの内容は含みません。プロセスごとの固定分も人数で割るため、実際より多めの値になります。
+
+    Args:
+        configs: (λ, 減衰フラグ) のリスト
+        engine, data_format, envelope, outcome_rng, policy, policies: run_trial_configsを参照
+    Returns:
+        user_bytes: 1ユーザーあたりのピークメモリ（バイト）
+    """
+    user_range = range(0, min(USER_NUM, MEMORY_SAMPLE_USERS))
+    tracemalloc.start()
+    try:
+        run_trial_configs(
+            0,
+            configs,
+            engine,
+            data_format,
+            envelope=envelope,
+            outcome_rng=outcome_rng,
+            policy=policy,
+            user_range=user_range,
+            policies=policies,
+        )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return max(peak // len(user_range), 1)
+
+
+def _save_checkpoints(
+    checkpoint_dir: str,
+    trial: int,
+    configs: list[tuple[float, bool]],
+    records: list[dict],
+    engine: str,
+    data_format: str,
+    outcome_rng: str,
+    policy: str,
+    shard_size: int | None = None,
+):
+    """1試行分の設定ごとの結果をチェックポイントとして保存します"""
+    for config, record in zip(configs, records):
+        settings = (*config, engine, data_format, outcome_rng, policy, shard_size)
+        save_checkpoint(
+            checkpoint_dir,
+            config_hash(*settings),
+            trial,
+            record,
+            effective_config(*settings),
+        )
+
+
+def _run_trials(
+    trials: list[int],
+    configs: list[tuple[float, bool]],
+    run_configs,
+    executor: ProcessPoolExecutor | None,
+    checkpoint_dir: str | None,
+    engine: str,
+    data_format: str,
+    outcome_rng: str,
+    policy: str,
+    shard_size: int | None = None,
+) -> tuple[dict, float, int]:
+    """
+    指定した試行・設定の結果を、チェックポイントから読み込むか実験を実行して取得します
+
+    shard_sizeを指定した場合は (試行, シャード) ごとにrun_configsを呼び出し、
+    シャードの結果を試行ごとに足し合わせてからチェックポイントを保存します。
+
+    Returns:
+        tuple[dict, float, int]:
+            設定ごとの試行結果のリスト（試行順）、データ読み込み時間の合計、チェックポイントから読み込んだ件数
+    """
+    records = {config: {} for config in configs}
+    if checkpoint_dir is not None:
+        for config in configs:
+            hash_value = config_hash(
+                *config, engine, data_format, outcome_rng, policy, shard_size
+            )
+            for trial in trials:
+                record = load_checkpoint(checkpoint_dir, hash_value, trial)
+                if record is not None:
+                    records[config][trial] = record
+    num_restored = sum(len(config_records) for config_records in records.values())
+
+    # 未完了の設定がある試行だけを実行する
+    pending_trials = []
+    pending_configs = []
+    for trial in trials:
+        missing = [config for config in configs if trial not in records[config]]
+        if missing:
+            pending_trials.append(trial)
+            pending_configs.append(missing)
+
+    # (試行, シャード) ごとの呼び出し（シャードに分割しない場合は試行ごと）
+    user_ranges = shard_ranges(USER_NUM, shard_size)
+    calls = [
+        partial(run_configs, trial, trial_configs, user_range=user_range)
+        for trial, trial_configs in zip(pending_trials, pending_configs)
+        for user_range in user_ranges
+    ]
+    if executor is not None:
+        futures = [executor.submit(call) for call in calls]
+        outputs = (future.result() for future in futures)
+    else:
+        outputs = (call() for call in calls)
+
+    load_time = 0.0
+    for trial, trial_configs in zip(pending_trials, pending_configs):
+        shard_outputs = [next(outputs) for _ in user_ranges]
+        load_time += sum(shard_load_time for _, shard_load_time in shard_outputs)
+        trial_records = merge_shard_records(
+            [shard_records for shard_records, _ in shard_outputs]
+        )
+        if shard_size is not None and checkpoint_dir is not None:
+            _save_checkpoints(
+                checkpoint_dir,
+                trial,
+                trial_configs,
+                trial_records,
+                engine,
+                data_format,
+                outcome_rng,
+                policy,
+                shard_size,
+            )
+        for config, record in zip(trial_configs, trial_records):
+            records[config][trial] = record
+
+    return (
+        {config: [records[config][trial] for trial in trials] for config in configs},
+        load_time,
+        num_restored,
+    )
+
+
+def _intervals(stats: RunningStats, paired: bool) -> dict:
+    """
+    試行結果の95%信頼区間を計算します
+
+    Args:
+        stats: 設定の逐次統計（pairedの場合は後半3次元が対応する試行のbaselineの結果）
+        paired: λ=0との比率の信頼区間も計算するかどうか
+    Returns:
+        intervals: confidence_interval（フェーズごとの [下限, 上限]）と、
+            pairedの場合はratio_confidence_interval（フェーズごとの [比率, 下限, 上限]）
+    """
+    lower, upper = stats.mean_interval()
+    intervals = {
+        "confidence_interval": {
+            phase: [float(lower[idx]), float(upper[idx])]
+            for idx, phase in enumerate(PHASES)
+        }
+    }
+    if paired:
+        ratio, lower, upper = stats.ratio_interval([0, 1, 2], [3, 4, 5])
+        intervals["ratio_confidence_interval"] = {
+            phase: [float(ratio[idx]), float(lower[idx]), float(upper[idx])]
+            for idx, phase in enumerate(PHASES)
+        }
+    return intervals
+
+
+def _converged(
+    stats: RunningStats, paired: bool, ci_width: float, min_samples: int
+) -> bool:
+    """信頼区間の幅が全フェーズで目標以下になったかどうかを判定します"""
+    if stats.count < min_samples:
+        return False
+    if paired:
+        widths = relative_width(*stats.ratio_interval([0, 1, 2], [3, 4, 5]))
+    else:
+        widths = relative_width(stats.mean[:3], *stats.mean_interval())
+    return bool(np.all(widths[:3] <= ci_width))
+
+
+def run_sweep(
+    lambda_values: list[float],
+    decay_flags: list[bool],
+    engine: str = "loop",
+    data_format: str = "csv",
+    workers: int = 1,
+    profiling: bool = False,
+    checkpoint_dir: str | None = None,
+    envelope: bool = False,
+    ci_width: float | None = None,
+    max_trials: int | None = None,
+    min_trials: int = 10,
+    outcome_rng: str = "sequential",
+    policy: str = PROPOSED,
+    shard_size: int | None = None,
+    memory_limit_mb: float | None = None,
+    trace_dir: str | None = None,
+) -> list[dict]:
+    """
+    λ値と減衰フラグの全組み合わせで実験を実行します
+
+    各試行のデータは1度だけ読み込み、全ての設定で共有します。
+    λ=0のbaselineランキングも試行ごとに1度だけ計算し、減衰フラグ間で共有します。
+
+    Args:
+        lambda_values: 将来マッチング重視パラメータλのリスト
+        decay_flags: 減衰フラグのリスト
+        engine: 実験エンジン。"loop"（参照実装）または"vectorized"（NumPy配列演算）
+        data_format: 試行データの形式。"csv", "npy"または"generated"
+        workers: 試行を並列実行するプロセス数（1の場合は逐次実行）
+        profiling: 処理段階ごとの時間とカウンタを計測し、結果とログに出力するかどうか
+        checkpoint_dir: 指定した場合、試行ごとの結果をここに保存し、
+            同じ設定で保存済みの試行は実行せずに再利用する
+        envelope: λ≠0のランキングに試行ごとに作成する包絡線インデックス（envelope.py）を使用するかどうか。
+            vectorizedエンジンでのみ有効で、結果は使用しない場合と同一
+        ci_width: 指定した場合、試行回数を適応的に決める。各設定の95%信頼区間の幅（推定値に対する比）が
+            全フェーズでこの値以下になった時点でその設定の試行を打ち切る。
+            λ=0と比較する設定はλ=0との比率、それ以外は各フェーズの平均の信頼区間で判定する。
+            outcome_rng="antithetic"では対になる2試行の平均を1標本とし、試行は組単位で追加する
+        max_trials: 適応的に決める場合の試行回数の上限（Noneの場合はTRIAL_NUM）
+        min_trials: 適応的に決める場合の最小の試行回数
+        outcome_rng: 成否判定の乱数。"crn"は (trial, user, step, slot, phase) ごとに固定の共通乱数を
+            全ての設定で共有する。ユーザーの結果は処理順序に依存しないため、エンジン・シャード分割・
+            ワーカー数によらず同じ結果になる。"antithetic"はさらに試行を2つずつ組にして一方で1 - uを使う。
+            "sequential"（デフォルト）は試行ごとのシードの乱数列を消費順に使う（従来の動作。過去の結果と一致する）
+        policy: λ≠0の設定で使うランキング方策の登録名（policies.py）。λ=0の設定は比較の基準となるbaseline
+        shard_size: 指定した場合、ユーザーをこの人数ずつのシャードに分け、(試行, シャード) ごとに
+            データを読み込んで独立に実験し、成功回数だけを足し合わせる（sharding.py）。
+            共通乱数（crn, antithetic）では分割しない場合と同じ結果になる
+        memory_limit_mb: shard_sizeを指定しない場合に、全プロセスの合計がこのメモリ（MB）に収まるよう
+            シャードサイズを決める。全ユーザーが収まる場合は分割しない
+        trace_dir: 指定した場合、推薦ごとのイベント（ユーザ状態・成功確率・成否）を
+            圧縮した列形式のファイルとしてここに記録する（experiments/tracing.py）。
+            チェックポイントから再利用した試行は実行しないため記録されない
+    Returns:
+        results: 設定 (decay_flag, λ) ごとの実験結果のリスト
+    """
+    logger = logging.getLogger(__name__)
+    configs = [
+        (lambda_val, decay_flag)
+        for decay_flag in decay_flags
+        for lambda_val in lambda_values
+    ]
+    for lambda_val, decay_flag in configs:
+        logger.info(
+            f"実験を開始します: λ = {lambda_val}, 減衰フラグ = {decay_flag}, エンジン = {engine}"
+        )
+
+    adaptive = ci_width is not None
+    num_trials = (max_trials or TRIAL_NUM) if adaptive else TRIAL_NUM
+    # 比較対象のbaseline（同じ減衰フラグのλ=0）
+    baselines = {
+        config: (
+            (0, config[1]) if config[0] != 0 and (0, config[1]) in configs else None
+        )
+        for config in configs
+    }
+    # 設定ごとの試行結果の逐次統計（baselineと比較する設定は対応する試行のbaselineの結果も含める）
+    stats = {config: RunningStats(6 if baselines[config] else 3) for config in configs}
+    # antitheticの組の2試行は独立でないため、組の平均を1標本とする（組の途中で打ち切らない）
+    pair_size = 2 if outcome_rng == "antithetic" else 1
+    min_samples = -(-min_trials // pair_size)
+
+    if trace_dir is not None:
+        # 以前の実行のトレースが残っていると、シャード分割などが異なる場合に新しいトレースと混ざる
+        num_removed = clear_trace_dirs(trace_dir, configs)
+        if num_removed:
+            logger.info(
+                f"以前のトレース {num_removed} ファイルを削除しました: {trace_dir}"
+            )
+
+    # 方策はスイープで1度だけ作成・事前計算（状態価値など）し、同じインスタンスを全試行で使う
+    # （ワーカーには試行ごとに準備済みのインスタンスが渡される）
+    policies = prepare_policies(policy, lambda_values)
+    run_configs = partial(
+        run_trial_configs,
+        engine=engine,
+        data_format=data_format,
+        profiling=profiling,
+        checkpoint_dir=checkpoint_dir,
+        envelope=envelope,
+        outcome_rng=outcome_rng,
+        policy=policy,
+        trace_dir=trace_dir,
+        policies=policies,
+    )
+
+    user_bytes = None
+    if shard_size is None and memory_limit_mb is not None:
+        # 1ユーザーあたりのメモリは、このエンジン・データ形式・設定で先頭の数人を実際に実行して計測する
+        user_bytes = measure_user_bytes(
+            configs, engine, data_format, envelope, outcome_rng, policy, policies
+        )
+        shard_size = shard_size_for_memory(
+            memory_limit_mb, workers, engine, data_format, user_bytes
+        )
+        if shard_size >= USER_NUM:
+            shard_size = None
+    if shard_size is not None:
+        num_shards = len(shard_ranges(USER_NUM, shard_size))
+        user_bytes = user_bytes or estimate_user_bytes(engine, data_format)
+        logger.info(
+            f"ユーザーを {shard_size} 人ずつの {num_shards} シャードに分割して実行します "
+            f"(1シャードの推定メモリ: {shard_size * user_bytes / 2**20:.1f} MB)"
+        )
+    # records[config]: 設定ごとの試行結果のリスト（run_trial_configsの戻り値の要素、試行順）
+    records = {config: [] for config in configs}
+    active = list(configs)
+    shared_time = 0.0
+    num_restored = 0
+    next_trial = 0
+    # 試行はプロセスプールに分配し、executor.mapで試行順に結果を受け取る
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        while active and next_trial < num_trials:
+            if not adaptive:
+                batch_size = num_trials
+            elif next_trial == 0:
+                batch_size = max(min_trials, workers)
+            else:
+                batch_size = workers
+            batch_size = -(-batch_size // pair_size) * pair_size
+            trials = list(range(next_trial, min(next_trial + batch_size, num_trials)))
+            next_trial = trials[-1] + 1
+
+            # baselineは比較する設定が終了するまで実行を続ける
+            batch_configs = [
+                config
+                for config in configs
+                if config in active or config in {baselines[a] for a in active}
+            ]
+            batch_records, load_time, restored = _run_trials(
+                trials,
+                batch_configs,
+                run_configs,
+                executor,
+                checkpoint_dir,
+                engine,
+                data_format,
+                outcome_rng,
+                policy,
+                shard_size,
+            )
+            shared_time += load_time
+            num_restored += restored
+
+            for config in batch_configs:
+                records[config].extend(batch_records[config])
+                baseline = baselines[config]
+                samples = []
+                for trial_idx, record in enumerate(batch_records[config]):
+                    values = [record["results"][phase] for phase in PHASES]
+                    if baseline is not None:
+                        baseline_results = batch_records[baseline][trial_idx]["results"]
+                        values += [baseline_results[phase] for phase in PHASES]
+                    samples.append(values)
+                # バッチは組の先頭の試行から始まる（試行回数が奇数の場合、最後の試行は単独の標本）
+                for start in range(0, len(samples), pair_size):
+                    stats[config].update(
+                        np.mean(samples[start : start + pair_size], axis=0)
+                    )
+
+            if adaptive:
+                active = [
+                    config
+                    for config in active
+                    if not _converged(
+                        stats[config], bool(baselines[config]), ci_width, min_samples
+                    )
+                ]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if checkpoint_dir is not None:
+        logger.info(
+            f"チェックポイントから {num_restored} 件の試行結果を再利用しました: {checkpoint_dir}"
+        )
+    logger.info(f"データ読み込みと共有前処理の時間: {shared_time:.2f}秒")
+
+    results = []
+    for config in configs:
+        config_records = records[config]
+        config_results = {
+            "lambda": config[0],
+            "decay_flag": config[1],
+            "engine": engine,
+            "outcome_rng": outcome_rng,
+            "policy": config_policy(policy, config[0]),
+            "config_hash": config_hash(
+                *config, engine, data_format, outcome_rng, policy, shard_size
+            ),
+            # 試行結果を記録
+            "trials": [record["results"] for record in config_records],
+        }
+        config_results["average"] = summarize_trials(config_results)
+        config_results["history"], config_results["average_history"] = (
+            summarize_history([record["step_counts"] for record in config_records])
+        )
+        config_results["execution_time"] = sum(
+            record["execution_time"] for record in config_records
+        )
+        config_results["num_trials"] = len(config_records)
+        config_results.update(_intervals(stats[config], bool(baselines[config])))
+        logger.info(
+            f"実験が完了しました: λ = {config[0]}, 減衰フラグ = {config[1]}, "
+            f"試行回数 = {len(config_records)}, 平均結果 = {config_results['average']}"
+        )
+        if profiling:
+            profiles = [record["profile"] for record in config_records]
+            total_profile = StageProfile()
+            for profile in profiles:
+                if profile is not None:
+                    total_profile.merge(StageProfile.from_dict(profile))
+            # load・groupingは試行ごとに設定間で共有された処理の時間
+            config_results["profile"] = {
+                "trials": profiles,
+                "total": total_profile.to_dict(),
+            }
+            logger.info(
+                f"処理時間の内訳: λ = {config[0]}, 減衰フラグ = {config[1]}: "
+                f"{total_profile.format()}"
+            )
+        results.append(config_results)
+
+    # 同じ減衰フラグのλ=0をbaselineとして、累積比率を計算
+    # （適応的に決める場合、baselineは比較する設定より多く試行していることがあるため、
+    # 設定と同じ先頭の試行だけで平均を取り直す）
+    results_by_config = dict(zip(configs, results))
+    for config, config_results in results_by_config.items():
+        baseline = (0, config[1])
+        baseline_results = results_by_config.get(baseline)
+        if baseline_results is None or baseline_results is config_results:
+            continue
+        num_trials = config_results["num_trials"]
+        baseline_records = records[baseline][:num_trials]
+        baseline_average = summarize_trials(
+            {"trials": [record["results"] for record in baseline_records]}
+        )
+        _, baseline_history = summarize_history(
+            [record["step_counts"] for record in baseline_records]
+        )
+        config_results["metrics"] = calculate_metrics(
+            baseline_average,
+            config_results["average"],
+            {
+                "baseline": baseline_history,
+                "proposed": config_results["average_history"],
+            },
+        )
+        config_results["metrics"]["num_trials"] = num_trials
+
+    return results
+
+
+def run_experiment(
+    lambda_val: float,
+    decay_flag: bool,
+    engine: str = "loop",
+    data_format: str = "csv",
+    workers: int = 1,
+    profiling: bool = False,
+    checkpoint_dir: str | None = None,
+    envelope: bool = False,
+    ci_width: float | None = None,
+    max_trials: int | None = None,
+    outcome_rng: str = "sequential",
+    policy: str = PROPOSED,
+    shard_size: int | None = None,
+    memory_limit_mb: float | None = None,
+    trace_dir: str | None = None,
+):
+    """
+    指定されたλ値で実験を実行します
+
+    Args:
+        lambda_val: 将来マッチング重視パラメータλ
+        decay_flag: 減衰フラグ
+        engine: 実験エンジン。"loop"（参照実装）または"vectorized"（NumPy配列演算）
+        data_format: 試行データの形式。"csv", "npy"または"generated"
+        workers: 試行を並列実行するプロセス数（1の場合は逐次実行）
+        profiling: 処理段階ごとの時間とカウンタを計測するかどうか
+        checkpoint_dir: 試行ごとの結果の保存先（指定した場合は保存済みの試行を再利用する）
+        envelope: λ≠0のランキングに包絡線インデックスを使用するかどうか
+        ci_width: 指定した場合、95%信頼区間の幅がこの値（推定値に対する比）以下になるまで試行を続ける
+        max_trials: ci_widthを指定した場合の試行回数の上限
+        outcome_rng: 成否判定の乱数（"crn", "antithetic", "sequential"）
+        policy: λ≠0の場合に使うランキング方策の登録名
+        shard_size: ユーザーを分割するシャードの人数（Noneの場合は分割しない）
+        memory_limit_mb: shard_sizeを指定しない場合にシャードサイズを決めるメモリ上限（MB）
+        trace_dir: 推薦イベントの記録先（Noneの場合は記録しない）
+    """
+    return run_sweep(
+        [lambda_val],
+        [decay_flag],
+        engine,
+        data_format,
+        workers,
+        profiling,
+        checkpoint_dir,
+        envelope,
+        ci_width,
+        max_trials,
+        outcome_rng=outcome_rng,
+        policy=policy,
+        shard_size=shard_size,
+        memory_limit_mb=memory_limit_mb,
+        trace_dir=trace_dir,
+    )[0]
 
 
 def save_results(results, output_dir=RESULTS_DIR):
@@ -247,12 +1302,149 @@ def parse_arguments():
         default=0.1,
         help="将来マッチング重視パラメータλ (0.0はbaseline相当)",
     )
+    parser.add_argument(
+        "--lambda_values",
+        type=float,
+        nargs="+",
+        default=None,
+        help="複数のλ値を1回の実行で評価する場合に指定 (--lambda_valueより優先)",
+    )
     parser.add_argument(
         "--no_decay_flag",
         action="store_false",
         dest="decay_flag",
         help="減衰なしにしたい場合はこのフラグを指定",
     )
+    parser.add_argument(
+        "--both_decay_flags",
+        action="store_true",
+        help="減衰あり・なしの両方を1回の実行で評価する場合に指定",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["loop", "vectorized"],
+        default="loop",
+        help="実験エンジン (loop: Pythonループの参照実装, vectorized: NumPy配列演算)",
+    )
+    parser.add_argument(
+        "--data_format",
+        choices=["csv", "npy", "generated"],
+        default="csv",
+        help=(
+            "試行データの形式 (csv: 行単位のCSV, npy: メモリマップで読み込む.npy, "
+            "generated: データファイルを使わずカウンタベース乱数でその場生成)"
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="試行を並列実行するプロセス数 (1の場合は逐次実行)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="試行ごとの処理段階別の時間とカウンタを計測し、結果JSONとログに出力する",
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        default=None,
+        help=(
+            "試行ごとの結果を保存するディレクトリ。中断後に同じ引数で再実行すると、"
+            "保存済みの試行を再利用して残りの試行だけを実行する"
+        ),
+    )
+    parser.add_argument(
+        "--envelope_index",
+        action="store_true",
+        help=(
+            "λ≠0のランキングに、試行ごとに作成する提案スコアの上側包絡線インデックスを使用する "
+            "(vectorizedエンジンのみ。候補数が多い場合に高速)"
+        ),
+    )
+    parser.add_argument(
+        "--ci_width",
+        type=float,
+        default=None,
+        help=(
+            "試行回数を適応的に決める場合に指定。各設定の95%%信頼区間の幅（推定値に対する比）が"
+            "全フェーズでこの値以下になった時点で試行を打ち切る"
+        ),
+    )
+    parser.add_argument(
+        "--max_trials",
+        type=int,
+        default=None,
+        help="--ci_widthを指定した場合の試行回数の上限 (デフォルト: TRIAL_NUM)",
+    )
+    parser.add_argument(
+        "--min_trials",
+        type=int,
+        default=10,
+        help="--ci_widthを指定した場合の最小の試行回数",
+    )
+    parser.add_argument(
+        "--outcome_rng",
+        choices=["crn", "antithetic", "sequential"],
+        default="sequential",
+        help=(
+            "成否判定の乱数 (sequential: 試行ごとのシードの乱数列を消費順に使う従来の動作。"
+            "デフォルトで、過去の結果とビット単位で一致する, "
+            "crn: (試行, ユーザー, ステップ, フェーズ) ごとに固定の共通乱数を"
+            "全ての設定で共有し、エンジン・シャード分割・ワーカー数によらず同じ結果になる, "
+            "antithetic: 共通乱数に加えて試行を2つずつ組にし、一方で1 - uを使う)"
+        ),
+    )
+    parser.add_argument(
+        "--policy",
+        default=PROPOSED,
+        help=(
+            "λ≠0の設定で使うランキング方策の登録名 "
+            f"(組み込み: {', '.join(sorted(POLICIES))}。λ=0の設定は常にbaseline)"
+        ),
+    )
+    parser.add_argument(
+        "--policy_module",
+        nargs="+",
+        default=[],
+        help="方策を登録するモジュール (register_policyで登録。--policyより先に読み込む)",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=None,
+        help=(
+            "ユーザーをこの人数ずつのシャードに分け、シャードごとにデータを読み込んで実験し"
+            "成功回数だけを足し合わせる (シャードは--workersのプロセスに分配される)"
+        ),
+    )
+    parser.add_argument(
+        "--memory_limit_mb",
+        type=float,
+        default=None,
+        help=(
+            "--shard_sizeを指定しない場合に、全プロセスの合計がこのメモリ (MB) に収まるよう"
+            "シャードサイズを決める"
+        ),
+    )
+    parser.add_argument(
+        "--trace_dir",
+        default=None,
+        help=(
+            "推薦ごとのイベントを圧縮した列形式のファイルとしてこのディレクトリに記録する"
+            " (python src/experiments/tracing.py で表示)"
+        ),
+    )
+    parser.add_argument(
+        "--results_db",
+        default=RESULTS_DB,
+        help="実験結果を追記するSQLiteデータベース (デフォルト: results/results.db)",
+    )
+    parser.add_argument(
+        "--save_json",
+        action="store_true",
+        help="従来形式のJSONファイル (results/decay_{true,false}/lambda_{λ}_{timestamp}.json) も保存する",
+    )
     return parser.parse_args()
 
 
@@ -264,13 +1456,41 @@ def main():
 
     logger.info("プログラムを開始します")
 
+    lambda_values = args.lambda_values or [args.lambda_value]
+    decay_flags = [True, False] if args.both_decay_flags else [args.decay_flag]
+
     try:
-        results = run_experiment(args.lambda_value, args.decay_flag)
-        if args.decay_flag:
-            output_dir = "results/decay_true"
-        else:
-            output_dir = "results/decay_false"
-        save_results(results, output_dir)
+        load_policy_modules(args.policy_module)
+        # 未登録の方策名は実験を始める前にエラーにする
+        get_policy(args.policy)
+        results = run_sweep(
+            lambda_values,
+            decay_flags,
+            args.engine,
+            args.data_format,
+            args.workers,
+            args.profile,
+            args.checkpoint_dir,
+            args.envelope_index,
+            args.ci_width,
+            args.max_trials,
+            args.min_trials,
+            args.outcome_rng,
+            args.policy,
+            args.shard_size,
+            args.memory_limit_mb,
+            args.trace_dir,
+        )
+        with ResultsStore(args.results_db) as store:
+            run_id = store.save_run(results)
+        logger.info(f"結果を保存しました: {args.results_db} (run_id = {run_id})")
+        if args.save_json:
+            for config_results in results:
+                if config_results["decay_flag"]:
+                    output_dir = "results/decay_true"
+                else:
+                    output_dir = "results/decay_false"
+                save_results(config_results, output_dir)
         logger.info("プログラムが正常に終了しました")
     except Exception as e:
         logger.error(f"エラーが発生しました: {e}", exc_info=True)
@@ -0,0 +1,670 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+パラメータ感度分析のグリッド実行
+
+モデルの挙動を決めるモジュール定数（config.USER_STATE_POWER, ModelConfig.SCORE_ADJUSTMENT,
+UserStateScoreParams.MAX_PH1_COUNT, MAX_STEPS, DECAY_RATE）とλ・減衰フラグの組み合わせをJSONで宣言し、
+コードを変更せずにまとめて実行する。
+
+    {
+        "params": {
+            "SCORE_ADJUSTMENT": [0.25, {"ph1": 0.5, "ph2": 1/3, "ph3": 1/3}],
+            "DECAY_RATE": [0.97, 0.99]
+        },
+        "lambda_values": [0, 0.1],
+        "decay_flags": [true, false]
+    }
+
+paramsの各値のリストの直積がグリッド点になる（指定しないパラメータは現在の値）。
+SCORE_ADJUSTMENTは数値（全フェーズ共通）またはフェーズごとの辞書で指定する。
+MAX_STEPSを指定してDECAY_RATEを指定しない場合、DECAY_RATEはMAX_STEPSステップで0.1になる値にする。
+
+設定間で共有できる処理は1度だけ行う:
+- 試行データの読み込み、baselineランキング、包絡線インデックスはパラメータに依存しないため、試行ごとに1度だけ計算する
+- 結果が依存するパラメータ（relevant_params）が同じ設定は1度だけ実行し、結果を共有する
+  （例: 減衰なしのλ=0はどのパラメータにも依存しない）
+- ユーザ状態スコアのテーブルはパラメータごとに1度だけ作成する（utils.get_user_state_score_tables）
+残りの実行は試行（とシャード）ごとにプロセスプールに分配する。
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from functools import partial
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+import config  # noqa: E402
+from data_processing.counter_rng import OutcomeUniforms  # noqa: E402
+from experiments.checkpoint import config_hash  # noqa: E402
+from experiments.experiment import (  # noqa: E402
+    load_trial,
+    run_trial,
+    setup_logger,
+    summarize_history,
+    summarize_trials,
+)
+from experiments.policies import (  # noqa: E402
+    BASELINE,
+    POLICIES,
+    PROPOSED,
+    BaselinePolicy,
+    ProposedPolicy,
+    RankingPolicy,
+    config_policy,
+    get_policy,
+    load_policy_modules,
+)
+from experiments.sharding import (  # noqa: E402
+    merge_shard_records,
+    shard_ranges,
+    shard_seed,
+)
+from utils.results_store import GRID, RESULTS_DB, ResultsStore  # noqa: E402
+from utils.utils import UserStateScoreParams, calculate_metrics  # noqa: E402
+
+GRID_PARAMS = (
+    "USER_STATE_POWER",
+    "SCORE_ADJUSTMENT",
+    "MAX_PH1_COUNT",
+    "MAX_STEPS",
+    "DECAY_RATE",
+)
+# ユーザ状態スコア（Δと減衰の倍率）を決めるパラメータ
+STATE_PARAMS = ("MAX_PH1_COUNT", "MAX_STEPS", "DECAY_RATE")
+PHASES = ["ph1", "ph2", "ph3"]
+GRID_RESULTS_DIR = os.path.join(config.RESULTS_DIR, "grid")
+
+
+def current_params() -> dict:
+    """現在のモジュール定数の値をグリッド点の形式で返す"""
+    return {
+        "USER_STATE_POWER": config.USER_STATE_POWER,
+        "SCORE_ADJUSTMENT": dict(config.ModelConfig.SCORE_ADJUSTMENT),
+        "MAX_PH1_COUNT": UserStateScoreParams.MAX_PH1_COUNT,
+        "MAX_STEPS": UserStateScoreParams.MAX_STEPS,
+        "DECAY_RATE": UserStateScoreParams.DECAY_RATE,
+    }
+
+
+def normalize_point(values: dict) -> dict:
+    """
+    グリッド点の指定を全パラメータの値に展開する
+
+    Args:
+        values: パラメータ名と値（指定しないパラメータは現在の値）
+    Returns:
+        point: GRID_PARAMSの全ての値
+    """
+    unknown = set(values) - set(GRID_PARAMS)
+    if unknown:
+        raise ValueError(
+            f"未知のパラメータです: {', '.join(sorted(unknown))} "
+            f"(指定できるパラメータ: {', '.join(GRID_PARAMS)})"
+        )
+    point = current_params()
+    point.update(values)
+
+    adjustment = values.get("SCORE_ADJUSTMENT")
+    if isinstance(adjustment, (int, float)):
+        point["SCORE_ADJUSTMENT"] = {phase: float(adjustment) for phase in PHASES}
+    elif isinstance(adjustment, dict):
+        point["SCORE_ADJUSTMENT"] = {
+            **current_params()["SCORE_ADJUSTMENT"],
+            **adjustment,
+        }
+
+    if "MAX_STEPS" in values and "DECAY_RATE" not in values:
+        point["DECAY_RATE"] = 0.1 ** (1 / point["MAX_STEPS"])
+    return point
+
+
+def expand_grid(params: dict) -> list[dict]:
+    """
+    パラメータごとの値のリストの直積をグリッド点のリストにする
+
+    Args:
+        params: パラメータ名と値のリスト
+    Returns:
+        points: normalize_point済みのグリッド点のリスト
+    """
+    names = list(params)
+    return [
+        normalize_point(dict(zip(names, values)))
+        for values in itertools.product(*(params[name] for name in names))
+    ]
+
+
+@contextmanager
+def model_params(point: dict):
+    """
+    グリッド点のパラメータをモジュール定数に設定し、終了時に元の値に戻す
+
+    Args:
+        point: normalize_pointの戻り値
+    """
+    saved = current_params()
+    _set_params(point)
+    try:
+        yield
+    finally:
+        _set_params(saved)
+
+
+def _set_params(point: dict):
+    config.USER_STATE_POWER = point["USER_STATE_POWER"]
+    config.ModelConfig.SCORE_ADJUSTMENT = dict(point["SCORE_ADJUSTMENT"])
+    UserStateScoreParams.MAX_PH1_COUNT = point["MAX_PH1_COUNT"]
+    UserStateScoreParams.MAX_STEPS = point["MAX_STEPS"]
+    UserStateScoreParams.DECAY_RATE = point["DECAY_RATE"]
+
+
+def relevant_params(policy_name: str, decay_flag: bool) -> tuple[str, ...]:
+    """
+    設定の結果が依存するパラメータを返す
+
+    - baseline: ランキングはユーザ状態に依存しない
+    - proposed: ランキングはΔ（STATE_PARAMS）に依存する
+    - 減衰あり: 成功確率の倍率（STATE_PARAMSとSCORE_ADJUSTMENT）に依存する
+    - その他の方策: 依存関係が分からないため全てのパラメータに依存するものとして扱う
+
+    USER_STATE_POWERは現在どの計算からも参照されないため、baseline・proposedは依存しないものとして扱う。
+
+    Args:
+        policy_name: 設定で使う方策名（config_policyの戻り値）
+        decay_flag: 減衰フラグ
+    Returns:
+        names: 依存するパラメータ名（GRID_PARAMSの順）
+    """
+    policy_class = POLICIES[policy_name]
+    if policy_class not in (BaselinePolicy, ProposedPolicy):
+        return GRID_PARAMS
+    names = set()
+    if policy_class is ProposedPolicy:
+        names.update(STATE_PARAMS)
+    if decay_flag:
+        names.update(STATE_PARAMS)
+        names.add("SCORE_ADJUSTMENT")
+    return tuple(name for name in GRID_PARAMS if name in names)
+
+
+@dataclass
+class GridTask:
+    """
+    実行する1設定（結果が同じになる設定をまとめたもの）
+
+    Attributes:
+        lambda_val (float): 将来マッチング重視パラメータλ
+        decay_flag (bool): 減衰フラグ
+        policy_name (str): 方策名
+        point (dict): 実行時に設定するパラメータ（この設定を使うグリッド点のうち最初のもの）
+    """
+
+    lambda_val: float
+    decay_flag: bool
+    policy_name: str
+    point: dict
+
+
+def task_key(policy_name: str, lambda_val: float, decay_flag: bool, point: dict):
+    """結果が同じになる設定で一致するキー"""
+    values = tuple(
+        (
+            name,
+            (
+                tuple(sorted(point[name].items()))
+                if isinstance(point[name], dict)
+                else point[name]
+            ),
+        )
+        for name in relevant_params(policy_name, decay_flag)
+    )
+    return (policy_name, lambda_val, decay_flag, values)
+
+
+def plan_tasks(
+    points: list[dict],
+    lambda_values: list[float],
+    decay_flags: list[bool],
+    policy: str = PROPOSED,
+) -> tuple[list[GridTask], dict]:
+    """
+    グリッド点と (λ, 減衰フラグ) の全組み合わせから、実行する設定を重複なく求める
+
+    Args:
+        points: グリッド点のリスト
+        lambda_values: λのリスト
+        decay_flags: 減衰フラグのリスト
+        policy: λ≠0の設定で使う方策名
+    Returns:
+        tuple[list[GridTask], dict]:
+            実行する設定のリストと、(グリッド点の番号, λ, 減衰フラグ) から設定の番号への対応
+    """
+    tasks = []
+    task_index = {}
+    assignments = {}
+    for point_idx, point in enumerate(points):
+        for decay_flag in decay_flags:
+            for lambda_val in lambda_values:
+                policy_name = config_policy(policy, lambda_val)
+                key = task_key(policy_name, lambda_val, decay_flag, point)
+                if key not in task_index:
+                    task_index[key] = len(tasks)
+                    tasks.append(GridTask(lambda_val, decay_flag, policy_name, point))
+                assignments[(point_idx, lambda_val, decay_flag)] = task_index[key]
+    return tasks, assignments
+
+
+def prepare_task_policies(tasks: list[GridTask]) -> list[RankingPolicy]:
+    """
+    設定ごとの方策のインスタンスを作成し、その設定のパラメータで事前計算を行います
+
+    Returns:
+        policies: tasksと同じ順序の準備済みの方策
+    """
+    policies = []
+    for task in tasks:
+        with model_params(task.point):
+            policy = get_policy(task.policy_name)
+            policy.prepare()
+        policies.append(policy)
+    return policies
+
+
+def run_grid_trial(
+    trial: int,
+    tasks: list[GridTask],
+    engine: str,
+    data_format: str,
+    outcome_rng: str = "sequential",
+    envelope: bool = False,
+    user_range: range | None = None,
+    policies: list[RankingPolicy] | None = None,
+) -> tuple[list[dict], float]:
+    """
+    1試行分のデータを1度だけ読み込み、全ての設定をそれぞれのパラメータで実行します
+
+    Args:
+        trial: 実験試行回数
+        tasks: 実行する設定のリスト
+        engine: 実験エンジン
+        data_format: 試行データの形式
+        outcome_rng: 成否判定の乱数
+        envelope: proposedの設定に包絡線インデックスを使用するかどうか
+        user_range: 実験するユーザーIDの範囲（Noneの場合は全ユーザー）
+        policies: prepare_task_policiesで準備した設定ごとの方策（Noneの場合はこの試行で作成して準備する）
+    Returns:
+        tuple[list[dict], float]: 設定ごとの試行結果（run_trial_configsと同じ形式）とデータ読み込み時間
+    """
+    logger = logging.getLogger(__name__)
+    if policies is None:
+        policies = prepare_task_policies(tasks)
+    trial_seed = config.RANDOM_SEED + trial
+    first_user = 0
+    if user_range is None:
+        logger.info(f"試行 {trial + 1} を開始 ({len(tasks)} 設定)")
+    else:
+        trial_seed = shard_seed(trial_seed, user_range)
+        first_user = user_range.start
+
+    # 読み込み・baselineランキング・包絡線インデックスはパラメータに依存しない
+    with_baseline = any(task.policy_name == BASELINE for task in tasks)
+    with_envelope = envelope and any(task.policy_name == PROPOSED for task in tasks)
+    load_start = time.time()
+    trial_data = load_trial(
+        trial,
+        engine,
+        data_format,
+        with_baseline,
+        with_envelope=with_envelope,
+        user_range=user_range,
+    )
+    load_time = time.time() - load_start
+
+    outcome_uniforms = None
+    if outcome_rng != "sequential":
+        outcome_uniforms = OutcomeUniforms(
+            trial, antithetic=outcome_rng == "antithetic", first_user=first_user
+        )
+
+    records = []
+    for task_idx, task in enumerate(tasks):
+        task_start = time.time()
+        with model_params(task.point):
+            trial_results, step_counts = run_trial(
+                trial_data,
+                task.lambda_val,
+                task.decay_flag,
+                engine,
+                trial_seed,
+                task_idx == len(tasks) - 1,
+                outcome_uniforms=outcome_uniforms,
+                policy=policies[task_idx],
+            )
+        records.append(
+            {
+                "results": trial_results,
+                "step_counts": step_counts,
+                "execution_time": time.time() - task_start + load_time / len(tasks),
+                "profile": None,
+            }
+        )
+    return records, load_time
+
+
+def run_grid(
+    points: list[dict],
+    lambda_values: list[float],
+    decay_flags: list[bool],
+    engine: str = "vectorized",
+    data_format: str = "npy",
+    workers: int = 1,
+    num_trials: int | None = None,
+    outcome_rng: str = "sequential",
+    policy: str = PROPOSED,
+    envelope: bool = False,
+    shard_size: int | None = None,
+) -> dict:
+    """
+    グリッド点と (λ, 減衰フラグ) の全組み合わせで実験を実行します
+
+    Args:
+        points: グリッド点のリスト（expand_gridの戻り値）
+        lambda_values: λのリスト
+        decay_flags: 減衰フラグのリスト
+        engine: 実験エンジン
+        data_format: 試行データの形式
+        workers: 試行を並列実行するプロセス数（1の場合は逐次実行）
+        num_trials: 試行回数（Noneの場合はTRIAL_NUM）
+        outcome_rng: 成否判定の乱数（"crn", "antithetic", "sequential"）
+        policy: λ≠0の設定で使うランキング方策の登録名
+        envelope: proposedの設定に包絡線インデックスを使用するかどうか
+        shard_size: ユーザーを分割するシャードの人数（Noneの場合は分割しない）
+    Returns:
+        grid_results: グリッド点ごとの設定別の実験結果（points）と、共有による実行数の削減（tasks）
+    """
+    logger = logging.getLogger(__name__)
+    num_trials = num_trials or config.TRIAL_NUM
+    tasks, assignments = plan_tasks(points, lambda_values, decay_flags, policy)
+    logger.info(
+        f"グリッド点 {len(points)} × 設定 {len(lambda_values) * len(decay_flags)} = "
+        f"{len(assignments)} のうち、結果が異なる {len(tasks)} 設定を実行します"
+    )
+
+    # 方策の事前計算（状態価値など）は設定ごとに、ワーカーを起動する前に1度だけ行う
+    run_tasks = partial(
+        run_grid_trial,
+        tasks=tasks,
+        engine=engine,
+        data_format=data_format,
+        outcome_rng=outcome_rng,
+        envelope=envelope,
+        policies=prepare_task_policies(tasks),
+    )
+    user_ranges = shard_ranges(config.USER_NUM, shard_size)
+    calls = [
+        partial(run_tasks, trial, user_range=user_range)
+        for trial in range(num_trials)
+        for user_range in user_ranges
+    ]
+    start = time.time()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(call) for call in calls]
+            outputs = [future.result() for future in futures]
+    else:
+        outputs = [call() for call in calls]
+    elapsed = time.time() - start
+
+    # task_records[task][trial]: 設定ごとの試行結果
+    task_records = [[] for _ in tasks]
+    for trial in range(num_trials):
+        shard_outputs = outputs[
+            trial * len(user_ranges) : (trial + 1) * len(user_ranges)
+        ]
+        trial_records = merge_shard_records([records for records, _ in shard_outputs])
+        for task_idx, record in enumerate(trial_records):
+            task_records[task_idx].append(record)
+
+    point_results = []
+    for point_idx, point in enumerate(points):
+        results = []
+        for decay_flag in decay_flags:
+            for lambda_val in lambda_values:
+                task_idx = assignments[(point_idx, lambda_val, decay_flag)]
+                with model_params(point):
+                    hash_value = config_hash(
+                        lambda_val,
+                        decay_flag,
+                        engine,
+                        data_format,
+                        outcome_rng,
+                        policy,
+                        shard_size,
+                    )
+                results.append(
+                    _config_results(
+                        task_records[task_idx],
+                        lambda_val,
+                        decay_flag,
+                        engine,
+                        outcome_rng,
+                        config_policy(policy, lambda_val),
+                        hash_value,
+                        task_idx,
+                    )
+                )
+        _add_metrics(results)
+        point_results.append({"params": point, "results": results})
+
+    logger.info(f"グリッドの実行が完了しました ({elapsed:.2f}秒)")
+    return {
+        "points": point_results,
+        "tasks": {"total": len(assignments), "executed": len(tasks)},
+        "execution_time": elapsed,
+    }
+
+
+def _config_results(
+    records: list[dict],
+    lambda_val: float,
+    decay_flag: bool,
+    engine: str,
+    outcome_rng: str,
+    policy_name: str,
+    hash_value: str,
+    task_idx: int,
+) -> dict:
+    """1設定分の試行結果をrun_sweepと同じ形式にまとめます"""
+    config_results = {
+        "lambda": lambda_val,
+        "decay_flag": decay_flag,
+        "engine": engine,
+        "outcome_rng": outcome_rng,
+        "policy": policy_name,
+        "config_hash": hash_value,
+        # 結果を共有した設定は同じtaskの番号を持つ
+        "task": task_idx,
+        "trials": [record["results"] for record in records],
+        "execution_time": sum(record["execution_time"] for record in records),
+        "num_trials": len(records),
+    }
+    config_results["average"] = summarize_trials(config_results)
+    config_results["history"], config_results["average_history"] = summarize_history(
+        [record["step_counts"] for record in records]
+    )
+    return config_results
+
+
+def _add_metrics(results: list[dict]):
+    """同じグリッド点・減衰フラグのλ=0をbaselineとして比較指標を追加します"""
+    baselines = {
+        config_results["decay_flag"]: config_results
+        for config_results in results
+        if config_results["lambda"] == 0
+    }
+    for config_results in results:
+        baseline_results = baselines.get(config_results["decay_flag"])
+        if baseline_results is None or baseline_results is config_results:
+            continue
+        config_results["metrics"] = calculate_metrics(
+            baseline_results["average"],
+            config_results["average"],
+            {
+                "baseline": baseline_results["average_history"],
+                "proposed": config_results["average_history"],
+            },
+        )
+
+
+def load_grid(path: str) -> dict:
+    """
+    グリッドの定義（JSON）を読み込む
+
+    Returns:
+        grid: params（パラメータ名と値のリスト）、lambda_values、decay_flags
+    """
+    with open(path) as f:
+        grid = json.load(f)
+    grid.setdefault("params", {})
+    grid.setdefault("lambda_values", [0, 0.1])
+    grid.setdefault("decay_flags", [True])
+    return grid
+
+
+def save_grid_results(grid: dict, grid_results: dict, settings: dict) -> str:
+    """グリッドの定義・実行設定と結果をJSONで保存し、保存先を返します"""
+    os.makedirs(GRID_RESULTS_DIR, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = os.path.join(GRID_RESULTS_DIR, f"grid_{timestamp}.json")
+    with open(path, "w") as f:
+        json.dump({"grid": grid, "settings": settings, **grid_results}, f, indent=2)
+    return path
+
+
+def save_grid_run(store: ResultsStore, grid_results: dict) -> str:
+    """
+    全グリッド点の結果を結果データベースに1回の実行（種類GRID）として追記し、実行IDを返します
+
+    同じ (減衰フラグ, λ) の設定がグリッド点の数だけ含まれるため、query_averagesは
+    run_idとconfig_hashを指定した場合のみこの実行を集計します。
+    """
+    return store.save_run(
+        [
+            config_results
+            for point in grid_results["points"]
+            for config_results in point["results"]
+        ],
+        kind=GRID,
+    )
+
+
+def parse_arguments():
+    """コマンドライン引数をパースします"""
+    parser = argparse.ArgumentParser(description="パラメータ感度分析のグリッド実行")
+    parser.add_argument("--grid", required=True, help="グリッドの定義 (JSON)")
+    parser.add_argument(
+        "--engine",
+        choices=["loop", "vectorized"],
+        default="vectorized",
+        help="実験エンジン",
+    )
+    parser.add_argument(
+        "--data_format",
+        choices=["csv", "npy", "generated"],
+        default="npy",
+        help="試行データの形式",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="試行を並列実行するプロセス数 (1の場合は逐次実行)",
+    )
+    parser.add_argument(
+        "--trials", type=int, default=None, help="試行回数 (デフォルト: TRIAL_NUM)"
+    )
+    parser.add_argument(
+        "--outcome_rng",
+        choices=["crn", "antithetic", "sequential"],
+        default="sequential",
+        help="成否判定の乱数 (experiment.pyと同じ)",
+    )
+    parser.add_argument(
+        "--policy", default=PROPOSED, help="λ≠0の設定で使うランキング方策の登録名"
+    )
+    parser.add_argument(
+        "--policy_module",
+        nargs="+",
+        default=[],
+        help="方策を登録するモジュール",
+    )
+    parser.add_argument(
+        "--envelope_index",
+        action="store_true",
+        help="proposedの設定に包絡線インデックスを使用する (vectorizedエンジンのみ)",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=None,
+        help="ユーザーをこの人数ずつのシャードに分けて実行する",
+    )
+    parser.add_argument(
+        "--results_db",
+        default=RESULTS_DB,
+        help="実験結果を追記するSQLiteデータベース (デフォルト: results/results.db)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    """メイン関数"""
+    args = parse_arguments()
+    logger = setup_logger()
+
+    try:
+        load_policy_modules(args.policy_module)
+        get_policy(args.policy)
+        grid = load_grid(args.grid)
+        points = expand_grid(grid["params"])
+        grid_results = run_grid(
+            points,
+            grid["lambda_values"],
+            grid["decay_flags"],
+            args.engine,
+            args.data_format,
+            args.workers,
+            args.trials,
+            args.outcome_rng,
+            args.policy,
+            args.envelope_index,
+            args.shard_size,
+        )
+        path = save_grid_results(grid, grid_results, vars(args))
+        logger.info(f"結果を保存しました: {path}")
+        with ResultsStore(args.results_db) as store:
+            run_id = save_grid_run(store, grid_results)
+        logger.info(f"結果を保存しました: {args.results_db} (run_id = {run_id})")
+    except Exception as e:
+        logger.error(f"エラーが発生しました: {e}", exc_info=True)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ユーザ状態グリッド上の状態価値（lookahead方策用）
+
+ユーザ状態 (ph1_count, steps_since_last_ph1) はそれぞれMAX_PH1_COUNT, MAX_STEPSで頭打ちになるため、
+(MAX_PH1_COUNT + 1) × (MAX_STEPS + 1) のグリッド上の遷移として扱える。
+推薦したアイテムのph1が成功すると (c + 1, 0)、失敗すると (c, t + 1) に遷移し、ph3が成功すると終了する。
+
+各状態の価値V(c, t)を、候補集合がitem_samplesの分布に従う場合に、以降も価値が最大のアイテムを推薦し続けたときの
+割引後のph3成功確率の期待値として値反復で求める。
+
+    Q(s, i) = p123 + γ·((p1 - p123)·V(c + 1, 0) + (1 - p1)·V(c, t + 1))
+    V(s) = E_候補集合[max_i Q(s, i)]
+
+p1, p123はアイテムのスコアにユーザ状態スコアのSCORE_ADJUSTMENT乗を掛けた成功確率（減衰ありのモデル）。
+遷移は c が減らず、c が同じなら t が減らないため、(c, t) の降順に更新すると1回の走査で収束する。
+自己遷移がある (c, MAX_STEPS) と (MAX_PH1_COUNT, 0) の行のみ反復して固定点を求める。
+
+結果はUserStateScoreParams・SCORE_ADJUSTMENTと解法の設定をキーとして、ディスクにキャッシュする。
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+import config  # noqa: E402
+from utils.utils import UserStateScoreParams, get_user_state_score_tables  # noqa: E402
+
+CACHE_DIR = os.path.join(config.RESULTS_DIR, "cache")
+
+# 候補集合の標本数（期待値の計算に使う）
+NUM_SAMPLES = 256
+# 候補のスコアの上限（create_data.pyと同じ一様分布 [0, 0.1]）
+SCORE_SCALE = 0.1
+# 固定点の反復の収束判定
+TOLERANCE = 1e-12
+MAX_ITERATIONS = 100000
+# 解法を変更した場合はこの値を変えてキャッシュを無効にする
+SOLVER_VERSION = 1
+
+
+class StateValues:
+    """
+    ユーザ状態グリッド上の状態価値
+
+    Attributes:
+        values (np.ndarray): shape (MAX_PH1_COUNT + 1, MAX_STEPS + 1) の状態価値
+        discount (float): 割引率γ
+        key (dict): 解法の設定とパラメータ
+    """
+
+    def __init__(self, values: np.ndarray, discount: float, key: dict):
+        self.values = values
+        self.discount = discount
+        self.key = key
+
+    def next_values(
+        self, ph1_counts: np.ndarray, steps: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        ph1の成功・失敗後の状態の価値を参照する
+
+        Args:
+            ph1_counts: ph1の累計数の配列（非負整数）
+            steps: 最後のph1からの経過ステップ数の配列（非負整数）
+        Returns:
+            tuple[np.ndarray, np.ndarray]: 成功後 V(c + 1, 0) と失敗後 V(c, t + 1) の価値
+        """
+        max_ph1_count = self.values.shape[0] - 1
+        max_steps = self.values.shape[1] - 1
+        ph1_counts = np.minimum(ph1_counts, max_ph1_count)
+        steps = np.minimum(steps, max_steps)
+        success = self.values[np.minimum(ph1_counts + 1, max_ph1_count), 0]
+        failure = self.values[ph1_counts, np.minimum(steps + 1, max_steps)]
+        return success, failure
+
+
+def default_discount() -> float:
+    """実験ステップ数を実質的な期間とする割引率 1 - 1 / EXPERIMENT_STEPS"""
+    return 1 - 1 / config.EXPERIMENT_STEPS
+
+
+def sample_item_sets(
+    num_samples: int = NUM_SAMPLES,
+    num_items: int | None = None,
+    seed: int | None = None,
+) -> np.ndarray:
+    """
+    create_data.pyと同じ分布の候補集合を生成する
+
+    Returns:
+        item_samples: shape (num_samples, num_items, 3) のph1~3スコア
+    """
+    num_items = config.ITEM_NUM if num_items is None else num_items
+    seed = config.RANDOM_SEED if seed is None else seed
+    rng = np.random.default_rng(seed)
+    return np.round(rng.random((num_samples, num_items, 3)) * SCORE_SCALE, 4)
+
+
+def _expected_value(
+    item_samples: np.ndarray,
+    multipliers: np.ndarray,
+    success_value: float,
+    failure_value: float,
+    discount: float,
+) -> float:
+    """1状態のE[max_i Q(s, i)]"""
+    probs = np.minimum(item_samples * multipliers, 1.0)
+    p1 = probs[..., 0]
+    p123 = p1 * probs[..., 1] * probs[..., 2]
+    q = p123 + discount * ((p1 - p123) * success_value + (1 - p1) * failure_value)
+    return float(q.max(axis=-1).mean())
+
+
+def _solve_row(
+    item_samples: np.ndarray,
+    multipliers: np.ndarray,
+    success_value: float | None,
+    discount: float,
+    initial: float,
+) -> np.ndarray:
+    """
+    ph1_countが同じ1行の状態価値を求める
+
+    Args:
+        item_samples: 候補集合の標本
+        multipliers: shape (MAX_STEPS + 1, 3) のこの行のユーザ状態スコアのSCORE_ADJUSTMENT乗
+        success_value: ph1成功後の状態 (c + 1, 0) の価値（Noneの場合はこの行の (c, 0)）
+        discount: 割引率γ
+        initial: 固定点の反復の初期値
+    Returns:
+        row: shape (MAX_STEPS + 1,) の状態価値
+    """
+    max_steps = multipliers.shape[0] - 1
+    row = np.empty(max_steps + 1)
+    start = initial
+    for _ in range(MAX_ITERATIONS):
+        target = start if success_value is None else success_value
+        # t = MAX_STEPS は失敗すると同じ状態に戻るため、固定点を反復で求める
+        value = initial
+        for _ in range(MAX_ITERATIONS):
+            updated = _expected_value(
+                item_samples, multipliers[max_steps], target, value, discount
+            )
+            converged = abs(updated - value) <= TOLERANCE
+            value = updated
+            if converged:
+                break
+        row[max_steps] = value
+        for step in range(max_steps - 1, -1, -1):
+            row[step] = _expected_value(
+                item_samples, multipliers[step], target, row[step + 1], discount
+            )
+        # 最後の行は成功すると (MAX_PH1_COUNT, 0) に戻るため、その価値が収束するまで反復する
+        if success_value is not None or abs(row[0] - start) <= TOLERANCE:
+            break
+        start = row[0]
+    return row
+
+
+def solve_state_values(item_samples: np.ndarray, discount: float) -> np.ndarray:
+    """
+    値反復で状態価値を求める
+
+    Args:
+        item_samples: shape (samples, items, 3) の候補集合の標本
+        discount: 割引率γ（1未満）
+    Returns:
+        values: shape (MAX_PH1_COUNT + 1, MAX_STEPS + 1) の状態価値
+    """
+    multipliers = get_user_state_score_tables().multipliers
+    max_ph1_count = multipliers.shape[0] - 1
+    values = np.empty(multipliers.shape[:2])
+    values[max_ph1_count] = _solve_row(
+        item_samples, multipliers[max_ph1_count], None, discount, 0.0
+    )
+    for ph1_count in range(max_ph1_count - 1, -1, -1):
+        values[ph1_count] = _solve_row(
+            item_samples,
+            multipliers[ph1_count],
+            values[ph1_count + 1, 0],
+            discount,
+            values[ph1_count + 1, -1],
+        )
+    return values
+
+
+def state_values_key(
+    discount: float, num_samples: int, num_items: int, seed: int
+) -> dict:
+    """キャッシュのキー（状態価値に影響するパラメータと解法の設定）"""
+    return {
+        "MAX_PH1_COUNT": UserStateScoreParams.MAX_PH1_COUNT,
+        "MAX_STEPS": UserStateScoreParams.MAX_STEPS,
+        "BASE_SCORE": UserStateScoreParams.BASE_SCORE,
+        "MAX_SCORE_MULTIPLIER": UserStateScoreParams.MAX_SCORE_MULTIPLIER,
+        "DECAY_RATE": UserStateScoreParams.DECAY_RATE,
+        "SCORE_ADJUSTMENT": dict(config.ModelConfig.SCORE_ADJUSTMENT),
+        "discount": discount,
+        "num_samples": num_samples,
+        "num_items": num_items,
+        "seed": seed,
+        "score_scale": SCORE_SCALE,
+        "version": SOLVER_VERSION,
+    }
+
+
+def cache_path(key: dict, cache_dir: str = CACHE_DIR) -> str:
+    encoded = json.dumps(key, sort_keys=True).encode("utf-8")
+    hash_value = hashlib.sha256(encoded).hexdigest()[:16]
+    return os.path.join(cache_dir, f"state_values_{hash_value}.npz")
+
+
+# プロセス内のキャッシュ（キャッシュファイルのパスをキーとする）
+_state_values = {}
+
+
+def get_state_values(
+    discount: float | None = None,
+    num_samples: int = NUM_SAMPLES,
+    num_items: int | None = None,
+    seed: int | None = None,
+    cache_dir: str = CACHE_DIR,
+    force: bool = False,
+) -> StateValues:
+    """
+    状態価値を取得する（キャッシュがなければ求めて保存する）
+
+    Args:
+        discount: 割引率γ（Noneの場合は1 - 1 / EXPERIMENT_STEPS）
+        num_samples: 候補集合の標本数
+        num_items: 1集合の候補数（Noneの場合はITEM_NUM）
+        seed: 標本の乱数シード（Noneの場合はRANDOM_SEED）
+        cache_dir: キャッシュの保存先
+        force: キャッシュを使わずに求め直すかどうか
+    Returns:
+        state_values: StateValues
+    """
+    discount = default_discount() if discount is None else discount
+    num_items = config.ITEM_NUM if num_items is None else num_items
+    seed = config.RANDOM_SEED if seed is None else seed
+    key = state_values_key(discount, num_samples, num_items, seed)
+    path = cache_path(key, cache_dir)
+
+    if not force and path in _state_values:
+        return _state_values[path]
+    if not force and os.path.exists(path):
+        with np.load(path) as cached:
+            if json.loads(str(cached["key"])) == key:
+                _state_values[path] = StateValues(cached["values"], discount, key)
+                return _state_values[path]
+
+    item_samples = sample_item_sets(num_samples, num_items, seed)
+    values = solve_state_values(item_samples, discount)
+    os.makedirs(cache_dir, exist_ok=True)
+    # 一時ファイルに書き込んでから置き換え、並列実行時も不完全なファイルを読まないようにする
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, values=values, key=json.dumps(key, sort_keys=True))
+    os.replace(tmp_path, path)
+    _state_values[path] = StateValues(values, discount, key)
+    return _state_values[path]
+
+
+def parse_arguments():
+    """コマンドライン引数をパースします"""
+    parser = argparse.ArgumentParser(
+        description="lookahead方策の状態価値を求めてキャッシュする"
+    )
+    parser.add_argument(
+        "--discount",
+        type=float,
+        default=None,
+        help="割引率 (デフォルト: 1 - 1 / EXPERIMENT_STEPS)",
+    )
+    parser.add_argument(
+        "--num_samples", type=int, default=NUM_SAMPLES, help="候補集合の標本数"
+    )
+    parser.add_argument("--cache_dir", default=CACHE_DIR, help="キャッシュの保存先")
+    parser.add_argument(
+        "--force", action="store_true", help="キャッシュがあっても求め直す"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    start = time.perf_counter()
+    state_values = get_state_values(
+        args.discount, args.num_samples, cache_dir=args.cache_dir, force=args.force
+    )
+    elapsed = time.perf_counter() - start
+    values = state_values.values
+    print(f"状態価値 ({elapsed:.2f}秒, γ = {state_values.discount:.4f}):")
+    print(f"  V(0, 0) = {values[0, 0]:.6f}, V(0, MAX_STEPS) = {values[0, -1]:.6f}")
+    print(f"  V(MAX_PH1_COUNT, 0) = {values[-1, 0]:.6f}")
+    print(f"  範囲: [{values.min():.6f}, {values.max():.6f}]")
+    print(f"保存先: {cache_path(state_values.key, args.cache_dir)}")
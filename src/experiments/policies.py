@@ -0,0 +1,304 @@
+"""
+ランキング方策の登録と選択
+
+方策は (ユーザ, 候補アイテム) の集合をまとめて配列として受け取り、候補のスコアまたは上位k件を返す。
+register_policyで登録した方策は`experiment.py --policy`で選択でき、実験ループを変更せずに追加できる。
+
+方策は以下を実装する（RankingPolicyを継承し、必要なものだけを上書きする）:
+
+- features(users): ユーザ状態から計算する特徴量（proposedではΔ）。ランキングの前に1度だけ計算される
+- score(items, features, lambda_val): shape (users, items) のスコア。rankはスコアの上位k件を選ぶ
+- rank(item_scores, users, features, lambda_val, top_k): 上位k件を直接求める場合に上書きする
+
+loopエンジンではrank_userで1ユーザずつ呼び出す。デフォルトの実装は候補を配列に変換してrankを呼ぶため、
+新しい方策は配列版だけを実装すればよい。
+"""
+
+import importlib
+import os
+import sys
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from config import TOP_K, ModelConfig  # noqa: E402
+from experiments.lookahead import get_state_values  # noqa: E402
+from models.models import Item, ItemBatch, User, UserBatch  # noqa: E402
+from utils.utils import (  # noqa: E402
+    get_phase_multipliers_array,
+    get_user_state_score_delta,
+    get_user_state_score_deltas,
+)
+
+BASELINE = "baseline"
+PROPOSED = "proposed"
+LOOKAHEAD = "lookahead"
+
+# 方策名と方策クラス
+POLICIES: dict[str, type] = {}
+
+
+def register_policy(name: str):
+    """
+    方策クラスを登録するデコレータ
+
+    Args:
+        name: `--policy`で指定する方策名
+    """
+
+    def decorator(cls):
+        if name in POLICIES:
+            raise ValueError(f"方策 {name} は登録済みです")
+        cls.name = name
+        POLICIES[name] = cls
+        return cls
+
+    return decorator
+
+
+def get_policy(name: str) -> "RankingPolicy":
+    """登録済みの方策のインスタンスを返す"""
+    if name not in POLICIES:
+        raise ValueError(
+            f"未登録の方策です: {name} (登録済み: {', '.join(sorted(POLICIES))})"
+        )
+    return POLICIES[name]()
+
+
+def load_policy_modules(module_names: list[str]):
+    """
+    方策を登録するモジュールを読み込む
+
+    Args:
+        module_names: インポートするモジュール名（srcからの相対、またはsys.path上のモジュール）
+    """
+    for module_name in module_names:
+        importlib.import_module(module_name)
+
+
+def config_policy(policy_name: str, lambda_val: float) -> str:
+    """
+    設定 (λ, 減衰フラグ) で使う方策名を返す
+
+    λ=0の設定は比較の基準となるbaselineとして実行する。
+    """
+    return BASELINE if lambda_val == 0 else policy_name
+
+
+def select_top_k(scores: np.ndarray, top_k: int = TOP_K) -> np.ndarray:
+    """
+    各行のスコアの上位top_k件のインデックスを返す（同点は若いインデックスを優先する）
+
+    Args:
+        scores: shape (rows, items) のスコア（候補にしない要素は-inf）
+        top_k: 選ぶアイテム数
+    Returns:
+        top_k_indices: shape (rows, min(top_k, items)) のアイテムインデックス（スコア降順）
+    """
+    num_items = scores.shape[1]
+    if top_k == 1:
+        return np.argmax(scores, axis=1)[:, None]
+
+    if top_k < num_items:
+        # argpartitionは同点の扱いが不定なため、候補を絞ってから安定ソートする
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        kth = np.take_along_axis(scores, candidates, axis=1).min(axis=1)
+        scores = np.where(scores >= kth[:, None], scores, -np.inf)
+
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return order[:, : min(top_k, num_items)]
+
+
+class RankingPolicy:
+    """
+    ランキング方策の基底クラス
+
+    Attributes:
+        name (str): 登録名（register_policyで設定される）
+        state_dependent (bool): ユーザ状態に依存するかどうか。Falseの場合featuresは呼ばれない
+    """
+
+    name = None
+    state_dependent = True
+
+    def prepare(self):
+        """
+        事前計算を行う（実験の開始前にメインプロセスで1度呼ばれる）
+
+        準備したインスタンスがそのまま各試行（ワーカープロセス）に渡されるため、結果はインスタンスの属性に保持する。
+        """
+
+    def features(self, users: UserBatch) -> np.ndarray | None:
+        """
+        ユーザ状態から特徴量を計算する
+
+        Args:
+            users: 未終了のユーザ
+        Returns:
+            features: shape (users, ...) の特徴量（使わない場合はNone）
+        """
+        return None
+
+    def score(
+        self, items: ItemBatch, features: np.ndarray | None, lambda_val: float
+    ) -> np.ndarray:
+        """
+        候補アイテムのスコアを計算する
+
+        Args:
+            items: 列のshapeが (users, items) の候補アイテム
+            features: featuresの戻り値
+            lambda_val: 将来マッチング重視パラメータλ
+        Returns:
+            scores: shape (users, items) のスコア
+        """
+        raise NotImplementedError
+
+    def rank(
+        self,
+        item_scores: np.ndarray,
+        users: UserBatch,
+        features: np.ndarray | None,
+        lambda_val: float,
+        top_k: int = TOP_K,
+    ) -> np.ndarray:
+        """
+        全ユーザの候補アイテムを一括でランキングする
+
+        Args:
+            item_scores: shape (users, items, 3) のph1~3スコア
+            users: 未終了のユーザ（item_scoresと同じ順）
+            features: featuresの戻り値
+            lambda_val: 将来マッチング重視パラメータλ
+            top_k: 推薦するアイテム数
+        Returns:
+            top_k_indices: shape (users, top_k) のアイテムインデックス（スコア降順）
+        """
+        scores = self.score(ItemBatch.from_scores(item_scores), features, lambda_val)
+        return select_top_k(scores, top_k)
+
+    def user_features(self, user: User):
+        """1ユーザ分のfeatures（loopエンジン用）"""
+        if not self.state_dependent:
+            return None
+        features = self.features(UserBatch.from_users([user]))
+        return None if features is None else features[0]
+
+    def rank_user(
+        self,
+        user_items: list[Item],
+        user: User,
+        features,
+        lambda_val: float,
+        top_k: int = TOP_K,
+    ) -> list[Item]:
+        """
+        1ユーザの候補アイテムをランキングする（loopエンジン用）
+
+        Args:
+            user_items: 候補アイテムのリスト
+            user: ユーザ
+            features: user_featuresの戻り値
+            lambda_val: 将来マッチング重視パラメータλ
+            top_k: 推薦するアイテム数
+        Returns:
+            top_k_items: 上位top_k件のアイテム（スコア降順）
+        """
+        if not user_items:
+            return []
+        item_scores = np.array(
+            [[(i.ph1_score, i.ph2_score, i.ph3_score) for i in user_items]],
+            dtype=np.float64,
+        )
+        if features is not None:
+            features = np.asarray(features)[None]
+        indices = self.rank(
+            item_scores, UserBatch.from_users([user]), features, lambda_val, top_k
+        )
+        return [user_items[i] for i in indices[0]]
+
+
+@register_policy(BASELINE)
+class BaselinePolicy(RankingPolicy):
+    """ph1·ph2·ph3（ModelConfig.baseline_score）によるランキング"""
+
+    state_dependent = False
+
+    def score(self, items, features, lambda_val):
+        return ModelConfig.baseline_score(items)
+
+    def rank_user(self, user_items, user, features, lambda_val, top_k=TOP_K):
+        # 参照実装と同じく、1件ずつのスコアで安定ソートする
+        return sorted(user_items, key=ModelConfig.baseline_score, reverse=True)[:top_k]
+
+
+@register_policy(PROPOSED)
+class ProposedPolicy(RankingPolicy):
+    """
+    ph1·ph2·ph3 + λ·ph1·Δ（ModelConfig.proposed_score）によるランキング
+
+    Δはph1実行後のユーザ状態スコアの変化量。λ=0の場合はbaselineと同じランキングになる。
+    """
+
+    def features(self, users):
+        return get_user_state_score_deltas(users.ph1_count, users.last_ph1_step)
+
+    def user_features(self, user):
+        return get_user_state_score_delta(user.ph1_count, user.last_ph1_step)
+
+    def score(self, items, features, lambda_val):
+        if lambda_val == 0:
+            return ModelConfig.baseline_score(items)
+        return ModelConfig.proposed_score(items, features[:, None], lambda_val)
+
+    def rank_user(self, user_items, user, features, lambda_val, top_k=TOP_K):
+        if lambda_val == 0:
+            key = ModelConfig.baseline_score
+        else:
+            key = lambda x: ModelConfig.proposed_score(x, features, lambda_val)
+        return sorted(user_items, key=key, reverse=True)[:top_k]
+
+
+@register_policy(LOOKAHEAD)
+class LookaheadPolicy(RankingPolicy):
+    """
+    状態価値（lookahead.py）を使った多段先読みのランキング
+
+    即時のph3成功確率に、推薦後の遷移先の状態価値の期待値をλ倍して加える。
+
+        p123 + λ·γ·((p1 - p123)·V(c + 1, 0) + (1 - p1)·V(c, t + 1))
+
+    λ=1の場合は状態価値に対して貪欲な方策となる。成功確率は減衰ありのモデル
+    （スコア × ユーザ状態スコアのSCORE_ADJUSTMENT乗）で計算する。
+    状態価値は最初に使うときに読み込み（キャッシュがなければ求め）、ランキングの計算量はproposedと同じ。
+    """
+
+    def __init__(self):
+        self.state_values = None
+
+    def prepare(self):
+        self.state_values = get_state_values()
+
+    def features(self, users):
+        if self.state_values is None:
+            self.prepare()
+        multipliers = get_phase_multipliers_array(users.ph1_count, users.last_ph1_step)
+        success, failure = self.state_values.next_values(
+            users.ph1_count, users.last_ph1_step
+        )
+        return np.column_stack([multipliers, success, failure])
+
+    def score(self, items, features, lambda_val):
+        p1 = np.minimum(items.ph1_score * features[:, 0:1], 1.0)
+        p2 = np.minimum(items.ph2_score * features[:, 1:2], 1.0)
+        p3 = np.minimum(items.ph3_score * features[:, 2:3], 1.0)
+        p123 = p1 * p2 * p3
+        continuation = self.state_values.discount * (
+            (p1 - p123) * features[:, 3:4] + (1 - p1) * features[:, 4:5]
+        )
+        return p123 + lambda_val * continuation
@@ -4,22 +4,18 @@ ROOT_DIR=$(dirname `readlink -f $0`)
 
 # 実験パラメータの設定
 lambda_values=(0 0.001 0.01 0.1 1)
-decay_flags=("" "--no_decay_flag")
 
 # 結果ディレクトリの作成
 mkdir -p $ROOT_DIR/../../results/decay_true
 mkdir -p $ROOT_DIR/../../results/decay_false
 
-# 結果ディレクトリの中のjsonファイルを削除
+# 結果ディレクトリの中のjsonファイルを削除（今回の実行の従来形式のJSONで置き換える）
 rm -f $ROOT_DIR/../../results/decay_true/*.json
 rm -f $ROOT_DIR/../../results/decay_false/*.json
 
-# 各パラメータの組み合わせで実験を実行
-for lambda in "${lambda_values[@]}"; do
-    for decay in "${decay_flags[@]}"; do
-        echo "Running experiment with lambda=$lambda, decay=$decay"
-        python $ROOT_DIR/experiment.py --lambda_value $lambda $decay
-    done
-done
+# 全てのλ値と減衰フラグの組み合わせを1回の実行で評価（試行データの読み込みは試行ごとに1度だけ）
+echo "Running experiments with lambda=(${lambda_values[*]}), decay=(true false)"
+# 結果はデータベースに追記し、results/decay_{true,false}には従来形式のJSONも保存する
+python $ROOT_DIR/experiment.py --lambda_values "${lambda_values[@]}" --both_decay_flags --save_json "$@"
 
 echo "All experiments completed!" 
@@ -0,0 +1,176 @@
+"""
+ユーザーのシャード分割
+
+ユーザー同士は相互作用しないため、ユーザーを固定サイズのシャードに分けて独立に実験し、
+成功回数などのカウンタだけを足し合わせても結果は変わらない（成否判定に共通乱数を使う場合）。
+各プロセスが保持するのは1シャード分の候補だけになるため、ユーザー数に対してメモリ使用量が一定になる。
+
+シャードサイズは直接指定するか、メモリ上限（全プロセスの合計）と1ユーザーあたりのメモリから決める。
+1ユーザーあたりのメモリは実行するエンジン・データ形式・設定で先頭の数人を実行して計測し
+（experiment.measure_user_bytes）、計測しない場合は候補数からの推定値（estimate_user_bytes）を使う。
+"""
+
+import os
+import resource
+import sys
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from config import EXPERIMENT_STEPS, ITEM_NUM  # noqa: E402
+from utils.profiling import StageProfile  # noqa: E402
+
+# 候補アイテム1件あたりの推定メモリ（バイト）
+# loop: Itemオブジェクト、(user, step) ごとのリスト、baselineランキングの合計（実測で約250バイト）
+# vectorized: float64のスコア3つと、baselineランキングや候補の圧縮による一時配列
+CANDIDATE_BYTES = {"loop": 256, "vectorized": 48}
+# シャードのデータ以外に1プロセスが使うメモリ（インタプリタとNumPy）
+PROCESS_BASE_MB = 64
+# 1ユーザーあたりのメモリを計測するユーザー数
+MEMORY_SAMPLE_USERS = 32
+
+
+def shard_ranges(num_users: int, shard_size: int | None) -> list[range | None]:
+    """
+    ユーザーIDをシャードに分割する
+
+    Args:
+        num_users: ユーザー数
+        shard_size: 1シャードのユーザー数（Noneの場合は分割しない）
+    Returns:
+        ranges: シャードごとのユーザーIDの範囲（分割しない場合は[None]）
+    """
+    if shard_size is None:
+        return [None]
+    if shard_size < 1:
+        raise ValueError(f"シャードサイズは1以上を指定してください: {shard_size}")
+    return [
+        range(start, min(start + shard_size, num_users))
+        for start in range(0, num_users, shard_size)
+    ]
+
+
+def shard_seed(trial_seed: int, user_range: range) -> int:
+    """
+    シャードごとの乱数シードを返す
+
+    逐次の乱数列（sequential）はシャードごとに独立したシードから作るため、
+    シャードに分割しない場合とは結果が異なる。
+    """
+    seed_sequence = np.random.SeedSequence([trial_seed, user_range.start])
+    return int(seed_sequence.generate_state(1)[0])
+
+
+def estimate_user_bytes(
+    engine: str,
+    data_format: str,
+    num_steps: int = EXPERIMENT_STEPS,
+    num_items: int = ITEM_NUM,
+) -> int:
+    """
+    1ユーザーの試行データが使うメモリを推定する
+
+    Args:
+        engine: 実験エンジン
+        data_format: 試行データの形式
+        num_steps: 実験ステップ数
+        num_items: 各ステップの候補アイテム数
+    Returns:
+        user_bytes: 1ユーザーあたりの推定メモリ（バイト）
+    """
+    if engine == "vectorized" and data_format == "generated":
+        # 候補は各ステップで必要な分だけ生成するため、保持するのは1ステップ分のみ
+        num_candidates = num_items
+    else:
+        num_candidates = num_steps * num_items
+    # CSVはどちらのエンジンでもItemオブジェクトを経由して読み込む
+    per_candidate = CANDIDATE_BYTES["loop" if data_format == "csv" else engine]
+    return num_candidates * per_candidate
+
+
+def shard_size_for_memory(
+    memory_limit_mb: float,
+    workers: int,
+    engine: str,
+    data_format: str,
+    user_bytes: int | None = None,
+) -> int:
+    """
+    メモリ上限に収まるシャードサイズを求める
+
+    各ワーカーは1度に1シャードだけを保持するため、上限からプロセスごとの固定分を引いた残りを
+    ワーカー数で割った範囲に1シャード分の推定メモリが収まるようにする。
+
+    Args:
+        memory_limit_mb: 全プロセスの合計のメモリ上限（MB）
+        workers: 試行を並列実行するプロセス数
+        engine: 実験エンジン
+        data_format: 試行データの形式
+        user_bytes: 1ユーザーあたりのメモリ（バイト）。Noneの場合はestimate_user_bytesの推定値
+    Returns:
+        shard_size: 1シャードのユーザー数
+    """
+    workers = max(workers, 1)
+    # 並列実行ではメインプロセスも結果の集計のために残る
+    num_processes = workers + 1 if workers > 1 else 1
+    available = (memory_limit_mb - PROCESS_BASE_MB * num_processes) * 2**20
+    if user_bytes is None:
+        user_bytes = estimate_user_bytes(engine, data_format)
+    shard_size = int(available / workers // user_bytes)
+    if shard_size < 1:
+        raise ValueError(
+            f"メモリ上限 {memory_limit_mb} MB では {workers} プロセスで実行できません "
+            f"(1プロセスあたり {PROCESS_BASE_MB} MB + 1ユーザーあたり {user_bytes} バイト)"
+        )
+    return shard_size
+
+
+def merge_shard_records(shard_records: list[list[dict]]) -> list[dict]:
+    """
+    シャードごとの試行結果を足し合わせて1試行分の結果にする
+
+    Args:
+        shard_records: シャードごとのrun_trial_configsの試行結果（設定の順序は全シャードで同じ）
+    Returns:
+        records: 設定ごとの試行結果（成功回数・ステップごとの成功回数・実行時間・計測結果の合計）
+    """
+    if len(shard_records) == 1:
+        return shard_records[0]
+
+    records = []
+    for config_records in zip(*shard_records):
+        profiles = [record["profile"] for record in config_records]
+        profile = None
+        if profiles[0] is not None:
+            profile = StageProfile()
+            for shard_profile in profiles:
+                profile.merge(StageProfile.from_dict(shard_profile))
+            profile = profile.to_dict()
+        records.append(
+            {
+                "results": {
+                    phase: sum(record["results"][phase] for record in config_records)
+                    for phase in config_records[0]["results"]
+                },
+                "step_counts": sum(
+                    np.asarray(record["step_counts"]) for record in config_records
+                ),
+                "execution_time": sum(
+                    record["execution_time"] for record in config_records
+                ),
+                "profile": profile,
+            }
+        )
+    return records
+
+
+def peak_rss_mb() -> float:
+    """このプロセスのこれまでの最大常駐メモリ（MB）を返す"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrssの単位はLinuxではKB、macOSではバイト
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
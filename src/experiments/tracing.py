@@ -0,0 +1,498 @@
+"""
+推薦イベントのトレース
+
+実験エンジンにTraceWriterを渡すと、推薦ごとに (試行, ユーザ, ステップ, 推薦枠, アイテム) と
+その時点のユーザ状態・Δ・各フェーズの成功確率・成否を記録する。渡さない場合（None）は
+各エンジンの分岐1つ分のコストしかかからない。
+
+イベントは列ごとの固定長のバッファ（TRACE_BATCH_ROWS行）に追加し、埋まるたびにバックグラウンドの
+スレッドが圧縮した列形式のファイル（np.savez_compressedと同じ、列ごとの.npyを含むzip）として書き出す。
+
+    {trace_dir}/decay_{true,false}/lambda_{λ}/trial_{trial}_{first_user}_{part}.npz
+
+ファイルは1つずつ読み、必要な列だけを展開できるため（iter_trace）、全試行のトレースを
+メモリに載せずに集計できる。
+
+    python src/experiments/tracing.py results/traces --lambda_val 0.1 --decay true --trial 0 --user 12
+"""
+
+import argparse
+import os
+import queue
+import sys
+import threading
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from utils.utils import (  # noqa: E402
+    calculate_user_state_scores,
+    get_user_state_score_deltas,
+)
+
+# 列名とdtype（ph1_count, last_ph1_step, user_state_score, deltaは推薦時点のユーザ状態）
+TRACE_COLUMNS = {
+    "trial": np.int32,
+    "user": np.int32,
+    "step": np.int32,
+    "slot": np.int32,
+    "item": np.int32,
+    "ph1_count": np.int32,
+    "last_ph1_step": np.int32,
+    "user_state_score": np.float64,
+    "delta": np.float64,
+    "ph1_prob": np.float64,
+    "ph2_prob": np.float64,
+    "ph3_prob": np.float64,
+    "ph1": np.bool_,
+    "ph2": np.bool_,
+    "ph3": np.bool_,
+}
+# 1ファイルあたりの行数
+TRACE_BATCH_ROWS = 1 << 16
+# 書き出し待ちのバッチ数の上限（超えた場合は実験側が書き出しを待つ）
+MAX_PENDING_BATCHES = 4
+# zlibの圧縮レベル（高いレベルでもサイズはほとんど変わらないため、速度を優先する）
+TRACE_COMPRESS_LEVEL = 1
+# 圧縮しない列。成功確率はスコアと倍率の積でほぼランダムなビット列になり、圧縮しても数%しか縮まず
+# 書き出し時間の大半を占めるため、そのまま格納する
+STORED_COLUMNS = ("ph1_prob", "ph2_prob", "ph3_prob")
+
+
+def config_trace_dir(trace_dir, lambda_val: float, decay_flag: bool) -> Path:
+    """設定 (λ, 減衰フラグ) のトレースのディレクトリを返す"""
+    return Path(trace_dir) / f"decay_{str(decay_flag).lower()}" / f"lambda_{lambda_val}"
+
+
+def clear_trace_dirs(trace_dir, configs) -> int:
+    """
+    設定ごとのトレースのディレクトリから以前の実行のファイルを削除する
+
+    ファイル名は (試行, シャードの先頭ユーザー, 書き出し順) で決まるため、シャードサイズや1ファイルの行数を
+    変えて同じディレクトリに記録し直すと、以前のファイルが上書きされずに残り、新しいトレースと混ざる。
+
+    Args:
+        trace_dir: トレースのディレクトリ
+        configs: (λ, 減衰フラグ) のリスト
+    Returns:
+        num_removed: 削除したファイル数
+    """
+    num_removed = 0
+    for lambda_val, decay_flag in configs:
+        directory = config_trace_dir(trace_dir, lambda_val, decay_flag)
+        if not directory.is_dir():
+            continue
+        for path in [*directory.glob("trial_*.npz"), *directory.glob("*.tmp")]:
+            path.unlink()
+            num_removed += 1
+    return num_removed
+
+
+class TraceSink:
+    """
+    トレースのバッチを圧縮ファイルに書き出すバックグラウンドスレッド
+
+    with文で使用し、終了時に全てのバッチの書き出しを待つ。書き出し中のエラーは終了時に送出する。
+
+    Attributes:
+        trace_dir (Path): 出力ディレクトリ
+        batch_rows (int): 1ファイルあたりの行数
+    """
+
+    def __init__(self, trace_dir, batch_rows: int = TRACE_BATCH_ROWS):
+        self.trace_dir = Path(trace_dir)
+        self.batch_rows = batch_rows
+        self._writers = []
+        self._queue = queue.Queue(maxsize=MAX_PENDING_BATCHES)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def writer(
+        self,
+        lambda_val: float,
+        decay_flag: bool,
+        trial: int,
+        first_user: int = 0,
+    ) -> "TraceWriter":
+        """
+        1設定・1試行分のイベントを記録するTraceWriterを返す
+
+        Args:
+            lambda_val: 将来マッチング重視パラメータλ
+            decay_flag: 減衰フラグ
+            trial: 試行番号
+            first_user: シャードの先頭のユーザーID（記録するユーザーIDに加える）
+        """
+        directory = config_trace_dir(self.trace_dir, lambda_val, decay_flag)
+        directory.mkdir(parents=True, exist_ok=True)
+        writer = TraceWriter(
+            self, directory / f"trial_{trial}_{first_user}", trial, first_user
+        )
+        self._writers.append(writer)
+        return writer
+
+    def submit(self, path: Path, columns: dict):
+        """バッチを書き出し待ちに追加する"""
+        self._queue.put((path, columns))
+
+    def close(self):
+        """残りのイベントを書き出し、書き出しスレッドの終了を待つ"""
+        for writer in self._writers:
+            writer.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        # 例外で中断した場合は、書き出しスレッドを終了させて元の例外をそのまま送出する
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            path, columns = item
+            try:
+                write_batch(path, columns)
+            except Exception as e:
+                self._error = e
+
+
+def write_batch(path, columns: dict):
+    """
+    列ごとの配列を圧縮したnpzファイルとして書き出す（np.loadで読み込める）
+
+    書き出し中のファイルは一時的な名前にしておき、完了後に置き換えるため、
+    実行中の実験のトレースを読む場合も書きかけのファイルは読まれない。
+
+    Args:
+        path: 出力ファイル
+        columns: 列名と配列の辞書
+    """
+    tmp_path = f"{path}.tmp"
+    with zipfile.ZipFile(
+        tmp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=TRACE_COMPRESS_LEVEL
+    ) as archive:
+        for name, values in columns.items():
+            # ZipInfoで開いた場合はアーカイブの圧縮レベルが使われないため、圧縮しない列のみZipInfoにする
+            entry = f"{name}.npy"
+            if name in STORED_COLUMNS:
+                entry = zipfile.ZipInfo(entry)
+                entry.compress_type = zipfile.ZIP_STORED
+            with archive.open(entry, "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, values, allow_pickle=False)
+    os.replace(tmp_path, path)
+
+
+class TraceWriter:
+    """
+    1設定・1試行分のイベントを列ごとの固定長バッファに追加する
+
+    vectorizedエンジンはappendで推薦枠ごとに全ユーザ分を、loopエンジンはappend_rowで1件ずつ追加する。
+    """
+
+    def __init__(self, sink: TraceSink, prefix: Path, trial: int, first_user: int):
+        self.sink = sink
+        self.prefix = prefix
+        self.trial = trial
+        self.first_user = first_user
+        self.num_parts = 0
+        self._rows = []
+        self._new_buffer()
+
+    def _new_buffer(self):
+        self._buffer = {
+            name: np.empty(self.sink.batch_rows, dtype=dtype)
+            for name, dtype in TRACE_COLUMNS.items()
+        }
+        self._size = 0
+
+    def append(
+        self,
+        step: int,
+        slot: int,
+        users: np.ndarray,
+        items: np.ndarray,
+        ph1_count: np.ndarray,
+        last_ph1_step: np.ndarray,
+        probs: np.ndarray,
+        ph1: np.ndarray,
+        ph2: np.ndarray,
+        ph3: np.ndarray,
+    ):
+        """
+        1ステップ・1推薦枠の全ユーザ分のイベントを追加する
+
+        Args:
+            step: ステップ
+            slot: 推薦枠（ランキングの順位）
+            users: shape (users,) のユーザーID（シャード内の番号）
+            items: shape (users,) の推薦したアイテム
+            ph1_count, last_ph1_step: shape (users,) の推薦時点のユーザ状態
+            probs: shape (users, 3) の各フェーズの成功確率
+            ph1, ph2, ph3: shape (users,) の各フェーズの成否
+        """
+        self._add(
+            {
+                "trial": self.trial,
+                "user": users + self.first_user,
+                "step": step,
+                "slot": slot,
+                "item": items,
+                "ph1_count": ph1_count,
+                "last_ph1_step": last_ph1_step,
+                "user_state_score": calculate_user_state_scores(
+                    ph1_count, last_ph1_step
+                ),
+                "delta": get_user_state_score_deltas(ph1_count, last_ph1_step),
+                "ph1_prob": probs[:, 0],
+                "ph2_prob": probs[:, 1],
+                "ph3_prob": probs[:, 2],
+                "ph1": ph1,
+                "ph2": ph2,
+                "ph3": ph3,
+            },
+            len(users),
+        )
+
+    def append_row(
+        self,
+        step: int,
+        slot: int,
+        user: int,
+        item: int,
+        ph1_count: int,
+        last_ph1_step: int,
+        ph1_prob: float,
+        ph2_prob: float,
+        ph3_prob: float,
+        ph1: bool,
+        ph2: bool,
+        ph3: bool,
+    ):
+        """1件のイベントを追加する（loopエンジン用。バッファ1つ分たまるごとに配列にまとめる）"""
+        self._rows.append(
+            (
+                step,
+                slot,
+                user,
+                item,
+                ph1_count,
+                last_ph1_step,
+                ph1_prob,
+                ph2_prob,
+                ph3_prob,
+                ph1,
+                ph2,
+                ph3,
+            )
+        )
+        if len(self._rows) == self.sink.batch_rows:
+            self._add_rows()
+
+    def _add_rows(self):
+        if not self._rows:
+            return
+        step, slot, users, items, ph1_count, last_ph1_step, *rest = (
+            np.array(column) for column in zip(*self._rows)
+        )
+        self._rows = []
+        self.append(
+            step,
+            slot,
+            users,
+            items,
+            ph1_count,
+            last_ph1_step,
+            np.column_stack(rest[:3]),
+            *rest[3:],
+        )
+
+    def _add(self, columns: dict, num_rows: int):
+        start = 0
+        while start < num_rows:
+            count = min(num_rows - start, self.sink.batch_rows - self._size)
+            stop = self._size + count
+            for name, values in columns.items():
+                if np.ndim(values) == 0:
+                    self._buffer[name][self._size : stop] = values
+                else:
+                    self._buffer[name][self._size : stop] = values[
+                        start : start + count
+                    ]
+            self._size = stop
+            start += count
+            if self._size == self.sink.batch_rows:
+                self._submit()
+
+    def _submit(self):
+        columns = {name: values[: self._size] for name, values in self._buffer.items()}
+        self.sink.submit(f"{self.prefix}_{self.num_parts}.npz", columns)
+        self.num_parts += 1
+        self._new_buffer()
+
+    def flush(self):
+        """バッファに残っているイベントを書き出し待ちに追加する"""
+        self._add_rows()
+        if self._size:
+            self._submit()
+
+
+def trace_files(
+    trace_dir,
+    lambda_val: float | None = None,
+    decay_flag: bool | None = None,
+    trial: int | None = None,
+) -> list[tuple[float, bool, Path]]:
+    """
+    条件に合うトレースファイルを列挙する
+
+    Args:
+        trace_dir: トレースのディレクトリ
+        lambda_val, decay_flag, trial: 指定した場合、その値のファイルのみを返す
+    Returns:
+        files: (λ, 減衰フラグ, ファイル) のリスト（設定・試行・ユーザー・書き出し順）
+    """
+
+    def sort_key(path):
+        return tuple(int(part) for part in path.stem.split("_")[1:])
+
+    files = []
+    for decay_dir in sorted(Path(trace_dir).glob("decay_*")):
+        flag = decay_dir.name == "decay_true"
+        if decay_flag is not None and flag != decay_flag:
+            continue
+        lambda_dirs = sorted(
+            decay_dir.glob("lambda_*"), key=lambda d: float(d.name[len("lambda_") :])
+        )
+        for lambda_dir in lambda_dirs:
+            value = float(lambda_dir.name[len("lambda_") :])
+            if lambda_val is not None and value != lambda_val:
+                continue
+            pattern = "trial_*.npz" if trial is None else f"trial_{trial}_*.npz"
+            for path in sorted(lambda_dir.glob(pattern), key=sort_key):
+                files.append((value, flag, path))
+    return files
+
+
+def iter_trace(
+    trace_dir,
+    columns: list[str] | None = None,
+    lambda_val: float | None = None,
+    decay_flag: bool | None = None,
+    trial: int | None = None,
+    user: int | None = None,
+):
+    """
+    トレースをファイル（最大TRACE_BATCH_ROWS行）ごとに読み込む
+
+    npzの各列は参照したときに展開されるため、columnsで指定した列だけを読み込む。
+
+    Args:
+        trace_dir: トレースのディレクトリ
+        columns: 読み込む列（Noneの場合は全ての列）
+        lambda_val, decay_flag, trial: 指定した場合、その設定・試行のみを読み込む
+        user: 指定した場合、そのユーザーの行のみを返す
+    Yields:
+        tuple[float, bool, dict]: λ, 減衰フラグ, 列名と配列の辞書
+    """
+    columns = list(columns or TRACE_COLUMNS)
+    for value, flag, path in trace_files(trace_dir, lambda_val, decay_flag, trial):
+        with np.load(path) as batch:
+            if user is None:
+                yield value, flag, {name: batch[name] for name in columns}
+                continue
+            mask = batch["user"] == user
+            if mask.any():
+                yield value, flag, {name: batch[name][mask] for name in columns}
+
+
+def load_trace(trace_dir, columns: list[str] | None = None, **conditions) -> dict:
+    """
+    条件に合うトレースを読み込んで1つの辞書にまとめる（条件はiter_traceと同じ）
+
+    全試行のトレースはメモリに収まらない場合があるため、集計にはiter_traceを使う。
+
+    Returns:
+        trace: 列名と配列の辞書（lambda, decay_flagの列を含む）
+    """
+    columns = list(columns or TRACE_COLUMNS)
+    batches = {name: [] for name in ["lambda", "decay_flag", *columns]}
+    for value, flag, batch in iter_trace(trace_dir, columns, **conditions):
+        num_rows = len(batch[columns[0]])
+        batches["lambda"].append(np.full(num_rows, value))
+        batches["decay_flag"].append(np.full(num_rows, flag))
+        for name in columns:
+            batches[name].append(batch[name])
+    return {
+        name: (
+            np.concatenate(values)
+            if values
+            else np.empty(0, dtype=TRACE_COLUMNS.get(name, np.float64))
+        )
+        for name, values in batches.items()
+    }
+
+
+def parse_arguments():
+    """コマンドライン引数をパースします"""
+    parser = argparse.ArgumentParser(description="推薦イベントのトレースを表示します")
+    parser.add_argument("trace_dir", help="トレースのディレクトリ (--trace_dir)")
+    parser.add_argument("--lambda_val", type=float, default=None, help="λ")
+    parser.add_argument(
+        "--decay", choices=["true", "false"], default=None, help="減衰フラグ"
+    )
+    parser.add_argument("--trial", type=int, default=None, help="試行番号")
+    parser.add_argument("--user", type=int, default=None, help="ユーザーID")
+    parser.add_argument(
+        "--columns", nargs="+", default=None, help="表示する列 (デフォルト: 全て)"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=200, help="表示する最大行数 (0の場合は全て)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    """メイン関数"""
+    import pandas as pd
+
+    args = parse_arguments()
+    decay_flag = None if args.decay is None else args.decay == "true"
+    trace = load_trace(
+        args.trace_dir,
+        args.columns,
+        lambda_val=args.lambda_val,
+        decay_flag=decay_flag,
+        trial=args.trial,
+        user=args.user,
+    )
+    frame = pd.DataFrame(trace)
+    print(f"{len(frame)} 件のイベント")
+    with pd.option_context(
+        "display.max_rows", None, "display.max_columns", None, "display.width", 200
+    ):
+        print(frame if args.limit == 0 else frame.head(args.limit))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+NumPy配列ベースの実験エンジン
+
+run_experimentの参照実装（Pythonループ）と同じモデルを、ユーザ状態を配列として保持し
+全ユーザのランキングと各フェーズの試行を一括で処理する形で実装する。
+"""
+
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from config import TOP_K  # noqa: E402
+from data_processing.counter_rng import OutcomeUniforms  # noqa: E402
+from experiments.envelope import EnvelopeIndex  # noqa: E402
+from experiments.policies import (  # noqa: E402
+    BASELINE,
+    PROPOSED,
+    BaselinePolicy,
+    ProposedPolicy,
+    RankingPolicy,
+    get_policy,
+)
+from models.models import User, Item, UserBatch  # noqa: E402
+from utils.profiling import StageProfile  # noqa: E402
+from experiments.tracing import TraceWriter  # noqa: E402
+from utils.utils import get_phase_multipliers_array  # noqa: E402
+
+# item_scoresの最後の軸のインデックス
+PH1, PH2, PH3 = 0, 1, 2
+
+
+def to_arrays(
+    users: list[User], items: list[Item], num_steps: int, num_items: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    load_dataの戻り値を配列形式に変換する
+
+    Args:
+        users: ユーザーリスト
+        items: アイテムデータのリスト
+        num_steps: 実験ステップ数
+        num_items: 各ステップの候補アイテム数
+    Returns:
+        tuple[np.ndarray, np.ndarray]:
+            user_states: shape (users, 2) の初期状態 (ph1_count, last_ph1_step)
+            item_scores: shape (users, steps, items, 3) のph1~3スコア
+    """
+    user_batch = UserBatch.from_users(users)
+    user_states = np.column_stack([user_batch.ph1_count, user_batch.last_ph1_step])
+
+    # simulate_trialはph1~3を並べた配列を使うため、列ごとに分けずに直接書き込む
+    shape = (len(users), num_steps, num_items)
+    item_scores = np.zeros(shape + (3,), dtype=np.float64)
+    index = np.array(
+        [(item.user, item.step, item.item) for item in items], dtype=np.int64
+    ).reshape(-1, 3)
+    scores = np.array(
+        [(item.ph1_score, item.ph2_score, item.ph3_score) for item in items],
+        dtype=np.float64,
+    ).reshape(-1, 3)
+    valid = np.all(index < shape, axis=1)
+    index, scores = index[valid], scores[valid]
+    item_scores[index[:, 0], index[:, 1], index[:, 2]] = scores
+    return user_states, item_scores
+
+
+def from_arrays(
+    user_states: np.ndarray, item_scores: np.ndarray
+) -> tuple[list[User], list[Item]]:
+    """
+    配列形式のデータをload_dataと同じ形式（User, Itemのリスト）に変換する
+
+    Args:
+        user_states: shape (users, 2) の初期状態 (ph1_count, last_ph1_step)
+        item_scores: shape (users, steps, items, 3) のph1~3スコア
+    Returns:
+        tuple[list[User], list[Item]]: ユーザーリストとアイテムデータのリスト
+    """
+    users = UserBatch.from_states(user_states).to_users()
+    items = [
+        Item(
+            user=u,
+            step=s,
+            item=item_idx,
+            ph1_score=scores[PH1],
+            ph2_score=scores[PH2],
+            ph3_score=scores[PH3],
+        )
+        for u, user_steps in enumerate(np.asarray(item_scores).tolist())
+        for s, step_items in enumerate(user_steps)
+        for item_idx, scores in enumerate(step_items)
+    ]
+    return users, items
+
+
+def rank_items(
+    item_scores: np.ndarray,
+    deltas: np.ndarray | None,
+    lambda_val: float,
+    top_k: int = TOP_K,
+) -> np.ndarray:
+    """
+    全ユーザの候補アイテムを一括でランキングし、上位top_k件のインデックスを返す
+
+    λ=0の場合はbaseline、それ以外はproposedの方策（policies.py）でランキングする。
+    同点のアイテムは参照実装（安定ソート）と同じく若いインデックスを優先する。
+
+    Args:
+        item_scores: shape (users, items, 3) のph1~3スコア
+        deltas: shape (users,) のユーザ状態スコアの変化量（λ=0の場合はNone）
+        lambda_val: 将来マッチング重視パラメータλ
+        top_k: 推薦するアイテム数
+    Returns:
+        top_k_indices: shape (users, top_k) のアイテムインデックス（スコア降順）
+    """
+    policy = get_policy(BASELINE if lambda_val == 0 else PROPOSED)
+    return policy.rank(item_scores, None, deltas, lambda_val, top_k)
+
+
+def rank_baseline(item_scores: np.ndarray, top_k: int = TOP_K) -> np.ndarray:
+    """
+    baselineスコアによる全 (user, step) のランキングを一括で計算する
+
+    baselineスコアはユーザ状態に依存しないため、λ=0の設定間で共有できる。
+
+    Args:
+        item_scores: shape (users, steps, items, 3) のph1~3スコア
+        top_k: 推薦するアイテム数
+    Returns:
+        baseline_ranking: shape (users, steps, top_k) のアイテムインデックス
+    """
+    num_users, num_steps, num_items = item_scores.shape[:3]
+    flat_scores = np.asarray(item_scores).reshape(num_users * num_steps, num_items, 3)
+    top_k_indices = rank_items(flat_scores, None, 0, top_k)
+    return top_k_indices.reshape(num_users, num_steps, -1)
+
+
+def outcome_probabilities(
+    chosen_scores: np.ndarray, multipliers: np.ndarray, decay_flag: bool
+) -> np.ndarray:
+    """
+    推薦されたアイテムに対する各フェーズの成功確率を計算する
+
+    Args:
+        chosen_scores: shape (users, 3) の推薦アイテムのph1~3スコア
+        multipliers: shape (users, 3) のユーザ状態スコアのSCORE_ADJUSTMENT乗
+        decay_flag: ユーザ状態スコアによる確率の補正を行うかどうか
+    Returns:
+        probs: shape (users, 3) の各フェーズの成功確率
+    """
+    if not decay_flag:
+        return chosen_scores
+    return chosen_scores * multipliers
+
+
+def simulate_trial(
+    user_states: np.ndarray,
+    item_scores: np.ndarray,
+    lambda_val: float,
+    decay_flag: bool,
+    rng: np.random.Generator,
+    top_k: int = TOP_K,
+    baseline_ranking: np.ndarray | None = None,
+    release_finished: bool = False,
+    profile: StageProfile | None = None,
+    envelope_index: EnvelopeIndex | None = None,
+    outcome_uniforms: OutcomeUniforms | None = None,
+    policy: RankingPolicy | None = None,
+    trace: TraceWriter | None = None,
+) -> tuple[dict, np.ndarray]:
+    """
+    1試行分の実験を配列演算で実行する
+
+    ユーザ状態は未終了のユーザのみに圧縮して保持するため、各ステップの処理量は残りのユーザ数に比例する。
+
+    Args:
+        user_states: shape (users, 2) の初期状態 (ph1_count, last_ph1_step)
+        item_scores: shape (users, steps, items, 3) のph1~3スコア
+        lambda_val: 将来マッチング重視パラメータλ
+        decay_flag: 減衰フラグ
+        rng: フェーズの成否判定に使用する乱数生成器
+        top_k: 推薦するアイテム数
+        baseline_ranking: rank_baselineの結果（λ=0の場合に再利用）
+        release_finished: item_scoresを他と共有していない場合にTrue。
+            残りのユーザが半分以下になるたびに、未終了ユーザの残りステップの候補だけを残して元の配列を解放する
+        profile: 処理段階ごとの時間とカウンタの記録先（Noneの場合は計測しない）
+        envelope_index: EnvelopeIndex.buildの結果（λ≠0の場合に全候補の代わりに包絡線上の候補だけを評価）
+        outcome_uniforms: 指定した場合、rngの代わりに (user, step, slot) ごとに固定の共通乱数で成否を判定する
+        policy: ランキング方策（Noneの場合はλ=0ならbaseline、それ以外はproposed）
+        trace: 推薦イベントの記録先（Noneの場合は記録しない）
+    Returns:
+        tuple[dict, np.ndarray]:
+            各フェーズの成功回数と、shape (steps, 3) のステップごとのph1~3成功回数
+    """
+    num_steps, num_items = item_scores.shape[1:3]
+    if policy is None:
+        policy = get_policy(BASELINE if lambda_val == 0 else PROPOSED)
+    # 事前計算したbaselineランキングと包絡線インデックスは、それぞれbaseline・proposedの方策のみで使える
+    use_baseline_ranking = (
+        isinstance(policy, BaselinePolicy) and baseline_ranking is not None
+    )
+    use_envelope = (
+        isinstance(policy, ProposedPolicy)
+        and lambda_val != 0
+        and envelope_index is not None
+    )
+    user_batch = UserBatch.from_states(user_states)
+    num_users = len(user_batch)
+    user_batch = user_batch[~user_batch.finished]
+
+    # user_ids: 未終了ユーザの元のID、rows: item_scoresにおける各ユーザの行
+    user_ids = np.arange(len(user_batch))
+    rows = user_ids
+    # item_scoresの先頭ステップ（候補を圧縮した場合に進む）
+    step_offset = 0
+    # メモリマップや遅延生成のデータは参照した分しか読まれないため、インメモリ配列のみ圧縮する
+    compact_items = release_finished and type(item_scores) is np.ndarray
+
+    step_counts = np.zeros((num_steps, 3), dtype=np.int32)
+
+    # 計測用（profilingがFalseの場合は分岐のみ）
+    profiling = profile is not None
+    timings = {"delta": 0.0, "ranking": 0.0, "sampling": 0.0, "aggregation": 0.0}
+    candidates_scored = users_skipped = rng_draws = 0
+
+    for step in range(num_steps):
+        if profiling:
+            users_skipped += num_users - user_ids.size
+            t0 = perf_counter()
+        if user_ids.size == 0:
+            if profiling:
+                users_skipped += (num_steps - step - 1) * num_users
+            break
+
+        ph1_count = user_batch.ph1_count
+        last_ph1_step = user_batch.last_ph1_step
+        step_items = item_scores[rows, step - step_offset]
+        features = None
+        if policy.state_dependent:
+            features = policy.features(user_batch)
+        if profiling:
+            t1 = perf_counter()
+            timings["delta"] += t1 - t0
+            t0 = t1
+        if use_baseline_ranking:
+            top_k_indices = baseline_ranking[user_ids, step, :top_k]
+        elif use_envelope:
+            top_k_indices, num_scored = envelope_index.rank(
+                step_items, user_ids, step, features, lambda_val, top_k
+            )
+            candidates_scored += num_scored
+        else:
+            top_k_indices = policy.rank(
+                step_items, user_batch, features, lambda_val, top_k
+            )
+            if profiling:
+                candidates_scored += user_ids.size * num_items
+        if profiling:
+            t1 = perf_counter()
+            timings["ranking"] += t1 - t0
+            t0 = t1
+
+        for k in range(top_k_indices.shape[1]):
+            chosen = step_items[np.arange(user_ids.size), top_k_indices[:, k]]
+            multipliers = None
+            if decay_flag:
+                multipliers = get_phase_multipliers_array(ph1_count, last_ph1_step)
+            probs = outcome_probabilities(chosen, multipliers, decay_flag)
+
+            if outcome_uniforms is None:
+                draws = rng.random((user_ids.size, 3))
+            else:
+                draws = outcome_uniforms(user_ids, step, k)
+            ph1_success = draws[:, PH1] < probs[:, PH1]
+            ph2_success = ph1_success & (draws[:, PH2] < probs[:, PH2])
+            ph3_success = ph2_success & (draws[:, PH3] < probs[:, PH3])
+            if trace is not None:
+                # 状態を更新する前に、推薦時点のユーザ状態とあわせて記録する
+                trace.append(
+                    step,
+                    k,
+                    user_ids,
+                    top_k_indices[:, k],
+                    ph1_count,
+                    last_ph1_step,
+                    probs,
+                    ph1_success,
+                    ph2_success,
+                    ph3_success,
+                )
+
+            ph1_count[ph1_success] += 1
+            last_ph1_step[ph1_success] = 0
+            last_ph1_step[~ph1_success] += 1
+            user_batch.finished |= ph3_success
+
+            num_ph1, num_ph2, num_ph3 = (
+                np.count_nonzero(ph1_success),
+                np.count_nonzero(ph2_success),
+                np.count_nonzero(ph3_success),
+            )
+            step_counts[step] += (num_ph1, num_ph2, num_ph3)
+            if profiling:
+                # loopエンジンと同じく、判定に使った乱数だけを数える
+                # （ph1は推薦ごと、ph2・ph3は前のフェーズが成功した場合のみ）
+                rng_draws += user_ids.size + num_ph1 + num_ph2
+
+        if profiling:
+            t1 = perf_counter()
+            timings["sampling"] += t1 - t0
+            t0 = t1
+
+        # このステップでph3に到達したユーザを除外して状態を圧縮する
+        if user_batch.finished.any():
+            remaining = ~user_batch.finished
+            user_batch = user_batch[remaining]
+            user_ids = user_ids[remaining]
+            rows = rows[remaining]
+
+            if compact_items and rows.size <= item_scores.shape[0] // 2:
+                item_scores = item_scores[rows, step + 1 - step_offset :]
+                rows = np.arange(rows.size)
+                step_offset = step + 1
+
+        if profiling:
+            timings["aggregation"] += perf_counter() - t0
+
+    if profiling:
+        t0 = perf_counter()
+    totals = step_counts.sum(axis=0)
+    trial_results = {
+        "ph1": int(totals[PH1]),
+        "ph2": int(totals[PH2]),
+        "ph3": int(totals[PH3]),
+    }
+
+    if profiling:
+        timings["aggregation"] += perf_counter() - t0
+        for stage, seconds in timings.items():
+            profile.add_time(stage, seconds)
+        profile.add_count("candidates_scored", candidates_scored)
+        profile.add_count("users_skipped_finished", users_skipped)
+        profile.add_count("rng_draws", rng_draws)
+
+    return trial_results, step_counts
@@ -1,7 +1,9 @@
 from dataclasses import dataclass
 
+import numpy as np
 
-@dataclass
+
+@dataclass(slots=True)
 class User:
     """ユーザクラス"""
 
@@ -11,7 +13,7 @@ class User:
     finished: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class Item:
     """アイテムクラス"""
 
@@ -21,3 +23,130 @@ class Item:
     ph1_score: float
     ph2_score: float
     ph3_score: float
+
+
+@dataclass
+class UserBatch:
+    """ユーザ集合の配列表現（各フィールドをshape (users,) の列として保持する）"""
+
+    ph1_count: np.ndarray
+    last_ph1_step: np.ndarray
+    finished: np.ndarray
+
+    @classmethod
+    def from_states(cls, user_states: np.ndarray) -> "UserBatch":
+        """shape (users, 2) の初期状態 (ph1_count, last_ph1_step) から作成する"""
+        user_states = np.asarray(user_states)
+        return cls(
+            ph1_count=np.array(user_states[:, 0], dtype=np.int64),
+            last_ph1_step=np.array(user_states[:, 1], dtype=np.int64),
+            finished=np.zeros(user_states.shape[0], dtype=bool),
+        )
+
+    @classmethod
+    def from_users(cls, users: list[User]) -> "UserBatch":
+        """Userのリストから作成する"""
+        return cls(
+            ph1_count=np.array([user.ph1_count for user in users], dtype=np.int64),
+            last_ph1_step=np.array(
+                [user.last_ph1_step for user in users], dtype=np.int64
+            ),
+            finished=np.array([user.finished for user in users], dtype=bool),
+        )
+
+    def __len__(self) -> int:
+        return self.ph1_count.shape[0]
+
+    def __getitem__(self, index) -> "UserBatch":
+        return UserBatch(
+            ph1_count=self.ph1_count[index],
+            last_ph1_step=self.last_ph1_step[index],
+            finished=self.finished[index],
+        )
+
+    def row(self, user_id: int) -> User:
+        """1ユーザ分をUserとして取り出す"""
+        return User(
+            id=user_id,
+            ph1_count=int(self.ph1_count[user_id]),
+            last_ph1_step=int(self.last_ph1_step[user_id]),
+            finished=bool(self.finished[user_id]),
+        )
+
+    def to_users(self) -> list[User]:
+        """Userのリストに変換する"""
+        return [self.row(i) for i in range(len(self))]
+
+
+@dataclass
+class ItemBatch:
+    """
+    候補アイテム集合の配列表現（ph1~3スコアをそれぞれ列として保持する）
+
+    各列のshapeは (users, steps, items) や (users, items) など任意で、全列で共通とする。
+    フィールド名がItemと同じため、ModelConfig.baseline_score / proposed_scoreにそのまま渡せる。
+    シミュレーションのデータはshape (..., 3) のスコア配列のままで、スコアを計算するときに
+    from_scoresで列のビューとして包む（列ごとの配列にはコピーしない）。
+    """
+
+    ph1_score: np.ndarray
+    ph2_score: np.ndarray
+    ph3_score: np.ndarray
+
+    @classmethod
+    def from_scores(cls, item_scores: np.ndarray) -> "ItemBatch":
+        """
+        shape (..., 3) のスコア配列から作成する
+
+        列は元の配列のビューとなりコピーは発生しない（連続な列が必要な場合はcontiguousを使う）。
+        """
+        return cls(
+            ph1_score=item_scores[..., 0],
+            ph2_score=item_scores[..., 1],
+            ph3_score=item_scores[..., 2],
+        )
+
+    @property
+    def shape(self) -> tuple:
+        return self.ph1_score.shape
+
+    def __len__(self) -> int:
+        return self.ph1_score.shape[0]
+
+    def __getitem__(self, index) -> "ItemBatch":
+        return ItemBatch(
+            ph1_score=self.ph1_score[index],
+            ph2_score=self.ph2_score[index],
+            ph3_score=self.ph3_score[index],
+        )
+
+    def at(self, user: int, step: int) -> "ItemBatch":
+        """(user, step) の候補アイテムのビューを返す（列がshape (users, steps, items) の場合）"""
+        return self[user, step]
+
+    def contiguous(self) -> "ItemBatch":
+        """各列を連続なメモリ配置にコピーしたバッチを返す"""
+        return ItemBatch(
+            ph1_score=np.ascontiguousarray(self.ph1_score),
+            ph2_score=np.ascontiguousarray(self.ph2_score),
+            ph3_score=np.ascontiguousarray(self.ph3_score),
+        )
+
+    def to_scores(self) -> np.ndarray:
+        """shape (..., 3) のスコア配列に変換する"""
+        return np.stack([self.ph1_score, self.ph2_score, self.ph3_score], axis=-1)
+
+    def to_items(self, user: int, step: int) -> list[Item]:
+        """(user, step) の候補アイテムをItemのリストとして取り出す"""
+        view = self.at(user, step)
+        return [
+            Item(
+                user=user,
+                step=step,
+                item=item_idx,
+                ph1_score=float(view.ph1_score[item_idx]),
+                ph2_score=float(view.ph2_score[item_idx]),
+                ph3_score=float(view.ph3_score[item_idx]),
+            )
+            for item_idx in range(view.shape[0])
+        ]
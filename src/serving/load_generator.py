@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ランキングサービスの負荷生成
+
+concurrency個の接続からランダムなリクエストを送り、応答までのレイテンシ（p50/p99）と
+スループットを計測する。各接続は応答を受け取ってから次のリクエストを送る（クローズドループ）。
+--spawn_serverを指定すると、計測用のサーバを別プロセスで起動する。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from config import ITEM_NUM, RANDOM_SEED, TOP_K  # noqa: E402
+from serving.ranking_service import DEFAULT_HOST, DEFAULT_PORT  # noqa: E402
+
+
+def make_requests(
+    num_requests: int,
+    num_items: int = ITEM_NUM,
+    lambda_val: float = 0.1,
+    top_k: int = TOP_K,
+    seed: int = RANDOM_SEED,
+) -> list[bytes]:
+    """
+    実験と同じ分布のユーザ状態・候補スコアを持つリクエストを作成する
+
+    Args:
+        num_requests: リクエスト数
+        num_items: 1リクエストの候補数
+        lambda_val: 将来マッチング重視パラメータλ
+        top_k: 返すアイテム数
+        seed: 乱数シード
+    Returns:
+        lines: 送信する改行区切りJSONの各行
+    """
+    rng = np.random.default_rng(seed)
+    states = rng.integers(0, 51, size=(num_requests, 2))
+    candidates = np.round(rng.uniform(0, 0.1, size=(num_requests, num_items, 3)), 4)
+    lines = []
+    for i in range(num_requests):
+        request = {
+            "id": i,
+            "ph1_count": int(states[i, 0]),
+            "steps_since_last_ph1": int(states[i, 1]),
+            "candidates": candidates[i].tolist(),
+            "lambda": lambda_val,
+            "top_k": top_k,
+        }
+        lines.append(json.dumps(request).encode("utf-8") + b"\n")
+    return lines
+
+
+async def _client(host: str, port: int, lines: list[bytes], latencies: list, errors):
+    """1つの接続からリクエストを順に送り、レイテンシを記録する"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for line in lines:
+            start = time.perf_counter()
+            writer.write(line)
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - start)
+            if "error" in response:
+                errors.append(response["error"])
+    finally:
+        writer.close()
+
+
+async def _request(host: str, port: int, data: dict) -> dict:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(json.dumps(data).encode("utf-8") + b"\n")
+        await writer.drain()
+        return json.loads(await reader.readline())
+    finally:
+        writer.close()
+
+
+async def run_load(
+    host: str, port: int, lines: list[bytes], concurrency: int, warmup: int = 0
+) -> dict:
+    """
+    リクエストをconcurrency個の接続に分けて送り、計測結果を返す
+
+    Args:
+        host, port: サーバのアドレス
+        lines: make_requestsで作成したリクエスト
+        concurrency: 同時接続数
+        warmup: linesの先頭のうち計測前に送るリクエスト数（計測結果には含めない）
+    Returns:
+        report: レイテンシの分位点（ミリ秒）、スループット（リクエスト/秒）、サーバのバッチ統計
+    """
+    if warmup:
+        await _client(host, port, lines[:warmup], [], [])
+    lines = lines[warmup:]
+    before = await _request(host, port, {"type": "stats"})
+
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            _client(host, port, lines[i::concurrency], latencies, errors)
+            for i in range(concurrency)
+        )
+    )
+    elapsed = time.perf_counter() - start
+
+    after = await _request(host, port, {"type": "stats"})
+    num_batches = after["batches"] - before["batches"]
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "latency_ms": {
+            "mean": float(latencies_ms.mean()),
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+            "max": float(latencies_ms.max()),
+        },
+        "server_batches": num_batches,
+        "mean_batch_size": (after["requests"] - before["requests"])
+        / max(num_batches, 1),
+    }
+
+
+def spawn_server(args) -> subprocess.Popen:
+    """計測用のサーバを別プロセスで起動し、接続できるようになるまで待つ"""
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(current_dir, "ranking_service.py"),
+            "--host",
+            args.host,
+            "--port",
+            str(args.port),
+            "--max_batch_size",
+            str(args.max_batch_size),
+            "--max_wait_ms",
+            str(args.max_wait_ms),
+        ],
+        stdout=subprocess.PIPE,
+    )
+    # 起動メッセージが出力されれば待ち受けを開始している
+    if not process.stdout.readline():
+        raise RuntimeError("ランキングサービスの起動に失敗しました")
+    return process
+
+
+def print_report(report: dict):
+    latency = report["latency_ms"]
+    print(
+        f"リクエスト数: {report['requests']} (エラー {report['errors']}), "
+        f"同時接続数: {report['concurrency']}"
+    )
+    print(f"スループット: {report['throughput']:.1f} リクエスト/秒")
+    print(
+        f"レイテンシ: p50 {latency['p50']:.3f} ms, p99 {latency['p99']:.3f} ms, "
+        f"平均 {latency['mean']:.3f} ms, 最大 {latency['max']:.3f} ms"
+    )
+    print(
+        f"サーバのバッチ数: {report['server_batches']} "
+        f"(平均 {report['mean_batch_size']:.1f} リクエスト/バッチ)"
+    )
+
+
+def parse_arguments():
+    """コマンドライン引数をパースします"""
+    parser = argparse.ArgumentParser(description="ランキングサービスの負荷生成")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="サーバのアドレス")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="サーバのポート")
+    parser.add_argument("--requests", type=int, default=10000, help="リクエスト数")
+    parser.add_argument("--concurrency", type=int, default=64, help="同時接続数")
+    parser.add_argument(
+        "--warmup", type=int, default=100, help="計測前に送るリクエスト数"
+    )
+    parser.add_argument(
+        "--items", type=int, default=ITEM_NUM, help="1リクエストの候補数"
+    )
+    parser.add_argument("--top_k", type=int, default=TOP_K, help="返すアイテム数")
+    parser.add_argument("--lambda_val", type=float, default=0.1, help="λ")
+    parser.add_argument(
+        "--spawn_server",
+        action="store_true",
+        help="計測用のサーバを別プロセスで起動する",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=256,
+        help="--spawn_serverで起動するサーバの最大バッチサイズ",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=1.0,
+        help="--spawn_serverで起動するサーバのバッチの最大待ち時間 (ミリ秒)",
+    )
+    parser.add_argument("--output", default=None, help="計測結果を保存するJSONファイル")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    lines = make_requests(
+        args.requests + args.warmup, args.items, args.lambda_val, args.top_k
+    )
+    process = spawn_server(args) if args.spawn_server else None
+    try:
+        report = asyncio.run(
+            run_load(
+                args.host,
+                args.port,
+                lines,
+                args.concurrency,
+                args.warmup,
+            )
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print_report(report)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), **report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+オンラインランキングサービス
+
+(ユーザ状態, 候補アイテム) のリクエストを受け取り、提案スコア
+ph1·ph2·ph3 + λ·ph1·Δ の上位k件を返すasyncioのTCPサーバ。
+
+同時に届いたリクエストはMicroBatcherでまとめ、候補数の違いを-infで埋めた1つの配列として
+ユーザ状態スコアの変化量Δの参照・スコア計算・上位k件の選択を一括で行う。
+スコアの式と同点の扱いはシミュレータ（policies.ProposedPolicy）と同じ。
+
+プロトコルは1行1件のJSON（改行区切り）で、1つの接続で複数のリクエストを続けて送ってよい。
+応答の順序はリクエストの順序と一致しないため、"id"で対応を取る。
+
+    リクエスト: {"id": 1, "ph1_count": 3, "steps_since_last_ph1": 5,
+                 "candidates": [[ph1, ph2, ph3], ...], "lambda": 0.1, "top_k": 1}
+    応答: {"id": 1, "items": [候補のインデックス, ...], "scores": [スコア, ...]}
+    エラー: {"id": 1, "error": "..."}（1行がmax_request_bytesを超える場合は {"id": null, "error": "..."}）
+    統計: {"type": "stats"} -> {"requests": ..., "batches": ..., "mean_batch_size": ...}
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from dataclasses import dataclass
+
+import numpy as np
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from config import TOP_K, ModelConfig  # noqa: E402
+from experiments.policies import select_top_k  # noqa: E402
+from models.models import ItemBatch  # noqa: E402
+from utils.utils import get_user_state_score_deltas  # noqa: E402
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# 1件のリクエスト（1行）の最大バイト数。候補1件あたり約60バイトのため、10万件程度まで受け付ける
+MAX_REQUEST_BYTES = 8 * 2**20
+
+
+@dataclass
+class RankingRequest:
+    """
+    1件のランキングリクエスト
+
+    Attributes:
+        ph1_count (int): ユーザのph1累計数
+        steps_since_last_ph1 (int): 最後のph1からの経過ステップ数
+        candidates (np.ndarray): shape (items, 3) の候補アイテムのph1~3スコア
+        lambda_val (float): 将来マッチング重視パラメータλ
+        top_k (int): 返すアイテム数
+    """
+
+    ph1_count: int
+    steps_since_last_ph1: int
+    candidates: np.ndarray
+    lambda_val: float
+    top_k: int
+
+    @classmethod
+    def from_dict(
+        cls, data: dict, lambda_val: float = 0.0, top_k: int = TOP_K
+    ) -> "RankingRequest":
+        """
+        JSONの辞書からリクエストを作成する
+
+        Args:
+            data: リクエストの辞書
+            lambda_val: "lambda"がない場合のλ
+            top_k: "top_k"がない場合の件数
+        Returns:
+            request: RankingRequest
+        Raises:
+            ValueError: 必須の値がない、または値が不正な場合
+        """
+        try:
+            ph1_count = int(data["ph1_count"])
+            steps_since_last_ph1 = int(data["steps_since_last_ph1"])
+            candidates = np.asarray(data["candidates"], dtype=np.float64)
+            lambda_val = float(data.get("lambda", lambda_val))
+            top_k = int(data.get("top_k", top_k))
+        except KeyError as e:
+            raise ValueError(f"{e.args[0]}がありません") from e
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"不正なリクエストです: {e}") from e
+
+        if ph1_count < 0 or steps_since_last_ph1 < 0:
+            raise ValueError("ユーザ状態は非負の整数で指定してください")
+        if candidates.ndim != 2 or candidates.shape[0] == 0 or candidates.shape[1] != 3:
+            raise ValueError(
+                "candidatesは [ph1, ph2, ph3] の空でないリストで指定してください"
+            )
+        if not np.all(np.isfinite(candidates)) or not np.isfinite(lambda_val):
+            raise ValueError("スコアとλは有限の値で指定してください")
+        if top_k < 1:
+            raise ValueError("top_kは1以上で指定してください")
+        return cls(ph1_count, steps_since_last_ph1, candidates, lambda_val, top_k)
+
+
+def rank_requests(
+    requests: list[RankingRequest],
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    複数のリクエストを1回の配列計算でランキングする
+
+    候補数が異なるリクエストは、最大の候補数まで-infのスコアで埋めて1つの配列にまとめる。
+    λ=0のリクエストのスコアはbaselineスコアと一致する。
+
+    Args:
+        requests: RankingRequestのリスト
+    Returns:
+        rankings: リクエストごとの (上位アイテムのインデックス, そのスコア)
+    """
+    num_requests = len(requests)
+    sizes = np.array([len(request.candidates) for request in requests])
+    max_items = int(sizes.max())
+
+    item_scores = np.zeros((num_requests, max_items, 3), dtype=np.float64)
+    for row, request in enumerate(requests):
+        item_scores[row, : sizes[row]] = request.candidates
+    ph1_counts = np.array([request.ph1_count for request in requests])
+    steps = np.array([request.steps_since_last_ph1 for request in requests])
+    lambdas = np.array([request.lambda_val for request in requests])
+
+    deltas = get_user_state_score_deltas(ph1_counts, steps)
+    scores = ModelConfig.proposed_score(
+        ItemBatch.from_scores(item_scores), deltas[:, None], lambdas[:, None]
+    )
+    scores = np.where(np.arange(max_items) < sizes[:, None], scores, -np.inf)
+
+    top_k = max(request.top_k for request in requests)
+    top_k_indices = select_top_k(scores, top_k)
+    top_k_scores = np.take_along_axis(scores, top_k_indices, axis=1)
+
+    rankings = []
+    for row, request in enumerate(requests):
+        num_ranked = min(request.top_k, sizes[row])
+        rankings.append(
+            (top_k_indices[row, :num_ranked], top_k_scores[row, :num_ranked])
+        )
+    return rankings
+
+
+class MicroBatcher:
+    """
+    同時に届いたリクエストをまとめてrank_requestsで処理する
+
+    最初のリクエストが届いてからmax_wait_ms経過するか、max_batch_size件集まった時点でまとめて処理する。
+    待ち時間の間に届かなかったリクエストは次のバッチに回る。
+
+    Attributes:
+        max_batch_size (int): 1回に処理する最大リクエスト数
+        max_wait (float): バッチを締め切るまでの最大待ち時間（秒）
+        num_requests (int): 処理したリクエスト数
+        num_batches (int): 処理したバッチ数
+    """
+
+    def __init__(self, max_batch_size: int = 256, max_wait_ms: float = 1.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.num_requests = 0
+        self.num_batches = 0
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._full = asyncio.Event()
+
+    async def submit(self, request: RankingRequest) -> tuple[np.ndarray, np.ndarray]:
+        """リクエストをキューに入れ、所属するバッチの処理が終わるまで待つ"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((request, future))
+        # 収集中のバッチの先頭1件はキューから取り出し済み
+        if self._queue.qsize() >= self.max_batch_size - 1:
+            self._full.set()
+        return await future
+
+    async def _collect(self) -> list:
+        """次のバッチを集める"""
+        batch = [await self._queue.get()]
+        if self.max_batch_size > 1 and self._queue.qsize() < self.max_batch_size - 1:
+            # 締め切りまでにmax_batch_size件に達した場合はその時点で処理する
+            self._full.clear()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def run(self):
+        """バッチの収集と処理を繰り返す（タスクとして実行する）"""
+        while True:
+            batch = await self._collect()
+            requests = [request for request, _ in batch]
+            try:
+                rankings = rank_requests(requests)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.num_requests += len(batch)
+            self.num_batches += 1
+            for (_, future), ranking in zip(batch, rankings):
+                # 応答を待たずに切断したリクエストはキャンセル済み
+                if not future.done():
+                    future.set_result(ranking)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "mean_batch_size": self.num_requests / max(self.num_batches, 1),
+        }
+
+
+# read_request_lineの戻り値。行が上限を超えたことを表す
+TOO_LONG = object()
+
+
+async def read_request_line(reader: asyncio.StreamReader):
+    """
+    1行を読む
+
+    StreamReader.readlineは上限（start_serverのlimit）を超えた行でValueErrorを送出し、
+    行の残りがバッファに残る場合があるため、readuntilで読み、超えた行は改行まで読み捨てる。
+
+    Returns:
+        line: 改行を含む1行（接続が閉じられた場合はb""、上限を超えた場合はTOO_LONG）
+    """
+    try:
+        return await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+    except asyncio.LimitOverrunError as e:
+        consumed = e.consumed
+    while True:
+        try:
+            await reader.readexactly(consumed)
+            await reader.readuntil(b"\n")
+            return TOO_LONG
+        except asyncio.IncompleteReadError:
+            return TOO_LONG
+        except asyncio.LimitOverrunError as e:
+            consumed = e.consumed
+
+
+class RankingService:
+    """
+    MicroBatcherを使う改行区切りJSONのTCPサーバ
+
+    Attributes:
+        batcher (MicroBatcher): リクエストのバッチ処理
+        lambda_val (float): リクエストにλがない場合の値
+        top_k (int): リクエストにtop_kがない場合の件数
+        max_request_bytes (int): 1件のリクエスト（1行）の最大バイト数
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = 256,
+        max_wait_ms: float = 1.0,
+        lambda_val: float = 0.0,
+        top_k: int = TOP_K,
+        max_request_bytes: int = MAX_REQUEST_BYTES,
+    ):
+        self.batcher = MicroBatcher(max_batch_size, max_wait_ms)
+        self.lambda_val = lambda_val
+        self.top_k = top_k
+        self.max_request_bytes = max_request_bytes
+
+    async def handle(self, data: dict) -> dict:
+        """1件のリクエストの辞書を処理し、応答の辞書を返す"""
+        if data.get("type") == "stats":
+            return self.batcher.stats()
+        response = {"id": data.get("id")}
+        try:
+            request = RankingRequest.from_dict(data, self.lambda_val, self.top_k)
+        except ValueError as e:
+            response["error"] = str(e)
+            return response
+        items, scores = await self.batcher.submit(request)
+        response["items"] = items.tolist()
+        response["scores"] = scores.tolist()
+        return response
+
+    async def _write(self, response: dict, writer, lock: asyncio.Lock):
+        writer.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+        async with lock:
+            await writer.drain()
+
+    async def _respond(self, line: bytes, writer, lock: asyncio.Lock):
+        request_id = None
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError("リクエストはJSONオブジェクトで指定してください")
+            request_id = data.get("id")
+            response = await self.handle(data)
+        except ValueError as e:
+            response = {"id": request_id, "error": str(e)}
+        except Exception as e:
+            response = {"id": request_id, "error": f"内部エラー: {e}"}
+        await self._write(response, writer, lock)
+
+    async def handle_connection(self, reader, writer):
+        """1つの接続のリクエストを読み、それぞれを並行して処理する"""
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while line := await read_request_line(reader):
+                if line is TOO_LONG:
+                    # 上限を超えた行は読み捨てて、接続を切らずにエラーを返す
+                    message = f"リクエストが上限の{self.max_request_bytes}バイトを超えています"
+                    await self._write({"id": None, "error": message}, writer, lock)
+                    continue
+                if not line.strip():
+                    continue
+                # 同じ接続から続けて届いたリクエストも同じバッチにまとめられるようにする
+                task = asyncio.create_task(self._respond(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        """サーバを起動し、停止されるまで処理を続ける"""
+        batcher_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(
+            self.handle_connection, host, port, limit=self.max_request_bytes
+        )
+        addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"ランキングサービスを{addresses}で起動しました", flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+
+def parse_arguments():
+    """コマンドライン引数をパースします"""
+    parser = argparse.ArgumentParser(description="オンラインランキングサービス")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="待ち受けるアドレス")
+    parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT, help="待ち受けるポート"
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=256,
+        help="1回のスコア計算にまとめる最大リクエスト数 (1の場合はリクエストごとに計算)",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=1.0,
+        help="最初のリクエストからバッチを締め切るまでの最大待ち時間 (ミリ秒)",
+    )
+    parser.add_argument(
+        "--lambda_val",
+        type=float,
+        default=0.0,
+        help="リクエストにlambdaがない場合のλ",
+    )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=TOP_K,
+        help="リクエストにtop_kがない場合に返すアイテム数",
+    )
+    parser.add_argument(
+        "--max_request_bytes",
+        type=int,
+        default=MAX_REQUEST_BYTES,
+        help="1件のリクエスト (1行) の最大バイト数。超えたリクエストにはエラーを返す",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    service = RankingService(
+        args.max_batch_size,
+        args.max_wait_ms,
+        args.lambda_val,
+        args.top_k,
+        args.max_request_bytes,
+    )
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+実験ループの処理段階ごとの計測
+
+計測は実験エンジンにStageProfileを渡した場合のみ行う。渡さない場合（None）は
+各エンジンの分岐1つ分のコストしかかからない。
+"""
+
+from time import perf_counter
+
+# 計測する処理段階
+STAGES = ["load", "grouping", "delta", "ranking", "sampling", "aggregation"]
+# 計測するカウンタ
+COUNTERS = ["candidates_scored", "users_skipped_finished", "rng_draws"]
+
+
+class StageProfile:
+    """処理段階ごとの経過時間（秒）とカウンタ
+
+    Attributes:
+        times (dict): 処理段階ごとの経過時間
+        counts (dict): カウンタの値
+    """
+
+    def __init__(self, times: dict | None = None, counts: dict | None = None):
+        self.times = {stage: 0.0 for stage in STAGES}
+        self.counts = {counter: 0 for counter in COUNTERS}
+        self.times.update(times or {})
+        self.counts.update(counts or {})
+
+    def add_time(self, stage: str, seconds: float):
+        self.times[stage] = self.times.get(stage, 0.0) + seconds
+
+    def add_count(self, counter: str, value: int):
+        self.counts[counter] = self.counts.get(counter, 0) + int(value)
+
+    def timer(self, stage: str) -> "_StageTimer":
+        """with文で囲んだ処理の経過時間をstageに加算するタイマーを返す"""
+        return _StageTimer(self, stage)
+
+    def merge(self, other: "StageProfile") -> "StageProfile":
+        """otherの値を加算する"""
+        for stage, seconds in other.times.items():
+            self.add_time(stage, seconds)
+        for counter, value in other.counts.items():
+            self.add_count(counter, value)
+        return self
+
+    def to_dict(self) -> dict:
+        return {"times": dict(self.times), "counts": dict(self.counts)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "StageProfile":
+        return cls(data.get("times"), data.get("counts"))
+
+    def format(self) -> str:
+        """ログ出力用の文字列を返す"""
+        total = sum(self.times.values())
+        times = ", ".join(
+            f"{stage}={seconds:.3f}s ({seconds / total:.0%})" if total > 0 else stage
+            for stage, seconds in self.times.items()
+        )
+        counts = ", ".join(
+            f"{counter}={value}" for counter, value in self.counts.items()
+        )
+        return f"{times} | {counts}"
+
+
+class _StageTimer:
+    def __init__(self, profile: StageProfile, stage: str):
+        self.profile = profile
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add_time(self.stage, perf_counter() - self.start)
+        return False
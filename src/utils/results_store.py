@@ -0,0 +1,397 @@
+"""
+実験結果の保存先（SQLite）
+
+実行（run）ごとに設定単位の集計値と試行単位の結果を追記する。同じλ・減衰フラグの実行が
+複数あっても run_id と config_hash で区別されるため、互いに上書きされることはない。
+
+- runs: 実行ID（seqは追記順の連番）と実行の種類（experiment.pyは"sweep"、grid.pyは"grid"）
+- configs: (run_id, config_hash) ごとのλ、減衰フラグ、エンジン、ランキング方策、実行時間、平均履歴、比較指標
+- trials: (run_id, config_hash, trial) ごとのph1~3成功回数
+
+試行単位の集計（平均・件数）はSQLで行う。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from config import RESULTS_DIR  # noqa: E402
+
+RESULTS_DB = os.path.join(RESULTS_DIR, "results.db")
+
+# 実行の種類（runs.kind）
+SWEEP = "sweep"
+GRID = "grid"
+
+# JSONファイルから取り込んだ結果の config_hash（設定の詳細が残っていないため）
+LEGACY_CONFIG_HASH = "legacy"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL UNIQUE,
+    created_at TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'sweep'
+);
+CREATE TABLE IF NOT EXISTS configs (
+    run_id TEXT NOT NULL REFERENCES runs (run_id),
+    config_hash TEXT NOT NULL,
+    lambda REAL NOT NULL,
+    decay_flag INTEGER NOT NULL,
+    engine TEXT,
+    num_trials INTEGER NOT NULL,
+    execution_time REAL,
+    average_history TEXT,
+    metrics TEXT,
+    policy TEXT,
+    PRIMARY KEY (run_id, config_hash)
+);
+CREATE TABLE IF NOT EXISTS trials (
+    run_id TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    lambda REAL NOT NULL,
+    decay_flag INTEGER NOT NULL,
+    trial INTEGER NOT NULL,
+    ph1 INTEGER NOT NULL,
+    ph2 INTEGER NOT NULL,
+    ph3 INTEGER NOT NULL,
+    PRIMARY KEY (run_id, config_hash, trial)
+);
+CREATE INDEX IF NOT EXISTS configs_by_setting
+    ON configs (decay_flag, lambda, config_hash);
+CREATE INDEX IF NOT EXISTS trials_by_setting
+    ON trials (decay_flag, lambda, config_hash);
+"""
+
+
+class ResultsStore:
+    """実験結果のSQLiteストア
+
+    Attributes:
+        path (str): データベースファイルのパス
+    """
+
+    def __init__(self, path: str | Path = RESULTS_DB):
+        self.path = str(path)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """以前のバージョンで作成したデータベースに不足している列を追加する"""
+        columns = {
+            row["name"] for row in self.connection.execute("PRAGMA table_info(configs)")
+        }
+        if "policy" not in columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE configs ADD COLUMN policy TEXT")
+        run_columns = {
+            row["name"] for row in self.connection.execute("PRAGMA table_info(runs)")
+        }
+        if "kind" not in run_columns:
+            with self.connection:
+                self.connection.execute(
+                    "ALTER TABLE runs ADD COLUMN kind TEXT NOT NULL DEFAULT 'sweep'"
+                )
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self) -> "ResultsStore":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @staticmethod
+    def new_run_id() -> str:
+        """タイムスタンプと乱数からなる実行IDを作成する"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return f"{timestamp}_{uuid.uuid4().hex[:8]}"
+
+    def save_run(
+        self, results: list[dict], run_id: str | None = None, kind: str = SWEEP
+    ) -> str:
+        """
+        1回の実行（run_sweepの戻り値）を追記する
+
+        Args:
+            results: 設定ごとの実験結果のリスト
+            run_id: 実行ID（Noneの場合は新しく作成する）
+            kind: 実行の種類（SWEEPまたはGRID）。GRIDの実行は同じ (減衰フラグ, λ) の設定を複数含むため、
+                query_averagesはrun_idを指定しない場合に集計しない
+        Returns:
+            run_id: 保存した実行ID
+        """
+        run_id = run_id or self.new_run_id()
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO runs (run_id, created_at, kind) VALUES (?, ?, ?)",
+                (run_id, datetime.now().isoformat(), kind),
+            )
+            for config_results in results:
+                self._insert_config(run_id, config_results)
+        return run_id
+
+    def _insert_config(self, run_id: str, config_results: dict):
+        hash_value = config_results.get("config_hash", LEGACY_CONFIG_HASH)
+        lambda_val = float(config_results["lambda"])
+        decay_flag = int(config_results["decay_flag"])
+        self.connection.execute(
+            """
+            INSERT INTO configs (
+                run_id, config_hash, lambda, decay_flag, engine, num_trials,
+                execution_time, average_history, metrics, policy
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                run_id,
+                hash_value,
+                lambda_val,
+                decay_flag,
+                config_results.get("engine"),
+                len(config_results["trials"]),
+                config_results.get("execution_time"),
+                json.dumps(config_results.get("average_history")),
+                json.dumps(config_results.get("metrics")),
+                config_results.get("policy"),
+            ),
+        )
+        self.connection.executemany(
+            "INSERT INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    run_id,
+                    hash_value,
+                    lambda_val,
+                    decay_flag,
+                    trial,
+                    trial_results["ph1"],
+                    trial_results["ph2"],
+                    trial_results["ph3"],
+                )
+                for trial, trial_results in enumerate(config_results["trials"])
+            ),
+        )
+
+    def import_json(self, result_dir: str | Path, decay_flag: bool) -> list[str]:
+        """
+        save_resultsで保存したJSONファイルを取り込む（ファイルごとに1実行とする）
+
+        λはファイル名ではなくJSONの"lambda"から取得する。実行IDはファイル名と内容のハッシュ値から作成するため、
+        取り込み済みのファイルは再度取り込まない（内容が変わったファイルは新しい実行として取り込む）。
+
+        Args:
+            result_dir: JSONファイルのディレクトリ
+            decay_flag: 取り込む結果の減衰フラグ（JSONに含まれない場合に使用）
+        Returns:
+            run_ids: 新しく取り込んだ実行IDのリスト
+        """
+        run_ids = []
+        for file in sorted(Path(result_dir).glob("lambda_*.json")):
+            with open(file) as f:
+                data = json.load(f)
+            data.setdefault("decay_flag", decay_flag)
+            content = json.dumps(data, sort_keys=True).encode()
+            run_id = f"{file.stem}_{hashlib.sha256(content).hexdigest()[:12]}"
+            if self.has_run(run_id):
+                continue
+            run_ids.append(self.save_run([data], run_id))
+        return run_ids
+
+    def has_run(self, run_id: str) -> bool:
+        """実行IDが保存済みかどうかを返す"""
+        row = self.connection.execute(
+            "SELECT 1 FROM runs WHERE run_id = ?", (run_id,)
+        ).fetchone()
+        return row is not None
+
+    def runs(self) -> list[dict]:
+        """実行の一覧を追記順に返す"""
+        rows = self.connection.execute(
+            "SELECT run_id, created_at, kind FROM runs ORDER BY seq"
+        )
+        return [dict(row) for row in rows]
+
+    def query_configs(
+        self,
+        decay_flag: bool | None = None,
+        lambda_val: float | None = None,
+        config_hash: str | None = None,
+        run_id: str | None = None,
+    ) -> list[dict]:
+        """
+        設定単位の結果を返す（average_history, metricsは復元済み）
+
+        Args:
+            decay_flag, lambda_val, config_hash, run_id: 絞り込み条件（Noneの場合は絞り込まない）
+        Returns:
+            rows: configsの行のリスト
+        """
+        where, params = _filters(
+            decay_flag=decay_flag,
+            lambda_val=lambda_val,
+            config_hash=config_hash,
+            run_id=run_id,
+        )
+        rows = self.connection.execute(f"SELECT * FROM configs {where}", params)
+        configs = []
+        for row in rows:
+            config = dict(row)
+            config["decay_flag"] = bool(config["decay_flag"])
+            config["average_history"] = json.loads(config["average_history"])
+            config["metrics"] = json.loads(config["metrics"])
+            configs.append(config)
+        return configs
+
+    def query_trials(
+        self,
+        decay_flag: bool | None = None,
+        lambda_val: float | None = None,
+        config_hash: str | None = None,
+        run_id: str | None = None,
+    ) -> list[dict]:
+        """
+        試行単位の結果を返す
+
+        Args:
+            decay_flag, lambda_val, config_hash, run_id: 絞り込み条件（Noneの場合は絞り込まない）
+        Returns:
+            rows: (run_id, config_hash, lambda, decay_flag, trial, ph1, ph2, ph3) のリスト
+        """
+        where, params = _filters(
+            decay_flag=decay_flag,
+            lambda_val=lambda_val,
+            config_hash=config_hash,
+            run_id=run_id,
+        )
+        rows = self.connection.execute(
+            f"SELECT * FROM trials {where} ORDER BY run_id, config_hash, trial", params
+        )
+        return [dict(row) for row in rows]
+
+    def query_averages(
+        self,
+        decay_flag: bool | None = None,
+        config_hash: str | None = None,
+        run_id: str | None = None,
+        policy: str | None = None,
+        engine: str | None = None,
+    ) -> list[dict]:
+        """
+        設定ごとの試行平均をλ順に返す（(減衰フラグ, λ) ごとに1設定）
+
+        run_idを指定しない場合は、(減衰フラグ, λ) ごとに条件に合う最後の実行（grid.pyの実行を除く）の結果を使う。
+        エンジンとλ≠0の方策を指定しない場合は、条件に合う最後の実行の値に揃えるため、
+        設定の異なる実行の結果が混ざることはない。
+
+        Args:
+            decay_flag: 減衰フラグ（Noneの場合は両方）
+            config_hash: 設定のハッシュ値（Noneの場合は絞り込まない）
+            run_id: 実行ID（Noneの場合は (減衰フラグ, λ) ごとの最新の実行）
+            policy: λ≠0の設定の方策名（λ=0は常にbaseline。Noneの場合は最新の実行の方策）
+            engine: 実験エンジン（Noneの場合は最新の実行のエンジン）
+        Returns:
+            rows: (run_id, config_hash, lambda, decay_flag, num_trials, ph1, ph2, ph3) のリスト
+        Raises:
+            ValueError: 同じ実行に (減衰フラグ, λ) が同じ設定が複数あり、1つに決まらない場合
+        """
+        where, params = _filters(
+            "c.", decay_flag=decay_flag, config_hash=config_hash, run_id=run_id
+        )
+        if run_id is None:
+            where += " AND" if where else "WHERE"
+            where += " r.kind != ?"
+            params.append(GRID)
+        candidates = [
+            dict(row)
+            for row in self.connection.execute(
+                f"""
+                SELECT r.seq, c.run_id, c.config_hash, c.lambda, c.decay_flag,
+                    c.engine, c.policy
+                FROM configs c JOIN runs r USING (run_id)
+                {where}
+                ORDER BY r.seq
+                """,
+                params,
+            )
+        ]
+        # エンジンとλ≠0の方策を揃える（指定しない場合は最新の実行の値）
+        if engine is None and candidates:
+            engine = candidates[-1]["engine"]
+        candidates = [row for row in candidates if row["engine"] == engine]
+        if policy is None:
+            policies = [row["policy"] for row in candidates if row["lambda"] != 0]
+            policy = policies[-1] if policies else None
+        candidates = [
+            row for row in candidates if row["lambda"] == 0 or row["policy"] == policy
+        ]
+
+        # (減衰フラグ, λ) ごとに最新の実行の設定を選ぶ
+        latest = {}
+        for row in candidates:
+            latest[(row["decay_flag"], row["lambda"])] = row["seq"]
+        selected = {}
+        for row in candidates:
+            setting = (row["decay_flag"], row["lambda"])
+            if row["seq"] == latest[setting]:
+                selected.setdefault(setting, []).append(row)
+        for (flag, lambda_val), rows in selected.items():
+            if len(rows) > 1:
+                raise ValueError(
+                    f"実行 {rows[0]['run_id']} に減衰フラグ = {bool(flag)}, λ = {lambda_val} の設定が"
+                    f"複数あります (config_hash: {', '.join(row['config_hash'] for row in rows)})。"
+                    "config_hashを指定してください"
+                )
+
+        averages = []
+        for flag, lambda_val in sorted(selected, key=lambda s: (-s[0], s[1])):
+            row = selected[(flag, lambda_val)][0]
+            average = dict(
+                self.connection.execute(
+                    """
+                    SELECT run_id, config_hash, lambda, decay_flag,
+                        COUNT(*) AS num_trials,
+                        AVG(ph1) AS ph1, AVG(ph2) AS ph2, AVG(ph3) AS ph3
+                    FROM trials WHERE run_id = ? AND config_hash = ?
+                    GROUP BY run_id, config_hash, lambda, decay_flag
+                    """,
+                    (row["run_id"], row["config_hash"]),
+                ).fetchone()
+            )
+            average["decay_flag"] = bool(average["decay_flag"])
+            averages.append(average)
+        return averages
+
+
+def _filters(prefix: str = "", **conditions) -> tuple[str, list]:
+    """Noneでない条件からWHERE句とパラメータを作成する"""
+    columns = {
+        "decay_flag": "decay_flag",
+        "lambda_val": "lambda",
+        "config_hash": "config_hash",
+        "run_id": "run_id",
+    }
+    clauses = []
+    params = []
+    for name, value in conditions.items():
+        if value is None:
+            continue
+        clauses.append(f"{prefix}{columns[name]} = ?")
+        params.append(int(value) if name == "decay_flag" else value)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
@@ -0,0 +1,90 @@
+"""
+試行結果の逐次的な平均・分散（Welfordのアルゴリズム）と信頼区間
+"""
+
+import numpy as np
+
+# 95%信頼区間の正規分布の分位点
+CONFIDENCE_Z = 1.959963984540054
+
+
+class RunningStats:
+    """
+    ベクトル値の標本の平均と共分散を1標本ずつ更新する（Welfordのアルゴリズム）
+
+    全標本を保持せずに平均・分散を計算でき、和の二乗を使う方法より桁落ちしにくい。
+
+    Attributes:
+        count (int): 標本数
+        mean (np.ndarray): shape (dim,) の平均
+        comoment (np.ndarray): shape (dim, dim) の偏差積和（count - 1で割ると不偏共分散）
+    """
+
+    def __init__(self, dim: int):
+        self.count = 0
+        self.mean = np.zeros(dim)
+        self.comoment = np.zeros((dim, dim))
+
+    def update(self, values):
+        """標本を1つ追加する"""
+        values = np.asarray(values, dtype=np.float64)
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.comoment += np.outer(delta, values - self.mean)
+
+    @property
+    def covariance(self) -> np.ndarray:
+        """不偏共分散行列（標本数が2未満の場合はinf）"""
+        if self.count < 2:
+            return np.full(self.comoment.shape, np.inf)
+        return self.comoment / (self.count - 1)
+
+    def mean_interval(self, z: float = CONFIDENCE_Z) -> tuple[np.ndarray, np.ndarray]:
+        """
+        各次元の平均の信頼区間（正規近似）
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: 区間の下限と上限
+        """
+        half_width = z * np.sqrt(np.diag(self.covariance) / max(self.count, 1))
+        return self.mean - half_width, self.mean + half_width
+
+    def ratio_interval(
+        self, numerators, denominators, z: float = CONFIDENCE_Z
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        対応のある2つの次元の平均の比 mean[numerators] / mean[denominators] の信頼区間（デルタ法）
+
+        Args:
+            numerators: 分子の次元のインデックス
+            denominators: 分母の次元のインデックス
+            z: 正規分布の分位点
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: 比、区間の下限と上限（分母の平均が0の場合はnan）
+        """
+        numerators = np.asarray(numerators)
+        denominators = np.asarray(denominators)
+        cov = self.covariance
+        num = self.mean[numerators]
+        den = self.mean[denominators]
+        var_num = cov[numerators, numerators]
+        var_den = cov[denominators, denominators]
+        cov_nd = cov[numerators, denominators]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = num / den
+            # Var(X̄/Ȳ) ≈ (Var(X) - 2R·Cov(X, Y) + R²·Var(Y)) / (n·Ȳ²)
+            var_ratio = (var_num - 2 * ratio * cov_nd + ratio**2 * var_den) / (
+                max(self.count, 1) * den**2
+            )
+            half_width = z * np.sqrt(np.maximum(var_ratio, 0))
+        ratio = np.where(den != 0, ratio, np.nan)
+        return ratio, ratio - half_width, ratio + half_width
+
+
+def relative_width(estimate, lower, upper) -> np.ndarray:
+    """信頼区間の幅を推定値の絶対値で割った値（推定値が0の場合はinf）"""
+    estimate = np.abs(np.asarray(estimate, dtype=np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        width = (np.asarray(upper) - np.asarray(lower)) / estimate
+    return np.where(np.isfinite(width), width, np.inf)
@@ -4,6 +4,7 @@ import os
 import sys
 
 from models.models import User, Item
+from config import ModelConfig
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = os.path.abspath(os.path.join(current_dir, ".."))
@@ -32,9 +33,9 @@ class UserStateScoreParams:
     DECAY_RATE = 0.1 ** (1 / MAX_STEPS)  # 経過ステップごとの減衰率
 
 
-def calculate_user_state_score(ph1_count: int, steps_since_last_ph1: int) -> float:
+def _compute_user_state_score(ph1_count: int, steps_since_last_ph1: int) -> float:
     """
-    ユーザの状態スコアを計算する
+    ユーザの状態スコアを計算式から直接計算する
 
     Args:
         ph1_count: ph1の累計数（最大100）
@@ -63,6 +64,167 @@ def calculate_user_state_score(ph1_count: int, steps_since_last_ph1: int) -> flo
     return score
 
 
+class UserStateScoreTables:
+    """ユーザ状態スコアの事前計算テーブル
+
+    ph1_count, steps_since_last_ph1はそれぞれMAX_PH1_COUNT, MAX_STEPSで頭打ちになるため、
+    (MAX_PH1_COUNT + 1) × (MAX_STEPS + 1) の全状態について計算しておく。
+
+    Attributes:
+        key (tuple): テーブル作成時のパラメータ（UserStateScoreParamsとSCORE_ADJUSTMENT）
+        score (np.ndarray): 状態スコア。shape (MAX_PH1_COUNT + 1, MAX_STEPS + 1)
+        delta (np.ndarray): ph1実行後の状態スコアの変化量。shapeはscoreと同じ
+        multipliers (np.ndarray): 状態スコアのSCORE_ADJUSTMENT乗。最後の軸は (ph1, ph2, ph3)
+        score_rows, delta_rows, multiplier_rows (list): スカラー参照用のPythonリスト
+    """
+
+    def __init__(self, key: tuple):
+        self.key = key
+        max_ph1_count = UserStateScoreParams.MAX_PH1_COUNT
+        max_steps = UserStateScoreParams.MAX_STEPS
+        adjustments = [ModelConfig.SCORE_ADJUSTMENT[p] for p in ["ph1", "ph2", "ph3"]]
+
+        # 計算式による値と完全に一致させるため、各要素はスカラー版の計算式で求める
+        self.score_rows = [
+            [_compute_user_state_score(c, s) for s in range(max_steps + 1)]
+            for c in range(max_ph1_count + 1)
+        ]
+        self.delta_rows = [
+            [
+                self.score_rows[min(c + 1, max_ph1_count)][0] - self.score_rows[c][s]
+                for s in range(max_steps + 1)
+            ]
+            for c in range(max_ph1_count + 1)
+        ]
+        self.multiplier_rows = [
+            [tuple(score**adj for adj in adjustments) for score in row]
+            for row in self.score_rows
+        ]
+
+        self.score = np.array(self.score_rows, dtype=np.float64)
+        self.delta = np.array(self.delta_rows, dtype=np.float64)
+        self.multipliers = np.array(self.multiplier_rows, dtype=np.float64)
+
+
+# パラメータ（_tables_key）ごとのテーブル。パラメータを切り替えて実行する場合も各テーブルは1度だけ作成する
+_tables = {}
+
+
+def _tables_key() -> tuple:
+    return (
+        UserStateScoreParams.MAX_PH1_COUNT,
+        UserStateScoreParams.MAX_STEPS,
+        UserStateScoreParams.BASE_SCORE,
+        UserStateScoreParams.MAX_SCORE_MULTIPLIER,
+        UserStateScoreParams.DECAY_RATE,
+        ModelConfig.SCORE_ADJUSTMENT["ph1"],
+        ModelConfig.SCORE_ADJUSTMENT["ph2"],
+        ModelConfig.SCORE_ADJUSTMENT["ph3"],
+    )
+
+
+def get_user_state_score_tables() -> UserStateScoreTables:
+    """
+    ユーザ状態スコアの事前計算テーブルを取得する
+
+    UserStateScoreParamsまたはSCORE_ADJUSTMENTが変更されている場合は、そのパラメータのテーブルを作成する
+    （作成済みのパラメータに戻した場合は再利用する）。
+
+    Returns:
+        tables: 現在のパラメータに対応するテーブル
+    """
+    key = _tables_key()
+    tables = _tables.get(key)
+    if tables is None:
+        tables = _tables[key] = UserStateScoreTables(key)
+    return tables
+
+
+def _is_state_index(value) -> bool:
+    return isinstance(value, (int, np.integer)) and value >= 0
+
+
+def calculate_user_state_score(ph1_count: int, steps_since_last_ph1: int) -> float:
+    """
+    ユーザの状態スコアを計算する
+
+    整数の状態は事前計算テーブルから参照し、それ以外（可視化用の実数値など）は計算式で求める。
+
+    Args:
+        ph1_count: ph1の累計数（最大100）
+        steps_since_last_ph1: 最後のph1実行からの経過ステップ数（最大100）
+
+    Returns:
+        user_state_score: 0から2の範囲のスコア、(ph1_count, steps_since_last_ph1) = (0, 0)のときの初期値は1
+    """
+    if not (_is_state_index(ph1_count) and _is_state_index(steps_since_last_ph1)):
+        return _compute_user_state_score(ph1_count, steps_since_last_ph1)
+
+    tables = get_user_state_score_tables()
+    return tables.score_rows[min(ph1_count, UserStateScoreParams.MAX_PH1_COUNT)][
+        min(steps_since_last_ph1, UserStateScoreParams.MAX_STEPS)
+    ]
+
+
+def calculate_user_state_scores(
+    ph1_counts: np.ndarray, steps_since_last_ph1: np.ndarray
+) -> np.ndarray:
+    """
+    calculate_user_state_scoreの配列版。全ユーザの状態スコアを事前計算テーブルから一括で参照する
+
+    Args:
+        ph1_counts: ph1の累計数の配列（非負整数）
+        steps_since_last_ph1: 最後のph1実行からの経過ステップ数の配列（非負整数）
+
+    Returns:
+        user_state_scores: 各ユーザの状態スコアの配列
+    """
+    tables = get_user_state_score_tables()
+    return tables.score[
+        np.minimum(ph1_counts, UserStateScoreParams.MAX_PH1_COUNT),
+        np.minimum(steps_since_last_ph1, UserStateScoreParams.MAX_STEPS),
+    ]
+
+
+def get_phase_multipliers(
+    ph1_count: int, steps_since_last_ph1: int
+) -> tuple[float, float, float]:
+    """
+    ユーザ状態スコアのSCORE_ADJUSTMENT乗（各フェーズの成功確率に掛ける倍率）を取得する
+
+    Args:
+        ph1_count: ph1の累計数（非負整数）
+        steps_since_last_ph1: 最後のph1実行からの経過ステップ数（非負整数）
+
+    Returns:
+        multipliers: (ph1, ph2, ph3) の倍率
+    """
+    tables = get_user_state_score_tables()
+    return tables.multiplier_rows[min(ph1_count, UserStateScoreParams.MAX_PH1_COUNT)][
+        min(steps_since_last_ph1, UserStateScoreParams.MAX_STEPS)
+    ]
+
+
+def get_phase_multipliers_array(
+    ph1_counts: np.ndarray, steps_since_last_ph1: np.ndarray
+) -> np.ndarray:
+    """
+    get_phase_multipliersの配列版
+
+    Args:
+        ph1_counts: ph1の累計数の配列（非負整数）
+        steps_since_last_ph1: 最後のph1実行からの経過ステップ数の配列（非負整数）
+
+    Returns:
+        multipliers: shape (..., 3) の (ph1, ph2, ph3) の倍率
+    """
+    tables = get_user_state_score_tables()
+    return tables.multipliers[
+        np.minimum(ph1_counts, UserStateScoreParams.MAX_PH1_COUNT),
+        np.minimum(steps_since_last_ph1, UserStateScoreParams.MAX_STEPS),
+    ]
+
+
 def generate_items(n_items: int, random_seed: int = 42) -> List[Item]:
     """
     アイテムを生成する
@@ -112,9 +274,62 @@ def get_user_state_score_delta(current_ph1_count: int, current_steps: int) -> fl
     Returns:
         delta: スコアの変化量
     """
-    current_score = calculate_user_state_score(current_ph1_count, current_steps)
-    next_score = calculate_user_state_score(current_ph1_count + 1, 0)
-    return next_score - current_score
+    if not (_is_state_index(current_ph1_count) and _is_state_index(current_steps)):
+        current_score = _compute_user_state_score(current_ph1_count, current_steps)
+        next_score = _compute_user_state_score(current_ph1_count + 1, 0)
+        return next_score - current_score
+
+    tables = get_user_state_score_tables()
+    return tables.delta_rows[
+        min(current_ph1_count, UserStateScoreParams.MAX_PH1_COUNT)
+    ][min(current_steps, UserStateScoreParams.MAX_STEPS)]
+
+
+def get_user_state_score_deltas(
+    current_ph1_counts: np.ndarray, current_steps: np.ndarray
+) -> np.ndarray:
+    """
+    get_user_state_score_deltaの配列版
+
+    Args:
+        current_ph1_counts: 現在のph1累計数の配列（非負整数）
+        current_steps: 現在の経過ステップ数の配列（非負整数）
+    Returns:
+        deltas: スコアの変化量の配列
+    """
+    tables = get_user_state_score_tables()
+    return tables.delta[
+        np.minimum(current_ph1_counts, UserStateScoreParams.MAX_PH1_COUNT),
+        np.minimum(current_steps, UserStateScoreParams.MAX_STEPS),
+    ]
+
+
+def _history_array(phase_history) -> np.ndarray:
+    """{"ph1": [...], ...} 形式またはshape (steps, 3) の履歴を配列に変換する"""
+    if isinstance(phase_history, dict):
+        return np.column_stack(
+            [np.asarray(phase_history[phase]) for phase in ["ph1", "ph2", "ph3"]]
+        )
+    return np.asarray(phase_history)
+
+
+def cumulative_counts(step_counts) -> np.ndarray:
+    """
+    ステップごとの成功回数の累積和（先頭に0を付けたもの）を計算する
+
+    戻り値のprefix[step]が先頭stepステップ分の合計となるため、任意のチェックポイントの
+    累積値をO(1)で参照できる。
+
+    Args:
+        step_counts: shape (steps, 3) または {"ph1": [...], ...} 形式のステップごとの成功回数
+
+    Returns:
+        prefix: shape (steps + 1, 3) の累積成功回数
+    """
+    step_counts = _history_array(step_counts)
+    prefix = np.zeros((step_counts.shape[0] + 1, 3), dtype=np.float64)
+    np.cumsum(step_counts, axis=0, out=prefix[1:])
+    return prefix
 
 
 def calculate_step_ratios(history: dict, steps: list = [10, 20, 30, 40, 50]) -> dict:
@@ -122,7 +337,8 @@ def calculate_step_ratios(history: dict, steps: list = [10, 20, 30, 40, 50]) ->
     特定のステップでのbaselineに対する比を計算する
 
     Args:
-        history: ステップごとのスコア履歴
+        history: ステップごとのスコア履歴。"baseline", "proposed"それぞれについて
+            {"ph1": [...], ...} 形式またはshape (steps, 3) の配列
         steps: 比率を計算するステップのリスト
 
     Returns:
@@ -130,25 +346,21 @@ def calculate_step_ratios(history: dict, steps: list = [10, 20, 30, 40, 50]) ->
     """
     step_ratios = {step: {"ph1": 0.0, "ph2": 0.0, "ph3": 0.0} for step in steps}
 
+    # 累積値は1度だけ計算し、各ステップではその値を参照する
+    baseline_prefix = cumulative_counts(history["baseline"])
+    proposed_prefix = cumulative_counts(history["proposed"])
+    num_steps = baseline_prefix.shape[0] - 1
+
     for step in steps:
-        if step >= len(history["baseline"]["ph1"]):
+        if step >= num_steps:
             continue
 
-        # 各ステップまでの累積値を計算
-        baseline_cumsum = {
-            phase: sum(history["baseline"][phase][:step])
-            for phase in ["ph1", "ph2", "ph3"]
-        }
-        proposed_cumsum = {
-            phase: sum(history["proposed"][phase][:step])
-            for phase in ["ph1", "ph2", "ph3"]
-        }
-
         # 比率の計算
-        for phase in ["ph1", "ph2", "ph3"]:
-            if baseline_cumsum[phase] > 0:
-                step_ratios[step][phase] = (
-                    proposed_cumsum[phase] / baseline_cumsum[phase]
+        for phase_idx, phase in enumerate(["ph1", "ph2", "ph3"]):
+            baseline_cumsum = baseline_prefix[step, phase_idx]
+            if baseline_cumsum > 0:
+                step_ratios[step][phase] = float(
+                    proposed_prefix[step, phase_idx] / baseline_cumsum
                 )
             else:
                 step_ratios[step][phase] = 0.0
@@ -165,7 +377,7 @@ def calculate_metrics(
     Args:
         baseline_score: baselineの各フェーズのスコア
         proposed_score: proposedの各フェーズのスコア
-        history: ステップごとのスコア履歴 (オプション)
+        history: ステップごとのスコア履歴 (オプション、calculate_step_ratiosを参照)
 
     Returns:
         metrics: 各種評価指標
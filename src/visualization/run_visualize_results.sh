@@ -3,4 +3,4 @@
 ROOT_DIR=$(dirname `readlink -f $0`)
 
 # 実験ディレクトリのパスを設定
-python $ROOT_DIR/visualize_results.py
\ No newline at end of file
+python $ROOT_DIR/visualize_results.py "$@"
\ No newline at end of file
@@ -1,75 +1,96 @@
-import json
+import argparse
+import hashlib
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from pathlib import Path
-import matplotlib_fontja
-
-
-def summarize_and_plot(result_dir, plot_filename_prefix):
-    # ディレクトリ内のすべてのJSONファイルを取得
-    json_files = list(result_dir.glob("*.json"))
-    # 結果を格納するデータフレームを初期化
-    results = []
-
-    # 各ファイルを処理
-    for file in json_files:
-        # ファイルからデータを読み込む
-        with open(file, "r") as f:
-            data = json.load(f)
-        lambda_val = file.name.split("_")[1]
-        # 平均スコアを記録
-        if "average" in data:
-            for score_metric in ["ph1", "ph2", "ph3"]:
-                if score_metric in data["average"]:
-                    results.append(
-                        {
-                            "lambda": lambda_val,
-                            "metric": f"{score_metric}_score",
-                            "value": data["average"][score_metric],
-                        }
-                    )
-
-    # λ=0.0のデータを基準として比率を計算
-    df = pd.DataFrame(results)
-    # λ=0.0のデータを抽出
-    lambda_0_df = df[df["lambda"] == "0.0"]
-
-    # 各メトリクスのλ=0.0の値を取得
-    baseline_values = {}
-    for _, row in lambda_0_df.iterrows():
-        metric = row["metric"]
-        baseline_values[metric] = row["value"]
-
-    # 比率を計算
-    for i, row in df.iterrows():
-        metric = row["metric"]
-        if metric in baseline_values:
-            baseline = baseline_values[metric]
-            df.at[i, "baseline"] = baseline
-            df.at[i, "ratio"] = (
-                row["value"] / baseline if baseline != 0 else float("inf")
-            )
+import matplotlib
 
-    # 結果を表示
-    print(f"{result_dir} λ=0.0との比率:")
-    print(df.pivot(index="lambda", columns="metric", values="ratio"))
+# 図の描画はワーカープロセスで行うため、非対話バックエンドを使用する
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+from pathlib import Path  # noqa: E402
+import matplotlib_fontja  # noqa: E402, F401
 
-    # 詳細な結果を表示
-    print(f"\n{result_dir} 詳細な結果:")
-    print(
-        df.pivot(
-            index=["lambda", "metric"],
-            columns=[],
-            values=["value", "baseline", "ratio"],
-        )
+# このファイルのディレクトリの親（src）をパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from utils.results_store import RESULTS_DB, ResultsStore  # noqa: E402
+
+# 描画内容を変更した場合はこの値を変えてキャッシュを無効にする
+RENDER_VERSION = "1"
+
+
+def load_summary(store, decay_flag, run_id=None, policy=None, engine=None):
+    """
+    λごとの試行平均を、λ・メトリクスごとの1行の形式で取得します
+
+    Args:
+        store: ResultsStore
+        decay_flag: 減衰フラグ
+        run_id: 実行ID（Noneの場合はλごとに最新の実行）
+        policy: λ≠0の方策名（Noneの場合は最新の実行の方策）
+        engine: 実験エンジン（Noneの場合は最新の実行のエンジン）
+    Returns:
+        df: lambda, metric, valueの列を持つデータフレーム
+    """
+    averages = pd.DataFrame(
+        store.query_averages(
+            decay_flag=decay_flag, run_id=run_id, policy=policy, engine=engine
+        ),
+        columns=["lambda", "ph1", "ph2", "ph3"],
     )
+    df = averages.melt(
+        id_vars="lambda",
+        value_vars=["ph1", "ph2", "ph3"],
+        var_name="metric",
+        value_name="value",
+    )
+    df["metric"] = df["metric"] + "_score"
+    return df
 
-    # 結果をCSVファイルに保存
-    output_file = result_dir / f"{plot_filename_prefix}_summary_ratios.csv"
-    df.to_csv(output_file, index=False)
-    print(f"\n結果を{output_file}に保存しました。")
 
+def add_ratios(df):
+    """
+    λ=0.0の値を基準とした比率の列を追加します
+
+    Args:
+        df: load_summaryの戻り値
+    Returns:
+        df: baseline, ratioの列を追加したデータフレーム（λ=0.0がないメトリクスはNaN）
+    """
+    baseline = df.loc[df["lambda"] == 0, ["metric", "value"]].rename(
+        columns={"value": "baseline"}
+    )
+    if baseline["metric"].duplicated().any():
+        raise ValueError("λ=0の結果が複数あるため、比率の基準を決められません")
+    df = df.merge(baseline, on="metric", how="left")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = df["value"] / df["baseline"]
+    df["ratio"] = ratio.where(df["baseline"] != 0, np.inf).where(df["baseline"].notna())
+    return df.sort_values(["lambda", "metric"], ignore_index=True)
+
+
+def content_hash(df, plot_filename_prefix):
+    """集計結果と描画設定から出力のキャッシュキーを計算します"""
+    digest = hashlib.sha256()
+    digest.update(f"{RENDER_VERSION}|{plot_filename_prefix}|".encode("utf-8"))
+    digest.update(df.to_csv(index=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def render_plot(df, plot_path):
+    """
+    λ=0.0との比率のグラフを保存します（ワーカープロセスから呼び出されます）
+
+    Args:
+        df: add_ratiosの戻り値
+        plot_path: 保存先
+    """
     # グラフの作成
     plt.figure(figsize=(8, 8))
 
@@ -81,36 +102,21 @@ def summarize_and_plot(result_dir, plot_filename_prefix):
     plt.rcParams["ytick.labelsize"] = 28
     plt.rcParams["legend.fontsize"] = 14
 
-    # λ値をソート
-    lambda_values = sorted(df["lambda"].unique(), key=lambda x: float(x))
-
-    # 全メトリクスを取得
-    all_metrics = df["metric"].unique()
+    # λ値をソートし、メトリクスごとの比率を列とする
+    ratios = df.pivot(index="lambda", columns="metric", values="ratio").sort_index()
+    lambda_labels = [str(lambda_val) for lambda_val in ratios.index]
 
     # メトリクスごとの色を定義
     color_map = {"ph1_score": "red", "ph2_score": "green", "ph3_score": "blue"}
 
-    for metric in all_metrics:
-        metric_df = df[df["metric"] == metric]
-        if not metric_df.empty:
-            sorted_df = pd.DataFrame(
-                {
-                    "lambda": lambda_values,
-                    "ratio": [
-                        metric_df[metric_df["lambda"] == lv]["ratio"].values[0]
-                        if lv in metric_df["lambda"].values
-                        else np.nan
-                        for lv in lambda_values
-                    ],
-                }
-            )
-            plt.plot(
-                sorted_df["lambda"],
-                sorted_df["ratio"],
-                marker="o",
-                label=metric,
-                color=color_map.get(metric),
-            )
+    for metric in ratios.columns:
+        plt.plot(
+            lambda_labels,
+            ratios[metric].to_numpy(),
+            marker="o",
+            label=metric,
+            color=color_map.get(metric),
+        )
 
     plt.axhline(y=1.0, color="black", linestyle="--", alpha=0.5)
     plt.xlabel("λ", fontsize=32)
@@ -119,12 +125,165 @@ def summarize_and_plot(result_dir, plot_filename_prefix):
     plt.tight_layout()
 
     # グラフを保存
-    plot_path = result_dir / f"{plot_filename_prefix}_ratio_plot.pdf"
     plt.savefig(plot_path, dpi=300)
-    print(f"グラフを{plot_path}に保存しました。")
     plt.close()
+    return plot_path
+
+
+def summarize(
+    store,
+    decay_flag,
+    result_dir,
+    plot_filename_prefix,
+    run_id=None,
+    policy=None,
+    engine=None,
+):
+    """
+    集計結果を表示・保存し、グラフの描画が必要かどうかを判定します
+
+    Args:
+        store: ResultsStore
+        decay_flag: 減衰フラグ
+        result_dir: 出力ディレクトリ
+        plot_filename_prefix: 出力ファイル名の接頭辞
+        run_id: 実行ID（Noneの場合はλごとに最新の実行）
+        policy: λ≠0の方策名（Noneの場合は最新の実行の方策）
+        engine: 実験エンジン（Noneの場合は最新の実行のエンジン）
+    Returns:
+        tuple[pd.DataFrame, Path, str, bool]:
+            集計結果、グラフの保存先、キャッシュキー、キャッシュが有効かどうか
+    """
+    df = add_ratios(load_summary(store, decay_flag, run_id, policy, engine))
+
+    # 結果を表示
+    print(f"{result_dir} λ=0.0との比率:")
+    print(df.pivot(index="lambda", columns="metric", values="ratio"))
+
+    # 詳細な結果を表示
+    print(f"\n{result_dir} 詳細な結果:")
+    print(df.set_index(["lambda", "metric"])[["value", "baseline", "ratio"]])
+
+    result_dir.mkdir(parents=True, exist_ok=True)
+    output_file = result_dir / f"{plot_filename_prefix}_summary_ratios.csv"
+    plot_path = result_dir / f"{plot_filename_prefix}_ratio_plot.pdf"
+    hash_file = result_dir / f"{plot_filename_prefix}_ratio_plot.sha256"
+
+    key = content_hash(df, plot_filename_prefix)
+    cached = (
+        plot_path.exists()
+        and output_file.exists()
+        and hash_file.exists()
+        and hash_file.read_text().strip() == key
+    )
+    if cached:
+        print(f"\n入力が変わっていないため{output_file}と{plot_path}を再利用します。")
+    else:
+        # 結果をCSVファイルに保存
+        df.to_csv(output_file, index=False)
+        print(f"\n結果を{output_file}に保存しました。")
+    return df, plot_path, key, cached
+
+
+def summarize_and_plot_all(
+    store, reports, run_id=None, workers=2, force=False, policy=None, engine=None
+):
+    """
+    複数の減衰設定の集計とグラフ作成を行います（グラフはプロセスプールで並列に描画）
+
+    Args:
+        store: ResultsStore
+        reports: (減衰フラグ, 出力ディレクトリ, 出力ファイル名の接頭辞) のリスト
+        run_id: 実行ID（Noneの場合はλごとに最新の実行）
+        workers: 描画に使用するプロセス数
+        force: キャッシュを無視して描画し直すかどうか
+        policy: λ≠0の方策名（Noneの場合は最新の実行の方策）
+        engine: 実験エンジン（Noneの場合は最新の実行のエンジン）
+    """
+    tasks = []
+    for decay_flag, result_dir, plot_filename_prefix in reports:
+        df, plot_path, key, cached = summarize(
+            store, decay_flag, result_dir, plot_filename_prefix, run_id, policy, engine
+        )
+        if df.empty:
+            print(f"{result_dir}: 集計対象の結果がありません。")
+        elif force or not cached:
+            tasks.append((df, plot_path, key))
+
+    if not tasks:
+        return
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(tasks)))) as executor:
+        futures = [
+            executor.submit(render_plot, df, plot_path) for df, plot_path, _ in tasks
+        ]
+        for future, (_, plot_path, key) in zip(futures, tasks):
+            future.result()
+            # 描画が完了した場合のみキャッシュキーを記録する
+            plot_path.with_suffix(".sha256").write_text(key)
+            print(f"グラフを{plot_path}に保存しました。")
+
+
+def summarize_and_plot(
+    store, decay_flag, result_dir, plot_filename_prefix, run_id=None
+):
+    """1つの減衰設定の集計とグラフ作成を行います"""
+    summarize_and_plot_all(
+        store, [(decay_flag, result_dir, plot_filename_prefix)], run_id, workers=1
+    )
+
+
+def parse_arguments():
+    """コマンドライン引数をパースします"""
+    parser = argparse.ArgumentParser(description="実験結果の集計と可視化")
+    parser.add_argument(
+        "--results_db", default=RESULTS_DB, help="実験結果のSQLiteデータベース"
+    )
+    parser.add_argument(
+        "--run_id",
+        default=None,
+        help="集計する実行ID (指定しない場合はλごとに最新の実行を使用)",
+    )
+    parser.add_argument(
+        "--policy",
+        default=None,
+        help="集計するλ≠0の方策 (指定しない場合は最新の実行の方策)",
+    )
+    parser.add_argument(
+        "--engine",
+        default=None,
+        help="集計する実験エンジン (指定しない場合は最新の実行のエンジン)",
+    )
+    parser.add_argument(
+        "--import_json",
+        action="store_true",
+        help="results/decay_{true,false}の従来形式のJSONファイルをデータベースに取り込んでから集計する",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="グラフの描画に使用するプロセス数"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="集計結果が変わっていない場合も描画し直す",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    summarize_and_plot(Path("results/decay_true"), "decay_true")
-    summarize_and_plot(Path("results/decay_false"), "decay_false")
+    args = parse_arguments()
+    with ResultsStore(args.results_db) as store:
+        if args.import_json:
+            store.import_json(Path("results/decay_true"), decay_flag=True)
+            store.import_json(Path("results/decay_false"), decay_flag=False)
+        summarize_and_plot_all(
+            store,
+            [
+                (True, Path("results/decay_true"), "decay_true"),
+                (False, Path("results/decay_false"), "decay_false"),
+            ],
+            args.run_id,
+            args.workers,
+            args.force,
+            args.policy,
+            args.engine,
+        )
@@ -0,0 +1,21 @@
+import os
+import sys
+
+# srcをパスに追加（各スクリプトと同じくsrcからの相対でインポートする）
+src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+
+import pytest  # noqa: E402
+
+import config  # noqa: E402
+from experiments import experiment  # noqa: E402
+
+
+@pytest.fixture
+def small_experiment(monkeypatch):
+    """ユーザー数・試行回数を小さくした実験設定（データファイルを使わないgenerated形式で実行する）"""
+    for module in (config, experiment):
+        monkeypatch.setattr(module, "USER_NUM", 60)
+        monkeypatch.setattr(module, "TRIAL_NUM", 2)
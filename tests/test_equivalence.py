@@ -0,0 +1,97 @@
+"""固定シードで、同じ結果になるはずの実行方法どうしの結果を比較する"""
+
+import numpy as np
+import pytest
+
+from experiments import grid
+from experiments.envelope import EnvelopeIndex
+from experiments.experiment import run_sweep
+from experiments.vectorized import rank_items
+
+LAMBDA_VALUES = [0, 0.1]
+DECAY_FLAGS = [True, False]
+
+
+def _trials(results):
+    return {
+        (config_results["lambda"], config_results["decay_flag"]): config_results[
+            "trials"
+        ]
+        for config_results in results
+    }
+
+
+@pytest.mark.parametrize("outcome_rng", ["crn", "antithetic"])
+def test_engines_agree_under_common_random_numbers(small_experiment, outcome_rng):
+    loop = run_sweep(
+        LAMBDA_VALUES, DECAY_FLAGS, "loop", "generated", outcome_rng=outcome_rng
+    )
+    vectorized = run_sweep(
+        LAMBDA_VALUES, DECAY_FLAGS, "vectorized", "generated", outcome_rng=outcome_rng
+    )
+    assert _trials(loop) == _trials(vectorized)
+
+
+@pytest.mark.parametrize("engine", ["loop", "vectorized"])
+def test_crn_results_do_not_depend_on_shards_or_workers(small_experiment, engine):
+    expected = _trials(
+        run_sweep(LAMBDA_VALUES, DECAY_FLAGS, engine, "generated", outcome_rng="crn")
+    )
+    sharded = run_sweep(
+        LAMBDA_VALUES,
+        DECAY_FLAGS,
+        engine,
+        "generated",
+        workers=2,
+        outcome_rng="crn",
+        shard_size=25,
+    )
+    assert _trials(sharded) == expected
+
+
+def test_sequential_loop_matches_snapshot(small_experiment):
+    """デフォルトのsequential（従来の乱数列）の結果は、過去の結果を再現できるよう変わってはならない"""
+    results = run_sweep(LAMBDA_VALUES, [True], "loop", "generated")
+    assert _trials(results) == {
+        (0, True): [
+            {"ph1": 229, "ph2": 17, "ph3": 0},
+            {"ph1": 217, "ph2": 21, "ph3": 3},
+        ],
+        (0.1, True): [
+            {"ph1": 271, "ph2": 17, "ph3": 0},
+            {"ph1": 250, "ph2": 24, "ph3": 1},
+        ],
+    }
+
+
+@pytest.mark.parametrize("top_k", [1, 3])
+@pytest.mark.parametrize("decimals", [None, 2])
+def test_envelope_rank_matches_rank_items(top_k, decimals):
+    rng = np.random.default_rng(0)
+    num_users, num_steps, num_items = 30, 4, 50
+    item_scores = rng.random((num_users, num_steps, num_items, 3)) * 0.1
+    if decimals is not None:
+        # 丸めて傾き・切片の同点を多く含める
+        item_scores = np.round(item_scores, decimals)
+    index = EnvelopeIndex.build(item_scores, top_k)
+
+    users = np.arange(num_users)
+    for step in range(num_steps):
+        deltas = rng.normal(scale=0.05, size=num_users)
+        for lambda_val in [0.01, 0.1, 1.0, 10.0]:
+            ranked, _ = index.rank(
+                item_scores[:, step], users, step, deltas, lambda_val, top_k
+            )
+            expected = rank_items(item_scores[:, step], deltas, lambda_val, top_k)
+            np.testing.assert_array_equal(ranked, expected)
+
+
+def test_grid_point_matches_direct_run(small_experiment):
+    points = grid.expand_grid({"DECAY_RATE": [0.97, 0.99]})
+    grid_results = grid.run_grid(
+        points, LAMBDA_VALUES, DECAY_FLAGS, "vectorized", "generated", num_trials=2
+    )
+    for point_results in grid_results["points"]:
+        with grid.model_params(point_results["params"]):
+            direct = run_sweep(LAMBDA_VALUES, DECAY_FLAGS, "vectorized", "generated")
+        assert _trials(point_results["results"]) == _trials(direct)
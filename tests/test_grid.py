@@ -0,0 +1,48 @@
+import pytest
+
+from experiments import grid
+from experiments.experiment import run_sweep
+from utils.results_store import ResultsStore
+
+LAMBDA_VALUES = [0, 0.1]
+DECAY_FLAGS = [True, False]
+
+
+@pytest.fixture
+def grid_results(small_experiment):
+    points = grid.expand_grid({"DECAY_RATE": [0.97, 0.99]})
+    return grid.run_grid(
+        points, LAMBDA_VALUES, DECAY_FLAGS, "vectorized", "generated", num_trials=2
+    )
+
+
+def test_grid_runs_are_excluded_from_latest_averages(tmp_path, grid_results):
+    sweep = run_sweep(LAMBDA_VALUES, DECAY_FLAGS, "vectorized", "generated")
+    with ResultsStore(tmp_path / "results.db") as store:
+        store.save_run(sweep)
+        grid_run_id = grid.save_grid_run(store, grid_results)
+
+        averages = store.query_averages(decay_flag=True)
+        assert [row["config_hash"] for row in averages] == [
+            config_results["config_hash"]
+            for config_results in sweep
+            if config_results["decay_flag"]
+        ]
+
+        # グリッドの実行は同じλの設定を複数含むため、config_hashを指定する必要がある
+        with pytest.raises(ValueError):
+            store.query_averages(decay_flag=True, run_id=grid_run_id)
+        point_hash = grid_results["points"][1]["results"][1]["config_hash"]
+        assert store.query_averages(run_id=grid_run_id, config_hash=point_hash)
+
+
+def test_summary_loads_after_grid_run(tmp_path, grid_results):
+    visualize = pytest.importorskip("visualization.visualize_results")
+    with ResultsStore(tmp_path / "results.db") as store:
+        store.save_run(run_sweep(LAMBDA_VALUES, DECAY_FLAGS, "vectorized", "generated"))
+        grid.save_grid_run(store, grid_results)
+
+        df = visualize.add_ratios(visualize.load_summary(store, decay_flag=True))
+
+    ratios = df.pivot(index="lambda", columns="metric", values="ratio")
+    assert list(ratios.index) == LAMBDA_VALUES
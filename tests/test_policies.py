@@ -0,0 +1,63 @@
+"""方策の事前計算が実験ごとに1度だけ行われ、準備したインスタンスが試行で使われることを確認する"""
+
+import pytest
+
+from experiments import grid
+from experiments.experiment import run_sweep
+from experiments.policies import POLICIES, ProposedPolicy
+
+LAMBDA_VALUES = [0, 0.1, 0.2]
+DECAY_FLAGS = [True, False]
+
+
+class PreparedPolicy(ProposedPolicy):
+    """prepareの呼び出し回数を数え、準備前に使われると失敗する方策"""
+
+    name = "prepared"
+    num_prepared = 0
+
+    def __init__(self):
+        self.prepared = False
+
+    def prepare(self):
+        PreparedPolicy.num_prepared += 1
+        self.prepared = True
+
+    def features(self, users):
+        assert self.prepared, "準備していないインスタンスが試行で使われました"
+        return super().features(users)
+
+    def user_features(self, user):
+        assert self.prepared, "準備していないインスタンスが試行で使われました"
+        return super().user_features(user)
+
+
+@pytest.fixture
+def prepared_policy(monkeypatch):
+    monkeypatch.setitem(POLICIES, PreparedPolicy.name, PreparedPolicy)
+    monkeypatch.setattr(PreparedPolicy, "num_prepared", 0)
+    return PreparedPolicy
+
+
+@pytest.mark.parametrize("engine", ["loop", "vectorized"])
+def test_sweep_prepares_policy_once(small_experiment, prepared_policy, engine):
+    run_sweep(
+        LAMBDA_VALUES, DECAY_FLAGS, engine, "generated", policy=prepared_policy.name
+    )
+    assert prepared_policy.num_prepared == 1
+
+
+def test_grid_prepares_policy_once_per_task(small_experiment, prepared_policy):
+    points = grid.expand_grid({"DECAY_RATE": [0.97, 0.99]})
+    grid.run_grid(
+        points,
+        LAMBDA_VALUES,
+        DECAY_FLAGS,
+        "vectorized",
+        "generated",
+        policy=prepared_policy.name,
+    )
+    tasks, _ = grid.plan_tasks(points, LAMBDA_VALUES, DECAY_FLAGS, prepared_policy.name)
+    num_tasks = sum(task.policy_name == prepared_policy.name for task in tasks)
+    assert num_tasks > 0
+    assert prepared_policy.num_prepared == num_tasks
@@ -0,0 +1,60 @@
+import asyncio
+import json
+
+import numpy as np
+
+from serving.ranking_service import RankingService
+
+
+async def _exchange(service, lines):
+    """サーバを起動し、1つの接続からlinesを送って同数の応答を受け取る"""
+    batcher_task = asyncio.create_task(service.batcher.run())
+    server = await asyncio.start_server(
+        service.handle_connection, "127.0.0.1", 0, limit=service.max_request_bytes
+    )
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=2**24)
+        responses = []
+        # 応答の順序を固定するため1行ずつ送る
+        for line in lines:
+            writer.write(line)
+            await writer.drain()
+            responses.append(json.loads(await reader.readline()))
+        writer.close()
+        return responses
+    finally:
+        server.close()
+        batcher_task.cancel()
+
+
+def _request(request_id, num_candidates):
+    rng = np.random.default_rng(request_id)
+    request = {
+        "id": request_id,
+        "ph1_count": 3,
+        "steps_since_last_ph1": 5,
+        "candidates": rng.random((num_candidates, 3)).round(6).tolist(),
+        "lambda": 0.1,
+        "top_k": 5,
+    }
+    return json.dumps(request).encode("utf-8") + b"\n"
+
+
+def test_large_request_is_served():
+    """既定の上限では候補5000件のリクエスト（64KiB超）も処理できる"""
+    line = _request(1, 5000)
+    assert len(line) > 2**16
+    (response,) = asyncio.run(_exchange(RankingService(), [line]))
+    assert response["id"] == 1
+    assert len(response["items"]) == 5
+
+
+def test_oversize_request_returns_error_and_keeps_connection():
+    """上限を超えた行にはエラーを返し、同じ接続の次のリクエストを処理する"""
+    service = RankingService(max_request_bytes=4096)
+    responses = asyncio.run(_exchange(service, [_request(1, 5000), _request(2, 10)]))
+    assert responses[0]["id"] is None
+    assert "4096" in responses[0]["error"]
+    assert responses[1]["id"] == 2
+    assert len(responses[1]["items"]) == 5
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from utils.results_store import ResultsStore
+
+
+def config_results(lambda_val, decay_flag, config_hash, ph1, engine="vectorized"):
+    return {
+        "lambda": lambda_val,
+        "decay_flag": decay_flag,
+        "engine": engine,
+        "policy": "baseline" if lambda_val == 0 else "proposed",
+        "config_hash": config_hash,
+        "trials": [{"ph1": ph1, "ph2": 0, "ph3": 0}] * 2,
+    }
+
+
+@pytest.fixture
+def store(tmp_path):
+    with ResultsStore(tmp_path / "results.db") as store:
+        yield store
+
+
+def test_query_averages_uses_latest_run_per_setting(store):
+    store.save_run(
+        [config_results(0, True, "a0", 1), config_results(0.1, True, "a1", 2)]
+    )
+    store.save_run([config_results(0.1, True, "b1", 3)])
+
+    averages = store.query_averages(decay_flag=True)
+
+    assert [(row["lambda"], row["config_hash"], row["ph1"]) for row in averages] == [
+        (0, "a0", 1),
+        (0.1, "b1", 3),
+    ]
+
+
+def test_query_averages_does_not_mix_engines(store):
+    store.save_run(
+        [config_results(0, True, "v0", 1), config_results(0.1, True, "v1", 2)]
+    )
+    store.save_run([config_results(0.1, True, "l1", 5, engine="loop")])
+
+    latest = store.query_averages(decay_flag=True)
+    vectorized = store.query_averages(decay_flag=True, engine="vectorized")
+
+    assert [row["config_hash"] for row in latest] == ["l1"]
+    assert [row["config_hash"] for row in vectorized] == ["v0", "v1"]
+
+
+def test_query_averages_rejects_ambiguous_settings(store):
+    store.save_run([config_results(0, True, "x", 1), config_results(0, True, "y", 2)])
+
+    with pytest.raises(ValueError, match="config_hash"):
+        store.query_averages(decay_flag=True)
+    assert [row["ph1"] for row in store.query_averages(config_hash="y")] == [2]
+
+
+def test_import_json_skips_imported_files(store, tmp_path):
+    result_dir = tmp_path / "decay_true"
+    result_dir.mkdir()
+    for lambda_val, ph1 in [(0, 1), (0.1, 2)]:
+        data = config_results(lambda_val, True, "legacy", ph1)
+        (result_dir / f"lambda_{lambda_val}.json").write_text(json.dumps(data))
+    store.save_run([config_results(0.1, True, "new", 5)])
+
+    imported = store.import_json(result_dir, decay_flag=True)
+    averages = store.query_averages(decay_flag=True)
+
+    assert len(imported) == 2
+    assert store.import_json(result_dir, decay_flag=True) == []
+    assert len(store.runs()) == 3
+    assert store.query_averages(decay_flag=True) == averages
@@ -0,0 +1,36 @@
+import numpy as np
+
+from experiments.experiment import run_sweep
+from experiments.tracing import load_trace, trace_files
+
+LAMBDA_VALUES = [0, 0.1]
+
+
+def _sorted_trace(trace_dir):
+    trace = load_trace(trace_dir, ["trial", "user", "step", "slot", "item", "ph1"])
+    order = np.lexsort((trace["slot"], trace["step"], trace["user"], trace["trial"]))
+    return {name: values[order] for name, values in trace.items()}
+
+
+def test_rerun_with_different_shard_size_replaces_trace(tmp_path, small_experiment):
+    """シャードサイズを変えて同じディレクトリに記録し直しても、以前の実行のファイルが混ざらない"""
+    trace_dir = tmp_path / "traces"
+    run_sweep(LAMBDA_VALUES, [True], "vectorized", "generated", trace_dir=trace_dir)
+    expected = _sorted_trace(trace_dir)
+
+    sharded_dir = tmp_path / "sharded"
+    run_sweep(
+        LAMBDA_VALUES,
+        [True],
+        "vectorized",
+        "generated",
+        shard_size=25,
+        trace_dir=sharded_dir,
+    )
+    # シャードごとのファイル（trial_*_25_0.npzなど）が残った状態で、分割せずに記録し直す
+    run_sweep(LAMBDA_VALUES, [True], "vectorized", "generated", trace_dir=sharded_dir)
+
+    assert len(trace_files(sharded_dir)) == len(trace_files(trace_dir))
+    rerun = _sorted_trace(sharded_dir)
+    for name, values in expected.items():
+        np.testing.assert_array_equal(rerun[name], values)